@@ -0,0 +1,659 @@
+"""
+Asyncio counterparts of the external file retrievers.
+
+The async retrievers take the same file metadata and return the same Dict of
+DownloadStatus as get_syracuse_qdr_files, get_harvard_dataverse_files and
+get_mpd_files, so they can be awaited from an asyncio application without
+tying up a thread per manifest. Responses are streamed to disk with aiohttp
+and aiofiles, and the downloads share one aiohttp session per call.
+
+Cancelling a retriever (or async_download_from_url) cancels the downloads in
+progress, removes their partial '.part' files and raises asyncio.CancelledError.
+Zip files and idp tokens are still handled in worker threads, so an unpack or
+token request that has started runs to completion before the cancellation.
+
+Usage:
+    completed = await async_get_harvard_dataverse_files(
+        file_metadata_list=file_metadata_list, download_path="data"
+    )
+"""
+
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import aiofiles
+import aiohttp
+from cdislogging import get_logger
+
+from heal.download_plan import DownloadPlan
+from heal.harvard_downloads import plan_harvard_dataverse_files
+from heal.metrics import (
+    PhaseTimer,
+    emit_file_metrics,
+    emit_manifest_metrics,
+    emit_metrics,
+    metrics_enabled,
+)
+from heal.mpd_downloads import plan_mpd_files
+from heal.progress import ProgressReporter, progress_enabled
+from heal.qdr_downloads import get_request_headers, plan_syracuse_qdr_files
+from heal.utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_MAX_PER_HOST,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RETRY_POLICY,
+    DEFAULT_UNPACK_WORKERS,
+    DownloadResult,
+    RetryPolicy,
+    get_content_total,
+    get_filename,
+    get_filename_from_headers,
+    get_host,
+    get_idp_access_token,
+    get_part_filename,
+    get_retry_after,
+    get_zip_filename,
+    remove_part_files,
+    unpack_download,
+)
+
+logger = get_logger("__name__", log_level="debug")
+
+# no overall limit, large studies can take a long time to download
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+
+
+async def async_get_syracuse_qdr_files(
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    unpack_workers: int = DEFAULT_UNPACK_WORKERS,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    plan: DownloadPlan = None,
+) -> Dict:
+    """
+    Retrieves external data from the Syracuse QDR, see get_syracuse_qdr_files.
+
+    Args:
+        wts_hostname (str): hostname for commons with wts
+        auth (Gen3Auth): auth for commons with wts
+        file_metadata_list (List of Dict): list of studies or files
+        download_path (str): path to download files and unpack
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        unpack_workers (int): number of threads for unpacking each zip file
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        plan (DownloadPlan): download plan, used instead of file_metadata_list
+
+    Returns:
+        Dict of download status
+    """
+    if not Path(download_path).exists():
+        logger.critical(f"Download path does not exist: {download_path}")
+        return None
+
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_syracuse_qdr_files(wts_hostname, auth, file_metadata_list)
+    jobs = plan.get_jobs()
+    async with aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT) as session:
+        for job in jobs.values():
+            job.update(
+                session=session,
+                wts_hostname=wts_hostname,
+                auth=auth,
+                download_path=download_path,
+                unpack_workers=unpack_workers,
+                retry_policy=retry_policy,
+            )
+        results = await async_download_concurrently(
+            async_download_qdr_file,
+            jobs,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+        )
+    completed = plan.get_completed(results)
+    emit_manifest_metrics("QDR", completed, start_time)
+
+    if not completed:
+        return None
+    return completed
+
+
+async def async_get_harvard_dataverse_files(
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    unpack_workers: int = DEFAULT_UNPACK_WORKERS,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    plan: DownloadPlan = None,
+) -> Dict:
+    """
+    Retrieves external data from Harvard Dataverse, see get_harvard_dataverse_files.
+
+    Args:
+        wts_hostname (str): hostname for commons with wts, not used
+        auth (Gen3Auth): auth for commons with wts, not used
+        file_metadata_list (List of Dict): list of studies or files
+        download_path (str): path to download files and unpack
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        unpack_workers (int): number of threads for unpacking each zip file
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        plan (DownloadPlan): download plan, used instead of file_metadata_list
+
+    Returns:
+        Dict of download status
+    """
+    if not Path(download_path).exists():
+        logger.critical(f"Download path does not exist: {download_path}")
+        return None
+
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_harvard_dataverse_files(file_metadata_list)
+    jobs = plan.get_jobs()
+    async with aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT) as session:
+        for job in jobs.values():
+            job.update(
+                session=session,
+                download_path=download_path,
+                unpack_workers=unpack_workers,
+                retry_policy=retry_policy,
+            )
+        results = await async_download_concurrently(
+            async_download_harvard_dataverse_file,
+            jobs,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+        )
+    completed = plan.get_completed(results)
+    emit_manifest_metrics("Dataverse", completed, start_time)
+
+    if not completed:
+        return None
+    return completed
+
+
+async def async_get_mpd_files(
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List[Dict],
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    plan: DownloadPlan = None,
+) -> Dict:
+    """
+    Retrieve data from the Mouse Phenome Database (MPD), see get_mpd_files.
+
+    Args:
+        wts_hostname (str): not used, MPD does not require auth
+        auth: not used, MPD does not require auth
+        file_metadata_list (List of Dict): list of MPD projects or measures
+        download_path (str): path to save downloaded CSV files
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        plan (DownloadPlan): download plan, used instead of file_metadata_list
+
+    Returns:
+        Dict of download status
+    """
+    if not Path(download_path).exists():
+        logger.critical(f"Download path does not exist: {download_path}")
+        return None
+
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_mpd_files(file_metadata_list)
+    jobs = plan.get_jobs()
+    async with aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT) as session:
+        for job in jobs.values():
+            job.update(
+                session=session, download_path=download_path, retry_policy=retry_policy
+            )
+        results = await async_download_concurrently(
+            async_download_mpd_file,
+            jobs,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+        )
+    completed = plan.get_completed(results)
+    emit_manifest_metrics("MPD", completed, start_time)
+
+    return completed if completed else None
+
+
+async def async_download_qdr_file(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    id: str,
+    wts_hostname: str,
+    auth,
+    file_metadata: Dict,
+    download_path: str = ".",
+    unpack_workers: int = 1,
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """
+    Download a single QDR study or file and unpack it if it is a zip file.
+
+    Args:
+        session (aiohttp.ClientSession): session for the download
+        api_url (str): QDR download url
+        id (str): study_id or file_id
+        wts_hostname (str): hostname for commons with wts
+        auth (Gen3Auth): auth for commons with wts
+        file_metadata (Dict): metadata for the study or file
+        download_path (str): path to download files and unpack
+        unpack_workers (int): number of threads for unpacking a zip file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        status string: "downloaded" or "failed"
+    """
+    timer = PhaseTimer()
+    idp_access_token = await asyncio.to_thread(
+        get_idp_access_token, wts_hostname, auth, file_metadata
+    )
+    timer.mark("token")
+    request_headers = get_request_headers(idp_access_token)
+    if "Authorization" not in request_headers:
+        logger.critical("WARNING Request headers do not include a bearer token.")
+
+    result = await async_fetch_from_url(
+        session,
+        api_url,
+        headers=request_headers,
+        download_path=download_path,
+        filename=get_filename(file_metadata),
+        retry_policy=retry_policy,
+        file_id=id,
+        zip_filename=get_zip_filename(api_url, file_metadata),
+    )
+    timer.mark("download")
+    status = await asyncio.to_thread(unpack_download, id, result, unpack_workers, timer)
+    emit_file_metrics("QDR", id, status, timer)
+    return status
+
+
+async def async_download_harvard_dataverse_file(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    id: str,
+    file_metadata: Dict,
+    download_path: str = ".",
+    unpack_workers: int = 1,
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """
+    Download a single Harvard Dataverse study or file and unpack it if it is a zip file.
+
+    Args:
+        session (aiohttp.ClientSession): session for the download
+        api_url (str): Dataverse download url
+        id (str): study_id or file_id
+        file_metadata (Dict): metadata for the study or file
+        download_path (str): path to download files and unpack
+        unpack_workers (int): number of threads for unpacking a zip file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        status string: "downloaded" or "failed"
+    """
+    timer = PhaseTimer()
+    result = await async_fetch_from_url(
+        session,
+        api_url,
+        download_path=download_path,
+        filename=get_filename(file_metadata),
+        retry_policy=retry_policy,
+        file_id=id,
+        zip_filename=get_zip_filename(api_url, file_metadata),
+    )
+    timer.mark("download")
+    status = await asyncio.to_thread(unpack_download, id, result, unpack_workers, timer)
+    emit_file_metrics("Dataverse", id, status, timer)
+    return status
+
+
+async def async_download_mpd_file(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    object_id: str,
+    filename: str,
+    download_path: str = ".",
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """Download a single MPD project or measure CSV, returning the status string."""
+    timer = PhaseTimer()
+    result = await async_fetch_from_url(
+        session,
+        api_url,
+        download_path=download_path,
+        filename=filename,
+        retry_policy=retry_policy,
+        file_id=object_id,
+    )
+    timer.mark("download")
+    emit_file_metrics("MPD", object_id, result.status, timer)
+    return result.status
+
+
+async def async_download_concurrently(
+    download_coroutine: Callable,
+    jobs: Dict,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+) -> Dict:
+    """
+    Run download coroutines concurrently, see download_concurrently.
+
+    Args:
+        download_coroutine (Callable): async function taking the job kwargs and
+            returning a status string
+        jobs (Dict): kwargs for download_coroutine by id, each with an 'api_url'
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+
+    Returns:
+        Dict of status string by id, in the order of jobs
+    """
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+    host_semaphores = {}
+
+    async def run(id, kwargs):
+        host = get_host(kwargs["api_url"])
+        host_semaphore = host_semaphores.setdefault(
+            host, asyncio.Semaphore(max(1, max_per_host))
+        )
+        # wait for the host before taking a worker, so one busy host
+        # does not hold up downloads from other hosts
+        async with host_semaphore, semaphore:
+            try:
+                return await download_coroutine(**kwargs)
+            except Exception as exc:
+                logger.critical(f"Error downloading {id}: {exc}")
+                return "failed"
+
+    async with asyncio.TaskGroup() as group:
+        tasks = {id: group.create_task(run(id, kwargs)) for id, kwargs in jobs.items()}
+    return {id: task.result() for id, task in tasks.items()}
+
+
+async def async_download_from_url(
+    api_url: str,
+    headers=None,
+    download_path: str = ".",
+    filename: str = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retry_policy: RetryPolicy = None,
+    session: aiohttp.ClientSession = None,
+    progress: Callable = None,
+) -> str:
+    """
+    Retrieve data file (study_id or file_id) from url, see download_from_url.
+    Save the file based on the filename in the Content-Disposition response header.
+
+    Args:
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        download_path (str): path for saving downloaded zip file
+        filename (str): filename to save downloaded files to, default is to get a
+          filename by parsing response headers.
+        chunk_size (int): number of bytes read from the response and written to
+            file at a time
+        retry_policy (RetryPolicy): if set then retry requests that time out or fail
+            with a retryable status, default is no retries
+        session (aiohttp.ClientSession): session for the request, default is a
+            new session for this download
+        progress (Callable): called with a FileProgress as the file downloads,
+            see heal.progress
+
+    Returns:
+        path to downloaded and renamed file, None if there are errors
+    """
+    if session is None:
+        async with aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT) as session:
+            return await async_download_from_url(
+                api_url,
+                headers=headers,
+                download_path=download_path,
+                filename=filename,
+                chunk_size=chunk_size,
+                retry_policy=retry_policy,
+                session=session,
+                progress=progress,
+            )
+    result = await async_fetch_from_url(
+        session,
+        api_url,
+        headers=headers,
+        download_path=download_path,
+        filename=filename,
+        chunk_size=chunk_size,
+        retry_policy=retry_policy,
+        progress=progress,
+    )
+    return result.path
+
+
+async def async_fetch_from_url(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    headers=None,
+    download_path: str = ".",
+    filename: str = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retry_policy: RetryPolicy = None,
+    file_id: str = None,
+    progress: Callable = None,
+    zip_filename: str = None,
+) -> DownloadResult:
+    """
+    Retrieve data file from url and report the outcome, see fetch_from_url.
+
+    Data is written to a part file, see get_part_filename, and renamed when the
+    download is complete. The part file is removed if the download fails or is
+    cancelled.
+
+    Args:
+        session (aiohttp.ClientSession): session for the request
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        download_path (str): path for saving downloaded zip file
+        filename (str): filename to save downloaded files to, default is to get a
+          filename by parsing response headers.
+        chunk_size (int): number of bytes read from the response and written to
+            file at a time
+        retry_policy (RetryPolicy): if set then retry requests that time out or fail
+            with a retryable status, default is no retries
+        file_id (str): resolved study_id or file_id, for metrics and progress
+        progress (Callable): called with a FileProgress as the file downloads,
+            see heal.progress
+        zip_filename (str): filename for a zip file if filename is not set,
+            see get_zip_filename
+
+    Returns:
+        DownloadResult with the path to the downloaded and renamed file,
+        and a status of "downloaded" or "failed".
+    """
+    reporter = None
+    if progress is not None or progress_enabled():
+        reporter = ProgressReporter(api_url, file_id=file_id, callback=progress)
+    start_time = time.perf_counter()
+    response = await async_get_response(
+        session, api_url, headers=headers, retry_policy=retry_policy
+    )
+    response_time = time.perf_counter()
+    if response is None:
+        result = DownloadResult(status="failed")
+    else:
+        async with response:
+            result = await save_response(
+                response,
+                api_url,
+                download_path,
+                filename,
+                chunk_size,
+                reporter,
+                zip_filename,
+            )
+
+    if metrics_enabled():
+        end_time = time.perf_counter()
+        emit_metrics(
+            "download",
+            api_url=api_url,
+            file_id=file_id,
+            status=result.status,
+            bytes=os.path.getsize(result.path) if result.path else 0,
+            resumes=0,
+            first_byte_seconds=response_time - start_time,
+            transfer_seconds=end_time - response_time,
+            total_seconds=end_time - start_time,
+        )
+    if reporter is not None:
+        reporter.finish(result.status)
+    return result
+
+
+async def save_response(
+    response: aiohttp.ClientResponse,
+    api_url: str,
+    download_path: str,
+    filename: str,
+    chunk_size: int,
+    reporter: ProgressReporter = None,
+    zip_filename: str = None,
+) -> DownloadResult:
+    """
+    Stream the body of a response to a file.
+
+    Args:
+        response (aiohttp.ClientResponse): response with status 200
+        api_url (str): url of the request
+        download_path (str): path for saving the file
+        filename (str): filename, default is to get a filename from response headers
+        chunk_size (int): number of bytes written to file at a time
+        reporter (ProgressReporter): if set then the bytes received are reported
+        zip_filename (str): filename for a zip file if filename is not set
+
+    Returns:
+        DownloadResult
+    """
+    if filename is None:
+        filename = get_filename_from_headers(response.headers)
+        if filename is None:
+            filename = api_url.split("/")[-1]
+        if zip_filename is not None and filename.endswith("zip"):
+            filename = zip_filename
+
+    if filename.endswith("zip") and not "application/zip" in response.headers.get(
+        "Content-Type", ""
+    ):
+        logger.critical("Response headers do not show zipfile content-type")
+
+    download_filename = f"{download_path}/{filename}"
+    part_filename = get_part_filename(download_filename, api_url)
+    logger.info(f"Saving download as {download_filename}")
+    if reporter is not None:
+        reporter.start(filename, 0, get_content_total(response))
+    try:
+        async with aiofiles.open(part_filename, "wb") as file:
+            async for data in response.content.iter_chunked(chunk_size):
+                await file.write(data)
+                if reporter is not None:
+                    reporter.update(len(data))
+    except asyncio.CancelledError:
+        logger.warning(f"Download of {download_filename} cancelled")
+        remove_part_files(part_filename)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        logger.critical(f"Download of {download_filename} interrupted: {exc}")
+        remove_part_files(part_filename)
+        return DownloadResult(status="failed")
+    except IOError as ex:
+        logger.critical(f"IOError opening {download_filename} for writing: {ex}")
+        remove_part_files(part_filename)
+        return DownloadResult(status="failed")
+
+    os.replace(part_filename, download_filename)
+    total_downloaded = os.path.getsize(download_filename)
+    if total_downloaded == 0:
+        logger.critical("content-length is 0 and it should not be")
+        return DownloadResult(status="failed")
+    logger.debug(f"Download size = {total_downloaded}")
+    return DownloadResult(path=download_filename, status="downloaded")
+
+
+async def async_get_response(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    headers=None,
+    retry_policy: RetryPolicy = None,
+) -> aiohttp.ClientResponse:
+    """
+    Send a GET request, see get_response.
+
+    Args:
+        session (aiohttp.ClientSession): session for the request
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        retry_policy (RetryPolicy): if set then retry timeouts, connection errors
+            and retryable status codes, default is no retries
+
+    Returns:
+        response with the body not yet read, None if there are errors
+    """
+    attempt = 0
+    while True:
+        retry_after = None
+        try:
+            response = await session.get(api_url, headers=headers)
+        except asyncio.TimeoutError:
+            error = f"Was unable to get the download url: {api_url}. Timeout Error."
+        except aiohttp.ClientConnectionError as exc:
+            error = f"ConnectionError in download {exc}"
+        except Exception as exc:
+            logger.critical(f"Error in download {exc}")
+            return None
+        else:
+            if response.status < 400:
+                logger.debug(f"Status code={response.status}")
+                return response
+            response.release()
+            error = (
+                f"HTTPError in download {response.status} {response.reason} "
+                f"for url: {api_url}"
+            )
+            if retry_policy is None or response.status not in retry_policy.status_codes:
+                logger.critical(error)
+                return None
+            if response.status in (429, 503):
+                retry_after = get_retry_after(response)
+
+        if retry_policy is None or attempt >= retry_policy.max_retries:
+            logger.critical(error)
+            return None
+        backoff = retry_policy.get_backoff(attempt, retry_after)
+        attempt += 1
+        logger.warning(
+            f"{error} Retrying in {backoff:.2f} seconds, "
+            f"attempt {attempt} of {retry_policy.max_retries}"
+        )
+        await asyncio.sleep(backoff)
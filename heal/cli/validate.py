@@ -1,8 +1,12 @@
+import json
+import logging as std_logging
+
 import click
 from cdislogging import get_logger
 from jsonschema import ValidationError
 
-from heal.vlmd.validate.validate import vlmd_validate
+from heal.vlmd.file_utils import get_input_files
+from heal.vlmd.validate.validate import vlmd_validate, vlmd_validate_many
 
 logging = get_logger("__name__")
 
@@ -11,13 +15,41 @@ logging = get_logger("__name__")
 @click.option(
     "--input_file",
     "input_file",
-    required=True,
     help="name of file to validate",
     type=click.Path(writable=True),
 )
-def validate(input_file):
+@click.option(
+    "--input_dir",
+    "input_dir",
+    help="directory of files to validate, writes a json line for each file",
+    type=click.Path(exists=True, file_okay=False),
+    metavar="PATH",
+)
+@click.option(
+    "--glob",
+    "pattern",
+    help="pattern of the files to validate in input_dir, eg '**/*.csv'  [default: *]",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--workers",
+    "workers",
+    help="number of worker processes for validating files in input_dir",
+    default=None,
+    type=int,
+)
+def validate(input_file, input_dir, pattern, workers):
     """Validate VLMD input file"""
 
+    if input_dir is not None or pattern is not None:
+        if input_file is not None:
+            raise click.UsageError("Use --input_file or --input_dir, not both")
+        validate_dir(input_dir or ".", pattern or "*", workers)
+        return
+    if input_file is None:
+        raise click.UsageError("Missing option '--input_file' or '--input_dir'")
+
     logging.info(f"Validating VLMD file{input_file}")
 
     try:
@@ -29,3 +61,23 @@ def validate(input_file):
     except Exception as e:
         logging.error(f"Validation error {str(e)}")
         logging.error("Invalid file")
+
+
+def validate_dir(input_dir, pattern, workers):
+    """
+    Validate the files in a directory and write a json line for each file.
+    Logging is disabled while validating, so that stdout only has the json lines.
+    """
+    input_files = get_input_files(input_dir, pattern)
+    disabled_level = std_logging.root.manager.disable
+    std_logging.disable(std_logging.CRITICAL)
+    valid = 0
+    try:
+        for result in vlmd_validate_many(
+            input_files, workers=workers, collect_errors=True
+        ):
+            valid += result["valid"]
+            click.echo(json.dumps(result))
+    finally:
+        std_logging.disable(disabled_level)
+    click.echo(f"{valid} of {len(input_files)} files are valid", err=True)
@@ -0,0 +1,197 @@
+"""
+Planning pass for the get_*_files retrievers.
+
+A DownloadPlan is built from a manifest before anything is downloaded. It keeps
+one download job per study_id or file_id, drops repeated entries, and can drop
+file requests that are already covered by a study in the same manifest.
+The plan can be inspected, timed and then passed to the retriever with plan=...
+
+Usage:
+    plan = plan_harvard_dataverse_files(file_metadata_list, resolve_studies=True)
+    print(plan.summary())
+    get_harvard_dataverse_files(None, None, file_metadata_list, plan=plan)
+"""
+
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from cdislogging import get_logger
+from gen3.tools.download.drs_download import DownloadStatus
+
+from heal.metrics import emit_metrics
+
+logger = get_logger("__name__", log_level="debug")
+
+
+class DownloadPlan:
+    """
+    The download jobs for a manifest, after dedup and dropping covered files.
+
+    Jobs are ordered with studies first, since study zip files are usually the
+    largest downloads and starting them early shortens the total download time,
+    and otherwise in manifest order.
+
+    Args:
+        retriever (str): retriever name, eg "QDR"
+
+    Attributes:
+        statuses (Dict): initial DownloadStatus by id, "pending" or "invalid url"
+        jobs (Dict): download job kwargs by id
+        studies (Set[str]): ids of the jobs that download studies
+        duplicates (Dict): number of repeated manifest entries dropped by id
+        covered (Dict): study_id by file_id for files downloaded with a study
+        groups (Dict): member ids by id of the jobs that download several
+            manifest entries with one request
+        entries (int): number of manifest entries
+        planning_seconds (float): time taken to build the plan
+    """
+
+    def __init__(self, retriever: str):
+        self.retriever = retriever
+        self.statuses = {}
+        self.jobs = {}
+        self.studies = set()
+        self.duplicates = {}
+        self.covered = {}
+        self.groups = {}
+        self.entries = 0
+        self.planning_seconds = 0.0
+        self._start_time = time.perf_counter()
+
+    def add(self, id: str, filename: str, job: Optional[Dict], study: bool = False):
+        """
+        Add a manifest entry to the plan.
+
+        A repeated id replaces the earlier entry, with a warning if the entries
+        differ, and is counted in duplicates.
+
+        Args:
+            id (str): study_id, file_id or other object id
+            filename (str): filename for the DownloadStatus
+            job (Dict): download job kwargs, None if there is no download url
+            study (bool): True if the job downloads a study
+        """
+        self.entries += 1
+        if id in self.statuses:
+            self.duplicates[id] = self.duplicates.get(id, 0) + 1
+            if job is not None and job == self.jobs.get(id):
+                return
+            logger.warning(
+                f"{id} is in the manifest more than once, using the last entry"
+            )
+            self.jobs.pop(id, None)
+            self.studies.discard(id)
+
+        self.statuses[id] = DownloadStatus(
+            filename=filename, status="pending" if job is not None else "invalid url"
+        )
+        if job is not None:
+            self.jobs[id] = job
+            if study:
+                self.studies.add(id)
+
+    def add_skipped(self):
+        """Count a manifest entry without an id"""
+        self.entries += 1
+
+    def drop_covered_files(self, get_study_file_urls: Callable[[Dict], Set[str]]):
+        """
+        Drop file jobs whose files are downloaded with a study in the plan.
+
+        Files with a 'filename' in their metadata are kept, since files in a
+        study zip keep their own names.
+
+        Args:
+            get_study_file_urls (Callable): called with a study job, returns the
+                download urls of the files in the study, or None if unknown
+        """
+        file_ids_by_url = {
+            job["api_url"]: id
+            for id, job in self.jobs.items()
+            if id not in self.studies and "filename" not in job.get("file_metadata", {})
+        }
+        for study_id in [id for id in self.jobs if id in self.studies]:
+            if not file_ids_by_url:
+                break
+            for url in get_study_file_urls(self.jobs[study_id]) or []:
+                file_id = file_ids_by_url.pop(url, None)
+                if file_id is not None:
+                    logger.info(f"{file_id} is downloaded with study {study_id}")
+                    self.covered[file_id] = study_id
+                    del self.jobs[file_id]
+
+    def group_jobs(self, id: str, member_ids: List[str], job: Dict):
+        """
+        Replace the jobs of several manifest entries with one job for all of them.
+
+        The group job returns a Dict of status string by member id, or a status
+        string for all of the members.
+
+        Args:
+            id (str): id of the group job, not an id in the manifest
+            member_ids (List[str]): ids of the entries downloaded by the job
+            job (Dict): download job kwargs
+        """
+        for member_id in member_ids:
+            self.jobs.pop(member_id, None)
+        self.jobs[id] = job
+        self.groups[id] = list(member_ids)
+
+    def finish(self) -> "DownloadPlan":
+        """Order the jobs and record the planning time"""
+        self.jobs = dict(
+            sorted(self.jobs.items(), key=lambda item: item[0] not in self.studies)
+        )
+        self.planning_seconds = time.perf_counter() - self._start_time
+        logger.info(f"{self.retriever} download plan: {self.summary()}")
+        emit_metrics("plan", retriever=self.retriever, **self.summary())
+        return self
+
+    def get_jobs(self) -> Dict[str, Dict]:
+        """Get copies of the download job kwargs by id, for adding run options"""
+        return {id: dict(job) for id, job in self.jobs.items()}
+
+    def get_completed(self, results: Dict[str, str]) -> Dict[str, DownloadStatus]:
+        """
+        Get the DownloadStatus of every id in the plan after running its jobs.
+
+        Covered files get the status of their study, and the entries in a group
+        get their status from the group result. The plan is not changed, so it
+        can be run again.
+
+        Args:
+            results (Dict): status string by id of the jobs that were run, or
+                for group jobs a Dict of status string by member id
+
+        Returns:
+            Dict of DownloadStatus by id
+        """
+        completed = {
+            id: DownloadStatus(filename=status.filename, status=status.status)
+            for id, status in self.statuses.items()
+        }
+        for id, status in results.items():
+            if id in self.groups:
+                if isinstance(status, str):
+                    status = dict.fromkeys(self.groups[id], status)
+                for member_id, member_status in status.items():
+                    completed[member_id].status = member_status
+            else:
+                completed[id].status = status
+        for file_id, study_id in self.covered.items():
+            completed[file_id].status = completed[study_id].status
+        return completed
+
+    def summary(self) -> Dict:
+        """Get the counts and timing of the plan"""
+        return {
+            "entries": self.entries,
+            "jobs": len(self.jobs),
+            "studies": len(self.studies & set(self.jobs)),
+            "duplicates": sum(self.duplicates.values()),
+            "covered": len(self.covered),
+            "invalid": sum(
+                status.status == "invalid url" for status in self.statuses.values()
+            ),
+            "planning_seconds": self.planning_seconds,
+        }
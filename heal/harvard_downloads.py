@@ -9,19 +9,53 @@ https://guides.dataverse.org/en/latest/api/dataaccess.html#basic-download-by-dat
 
 """
 
+import time
 from pathlib import Path
 from typing import Dict, List
 
-from gen3.tools.download.drs_download import DownloadStatus
-
 from cdislogging import get_logger
-from heal.utils import download_from_url, get_filename, get_id, unpackage_object
+from heal.download_plan import DownloadPlan
+from heal.metrics import PhaseTimer, emit_file_metrics, emit_manifest_metrics
+from heal.utils import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_PER_HOST,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RETRY_POLICY,
+    DEFAULT_UNPACK_WORKERS,
+    DownloadCache,
+    DownloadScheduler,
+    RetryPolicy,
+    download_datafile_batch,
+    download_datafile_batches,
+    fetch_from_url,
+    get_checksums,
+    get_dataverse_checksums,
+    get_dataverse_study_file_urls,
+    get_filename,
+    get_id,
+    get_zip_filename,
+    run_download_jobs,
+    unpack_download,
+)
 
 logger = get_logger("__name__", log_level="debug")
 
 
 def get_harvard_dataverse_files(
-    wts_hostname: str, auth, file_metadata_list: List, download_path: str = "."
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    stream_extract: bool = False,
+    unpack_workers: int = DEFAULT_UNPACK_WORKERS,
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    scheduler: DownloadScheduler = None,
+    verify_checksums: bool = False,
+    plan: DownloadPlan = None,
 ) -> Dict:
     """
     Retrieves external data from the Harvard Dataverse.
@@ -31,6 +65,25 @@ def get_harvard_dataverse_files(
         auth (Gen3Auth): auth for commons with wts (not being used at this moment)
         file_metadata_list (List of Dict): list of studies or files
         download_path (str): path to download files and unpack
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        stream_extract (bool): if True then extract zip files while they download
+            instead of saving the zip file and unpacking it afterwards
+        unpack_workers (int): number of threads for unpacking each zip file
+        cache (DownloadCache): cache for revalidating files that were downloaded
+            before, unmodified files have status "cached"
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        batch_size (int): if > 1 then download files with numeric file_ids from the
+            same Dataverse in zip files of up to batch_size files
+        scheduler (DownloadScheduler): shared scheduler with bandwidth and request
+            rate limits, used instead of max_workers and max_per_host
+        verify_checksums (bool): if True then get the checksum of files without
+            checksums in their metadata from the Dataverse file metadata, and do
+            not batch files. Files are always verified against checksums in their
+            metadata, and mismatched files have status "checksum mismatch"
+        plan (DownloadPlan): plan from plan_harvard_dataverse_files, used instead
+            of file_metadata_list
 
     Returns:
         Dict of download status
@@ -39,7 +92,126 @@ def get_harvard_dataverse_files(
         logger.critical(f"Download path does not exist: {download_path}")
         return None
 
-    completed = {}
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_harvard_dataverse_files(file_metadata_list)
+    jobs = plan.get_jobs()
+    results = {}
+    if batch_size > 1 and not verify_checksums:
+        batch_statuses, jobs = download_datafile_batches(
+            download_harvard_dataverse_batch,
+            jobs,
+            batch_size,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            scheduler=scheduler,
+            download_path=download_path,
+            unpack_workers=unpack_workers,
+            retry_policy=retry_policy,
+        )
+        results.update(batch_statuses)
+    for job in jobs.values():
+        job.update(
+            download_path=download_path,
+            stream_extract=stream_extract,
+            unpack_workers=unpack_workers,
+            cache=cache,
+            retry_policy=retry_policy,
+            verify_checksums=verify_checksums,
+        )
+
+    results.update(
+        run_download_jobs(
+            download_harvard_dataverse_file, jobs, max_workers, max_per_host, scheduler
+        )
+    )
+    completed = plan.get_completed(results)
+    emit_manifest_metrics("Dataverse", completed, start_time)
+
+    if not completed:
+        return None
+    return completed
+
+
+def download_harvard_dataverse_file(
+    api_url: str,
+    id: str,
+    file_metadata: Dict,
+    download_path: str = ".",
+    stream_extract: bool = False,
+    unpack_workers: int = 1,
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = None,
+    verify_checksums: bool = False,
+) -> str:
+    """
+    Download a single Harvard Dataverse study or file and unpack it if it is a zip file.
+
+    Args:
+        api_url (str): Dataverse download url
+        id (str): study_id or file_id
+        file_metadata (Dict): metadata for the study or file
+        download_path (str): path to download files and unpack
+        stream_extract (bool): if True then extract zip files while downloading
+        unpack_workers (int): number of threads for unpacking a zip file
+        cache (DownloadCache): cache for revalidating files that were downloaded before
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+        verify_checksums (bool): if True and there are no checksums in file_metadata
+            then get the checksum from the Dataverse file metadata
+
+    Returns:
+        status string: "downloaded", "cached", "failed" or "checksum mismatch"
+    """
+    filename = get_filename(file_metadata)
+    if filename is not None:
+        logger.info(f"Filename = {filename}")
+
+    timer = PhaseTimer()
+    checksums = get_checksums(file_metadata)
+    if not checksums and verify_checksums:
+        checksums = get_dataverse_checksums(
+            api_url, headers=None, retry_policy=retry_policy
+        )
+        timer.mark("checksum")
+
+    logger.debug(f"Ready to send request to download_url: GET {api_url}")
+    result = fetch_from_url(
+        api_url=api_url,
+        headers=None,
+        download_path=download_path,
+        filename=filename,
+        extract_zip=stream_extract,
+        cache=cache,
+        retry_policy=retry_policy,
+        file_id=id,
+        checksums=checksums,
+        zip_filename=get_zip_filename(api_url, file_metadata),
+    )
+    timer.mark("download")
+    status = unpack_download(id, result, unpack_workers, timer)
+
+    emit_file_metrics("Dataverse", id, status, timer)
+    return status
+
+
+def plan_harvard_dataverse_files(
+    file_metadata_list: List,
+    resolve_studies: bool = False,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> DownloadPlan:
+    """
+    Plan the downloads for a list of Harvard Dataverse studies and files.
+
+    Args:
+        file_metadata_list (List of Dict): list of studies or files
+        resolve_studies (bool): if True then list the files of each study in the
+            Dataverse API and drop requests for files that are in a study
+        retry_policy (RetryPolicy): backoff and retries for listing study files
+
+    Returns:
+        DownloadPlan with job kwargs ('api_url', 'id', 'file_metadata') by id
+    """
+    plan = DownloadPlan("Dataverse")
     logger.debug(f"Input file metadata list={file_metadata_list}")
 
     for file_metadata in file_metadata_list:
@@ -48,49 +220,61 @@ def get_harvard_dataverse_files(
             logger.warning(
                 f"Could not find 'study_id' or 'file_id' in metadata {file_metadata}"
             )
+            plan.add_skipped()
             continue
         logger.info(f"ID = {id}")
-        completed[id] = DownloadStatus(filename=id, status="pending")
-
-        filename = get_filename(file_metadata)
-        if filename is not None:
-            logger.info(f"Filename = {filename}")
 
         download_url = get_download_url_for_harvard_dataverse(file_metadata)
         if download_url is None:
             logger.critical(f"Could not get download_url for {id}")
-            completed[id].status = "invalid url"
+            plan.add(id, id, None)
             continue
 
-        logger.debug(f"Ready to send request to download_url: GET {download_url}")
-        downloaded_file = download_from_url(
-            api_url=download_url,
-            headers=None,
-            download_path=download_path,
-            filename=filename,
+        plan.add(
+            id,
+            id,
+            {"api_url": download_url, "id": id, "file_metadata": file_metadata},
+            study="study_id" in file_metadata,
         )
-        if downloaded_file is None:
-            completed[id].status = "failed"
-            continue
 
-        if downloaded_file.endswith("zip"):
-            # unpack if download is zip file
-            try:
-                logger.debug(f"Ready to unpack {downloaded_file}.")
-                unpackage_object(filepath=downloaded_file)
-            except Exception as e:
-                logger.critical(f"{id} had an issue while being unpackaged: {e}")
-                completed[id].status = "failed"
-
-            completed[id].status = "downloaded"
-            # remove the zip file
-            Path(downloaded_file).unlink()
-        else:
-            completed[id].status = "downloaded"
+    if resolve_studies:
+        plan.drop_covered_files(
+            lambda job: get_dataverse_study_file_urls(
+                job["api_url"], retry_policy=retry_policy
+            )
+        )
+    return plan.finish()
+
 
-    if not completed:
-        return None
-    return completed
+def download_harvard_dataverse_batch(
+    api_url: str,
+    ids: List[str],
+    file_metadata: Dict,
+    download_path: str = ".",
+    unpack_workers: int = 1,
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """
+    Download a batch of Harvard Dataverse files as one zip file and unpack it.
+
+    Args:
+        api_url (str): Dataverse /datafiles url for the batch
+        ids (List[str]): file_ids in the batch
+        file_metadata (Dict): metadata for the first file in the batch
+        download_path (str): path to download files and unpack
+        unpack_workers (int): number of threads for unpacking the zip file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        status string: "downloaded" if every file was downloaded, otherwise "failed"
+    """
+    return download_datafile_batch(
+        api_url,
+        ids,
+        download_path=download_path,
+        unpack_workers=unpack_workers,
+        retry_policy=retry_policy,
+    )
 
 
 def get_download_url_for_harvard_dataverse(file_metadata: Dict) -> str:
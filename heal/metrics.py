@@ -0,0 +1,243 @@
+"""
+Hooks for download timing and byte metrics.
+
+Metrics are emitted as flat dicts, one per event, to every registered hook.
+A hook is any callable taking the record, eg a function, a JSONLinesMetricsHook
+or a PrometheusTextfileHook. Without registered hooks no records are built.
+
+Events:
+    download: one HTTP transfer by fetch_from_url or download_from_url,
+        with bytes, resumes, first_byte_seconds, transfer_seconds and total_seconds
+    unpack: one zip file unpacked by unpackage_object, with members, bytes,
+        workers and total_seconds
+    file: one file or study from a retriever, with the seconds spent in each
+        phase (token_seconds, download_seconds, unpack_seconds, cleanup_seconds)
+        and total_seconds
+    manifest: one call to a get_*_files retriever, with files, failed and total_seconds
+    plan: one DownloadPlan, with entries, jobs, studies, duplicates, covered,
+        invalid and planning_seconds
+
+Usage:
+    hook = add_metrics_hook(JSONLinesMetricsHook("metrics.jsonl"))
+    get_harvard_dataverse_files(None, None, file_metadata_list, download_path="data")
+    remove_metrics_hook(hook)
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+from cdislogging import get_logger
+
+logger = get_logger("__name__", log_level="debug")
+
+MetricsHook = Callable[[Dict], None]
+
+_metrics_hooks: List[MetricsHook] = []
+_metrics_hooks_lock = threading.Lock()
+
+
+def add_metrics_hook(hook: MetricsHook) -> MetricsHook:
+    """
+    Register a hook to receive metrics records.
+
+    Args:
+        hook (Callable): called with each metrics record
+
+    Returns:
+        the hook, for passing to remove_metrics_hook
+    """
+    with _metrics_hooks_lock:
+        _metrics_hooks.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook: MetricsHook):
+    """Unregister a metrics hook"""
+    with _metrics_hooks_lock:
+        if hook in _metrics_hooks:
+            _metrics_hooks.remove(hook)
+
+
+def clear_metrics_hooks():
+    """Unregister all metrics hooks"""
+    with _metrics_hooks_lock:
+        _metrics_hooks.clear()
+
+
+def metrics_enabled() -> bool:
+    """Check if any metrics hooks are registered"""
+    return bool(_metrics_hooks)
+
+
+def emit_metrics(event: str, **fields):
+    """
+    Send a metrics record to the registered hooks.
+    Errors in hooks are logged and do not interrupt downloads.
+
+    Args:
+        event (str): event name, eg "download"
+        fields: values for the record
+    """
+    if not _metrics_hooks:
+        return
+    record = {"event": event, "timestamp": time.time(), **fields}
+    for hook in list(_metrics_hooks):
+        try:
+            hook(record)
+        except Exception as exc:
+            logger.warning(f"Metrics hook {hook} failed: {exc}")
+
+
+class PhaseTimer:
+    """
+    Record the seconds spent in consecutive phases of a file download.
+
+    Usage:
+        timer = PhaseTimer()
+        token = get_token()
+        timer.mark("token")
+        download()
+        timer.mark("download")
+        timer.phases == {"token_seconds": 0.1, "download_seconds": 2.5}
+    """
+
+    def __init__(self):
+        self.start_time = self.last_time = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase: str):
+        """Record the time since the previous mark as the phase"""
+        now = time.perf_counter()
+        key = f"{phase}_seconds"
+        self.phases[key] = self.phases.get(key, 0.0) + now - self.last_time
+        self.last_time = now
+
+    @property
+    def total_seconds(self) -> float:
+        return time.perf_counter() - self.start_time
+
+
+def emit_file_metrics(retriever: str, file_id: str, status: str, timer: PhaseTimer):
+    """
+    Emit the 'file' event for a file or study downloaded by a retriever.
+
+    Args:
+        retriever (str): retriever name, eg "QDR"
+        file_id (str): study_id or file_id
+        status (str): download status
+        timer (PhaseTimer): phases of the download
+    """
+    if not _metrics_hooks:
+        return
+    emit_metrics(
+        "file",
+        retriever=retriever,
+        file_id=file_id,
+        status=status,
+        total_seconds=timer.total_seconds,
+        **timer.phases,
+    )
+
+
+def emit_manifest_metrics(retriever: str, completed: Dict, start_time: float):
+    """
+    Emit the 'manifest' event for a call to a retriever.
+
+    Args:
+        retriever (str): retriever name, eg "QDR"
+        completed (Dict): DownloadStatus by id
+        start_time (float): time.perf_counter() when the retriever started
+    """
+    if not _metrics_hooks:
+        return
+    emit_metrics(
+        "manifest",
+        retriever=retriever,
+        files=len(completed),
+        failed=sum(
+            status.status not in ("downloaded", "cached")
+            for status in completed.values()
+        ),
+        total_seconds=time.perf_counter() - start_time,
+    )
+
+
+class JSONLinesMetricsHook:
+    """
+    Append each metrics record to a file as a line of JSON.
+
+    Args:
+        path (str): path to the JSON-lines file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record: Dict):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.path, "a") as file:
+            file.write(f"{line}\n")
+
+
+class PrometheusTextfileHook:
+    """
+    Keep running totals of metrics records in a Prometheus textfile.
+
+    The file is rewritten after each record, for the node_exporter textfile
+    collector. For each event there is a '<prefix>_<event>_total' counter and
+    a '<prefix>_<event>_<field>_total' counter for each numeric field, labelled
+    with the retriever and status of the record.
+
+    Args:
+        path (str): path to the '.prom' file
+        prefix (str): prefix for metric names
+    """
+
+    LABELS = ("retriever", "status")
+
+    def __init__(self, path: str, prefix: str = "heal"):
+        self.path = path
+        self.prefix = prefix
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record: Dict):
+        labels = tuple(
+            (label, str(record[label])) for label in self.LABELS if label in record
+        )
+        event = record["event"]
+        with self._lock:
+            self._add(f"{self.prefix}_{event}_total", labels, 1)
+            for field, value in record.items():
+                if field == "timestamp" or isinstance(value, bool):
+                    continue
+                if isinstance(value, (int, float)):
+                    self._add(f"{self.prefix}_{event}_{field}_total", labels, value)
+            self._write()
+
+    def _add(self, name: str, labels: tuple, value: float):
+        series = self.totals.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def _write(self):
+        lines = []
+        for name, series in sorted(self.totals.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(series.items()):
+                label_text = ",".join(
+                    f'{label}="{escape_label_value(value)}"' for label, value in labels
+                )
+                lines.append(f"{name}{{{label_text}}} {value}")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+def escape_label_value(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
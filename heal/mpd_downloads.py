@@ -15,56 +15,575 @@ measure ID, saves it locally, and returns DownloadStatus objects for consistency
 other external retrievers like Dryad, QDR, and Harvard Dataverse.
 """
 
+import io
+import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List
+import pandas as pd
 from cdislogging import get_logger
-from gen3.tools.download.drs_download import DownloadStatus
-from heal.utils import download_from_url, get_filename, get_id
+from heal.download_plan import DownloadPlan
+from heal.metrics import PhaseTimer, emit_file_metrics, emit_manifest_metrics
+from heal.utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_MAX_PER_HOST,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RETRY_POLICY,
+    ChunkReader,
+    DownloadCache,
+    DownloadScheduler,
+    RetryPolicy,
+    fetch_from_url,
+    get_filename,
+    get_id,
+    get_response,
+    iter_response_chunks,
+    run_download_jobs,
+)
 
 MPD_API_BASE = "https://phenome.jax.org/api"
 
+# rows in each DataFrame parsed from a streaming MPD CSV
+DEFAULT_MPD_BATCH_ROWS = 100000
+# bytes of CSV in each Arrow record batch parsed from a streaming MPD CSV
+ARROW_BLOCK_SIZE = 4 * 1024 * 1024
+# measure id column in MPD project dataset CSV
+MPD_MEASURE_COLUMN = "measnum"
+# fewest measures of one project that are fetched with a project dataset request
+MIN_COALESCED_MEASURES = 2
+# status of a measure that download_mpd_measures could not split from its project
+NOT_SPLIT = "not split"
+
 logger = get_logger("__name__", log_level="debug")
 
 
 def get_mpd_files(
-    wts_hostname: str, auth, file_metadata_list: List, download_path: str = "."
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    scheduler: DownloadScheduler = None,
+    sink_factory: Callable = None,
+    plan: DownloadPlan = None,
+    output_format: str = "csv",
+    coalesce_measures: bool = False,
 ) -> Dict:
-    """Retrieve data from the Mouse Phenome Database (MPD)."""
+    """
+    Retrieve data from the Mouse Phenome Database (MPD).
+
+    Args:
+        wts_hostname (str): hostname for commons with wts (not used by MPD)
+        auth (Gen3Auth): auth for commons with wts (not used by MPD)
+        file_metadata_list (List of Dict): list of projects or measures
+        download_path (str): path to download files
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        cache (DownloadCache): cache for revalidating files that were downloaded
+            before, unmodified files have status "cached"
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        scheduler (DownloadScheduler): shared scheduler with bandwidth and request
+            rate limits, used instead of max_workers and max_per_host
+        sink_factory (Callable): if set then called with the object id and filename
+            of each file to get a sink that receives the CSV bytes instead of
+            saving them in download_path, see heal.utils.DownloadSink
+        plan (DownloadPlan): plan from plan_mpd_files, used instead of
+            file_metadata_list
+        output_format (str): "csv" to save the CSV files, or "parquet" to parse
+            the CSV as it downloads and save '<object_id>.parquet' files,
+            which needs pyarrow. The cache and sinks are not used for parquet.
+        coalesce_measures (bool): fetch measures with a 'project_symbol' in their
+            metadata with one project dataset request per project, and split the
+            project CSV into '<measure_id>.project.csv' files with the columns of
+            the project dataset, see plan_mpd_files. Measures that cannot be split
+            are downloaded with measure requests. Not used with sink_factory or
+            parquet output.
+
+    Returns:
+        Dict of download status
+    """
     if not Path(download_path).exists():
         logger.critical(f"Download path does not exist: {download_path}")
         return None
+    if output_format not in ("csv", "parquet"):
+        logger.critical(f"Invalid MPD output format: {output_format}")
+        return None
+    if output_format == "parquet":
+        try:
+            import_pyarrow()
+        except ImportError as exc:
+            logger.critical(str(exc))
+            return None
+
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_mpd_files(
+            file_metadata_list,
+            coalesce_measures=coalesce_measures
+            and sink_factory is None
+            and output_format == "csv",
+        )
+    jobs = plan.get_jobs()
+    for id, job in jobs.items():
+        job.update(download_path=download_path, retry_policy=retry_policy, cache=cache)
+        if id not in plan.groups:
+            job.update(sink_factory=sink_factory, output_format=output_format)
+
+    results = run_download_jobs(
+        download_mpd_job, jobs, max_workers, max_per_host, scheduler
+    )
+    split_ids = get_split_measure_ids(plan, results)
+    measure_jobs = get_unsplit_measure_jobs(plan, results)
+    if measure_jobs:
+        logger.info(f"Downloading {len(measure_jobs)} measures that were not split")
+        for job in measure_jobs.values():
+            job.update(
+                download_path=download_path, retry_policy=retry_policy, cache=cache
+            )
+        measure_results = run_download_jobs(
+            download_mpd_job, measure_jobs, max_workers, max_per_host, scheduler
+        )
+        for id in plan.groups:
+            if isinstance(results.get(id), dict):
+                results[id].update(
+                    (measure_id, measure_results[measure_id])
+                    for measure_id in results[id]
+                    if measure_id in measure_results
+                )
+    completed = plan.get_completed(results)
+    for measure_id in split_ids:
+        completed[measure_id].filename = get_split_measure_filename(
+            completed[measure_id].filename
+        )
+    if output_format == "parquet":
+        for status in completed.values():
+            status.filename = str(Path(status.filename).with_suffix(".parquet"))
+    emit_manifest_metrics("MPD", completed, start_time)
+
+    return completed if completed else None
+
+
+def download_mpd_job(**job) -> str:
+    """Run a download job from plan_mpd_files, for a single file or a project group"""
+    if "measures" in job:
+        return download_mpd_measures(**job)
+    return download_mpd_file(**job)
+
+
+def download_mpd_measures(
+    api_url: str,
+    object_id: str,
+    measures: Dict,
+    download_path: str = ".",
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = None,
+) -> Dict[str, str]:
+    """
+    Download an MPD project dataset and split it into CSV files for some of
+    its measures.
+
+    The project CSV is parsed as it downloads, and the rows of each measure
+    are appended to '<filename>.part' files that are renamed to the
+    get_split_measure_filename name when the project is complete. The split
+    files have the columns of the project dataset, which differ from the
+    columns of a measure request, so they do not replace '<filename>'.
+    Measures that are not in the project dataset, or all of the measures if
+    the project cannot be split, get the status NOT_SPLIT, to be downloaded
+    with measure requests by the caller.
 
-    completed = {}
+    Args:
+        api_url (str): MPD project dataset url
+        object_id (str): project symbol
+        measures (Dict): filename by measure id
+        download_path (str): path to save the measure files
+        cache (DownloadCache): not used, the project dataset is not cached
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        Dict of status string by measure id
+    """
+    logger.info(f"Downloading {len(measures)} measures from {object_id} at {api_url}")
+    timer = PhaseTimer()
+    measure_ids = {str(measure_id): measure_id for measure_id in measures}
+    part_paths = {}
+    outputs = {}
+    try:
+        with open_mpd_stream(api_url, retry_policy=retry_policy) as stream:
+            with pd.read_csv(
+                stream,
+                chunksize=DEFAULT_MPD_BATCH_ROWS,
+                dtype=str,
+                keep_default_na=False,
+            ) as reader:
+                for batch in reader:
+                    if MPD_MEASURE_COLUMN not in batch.columns:
+                        raise ValueError(f"no '{MPD_MEASURE_COLUMN}' column")
+                    for measure, rows in batch.groupby(MPD_MEASURE_COLUMN, sort=False):
+                        measure_id = measure_ids.get(measure)
+                        if measure_id is None:
+                            continue
+                        output = outputs.get(measure_id)
+                        if output is None:
+                            part_paths[measure_id] = (
+                                Path(download_path) / f"{measures[measure_id]}.part"
+                            )
+                            output = open(part_paths[measure_id], "w", newline="")
+                            outputs[measure_id] = output
+                        rows.to_csv(output, index=False, header=output.tell() == 0)
+    except (IOError, ValueError) as exc:
+        logger.warning(
+            f"Could not split {object_id} into measures, "
+            f"downloading the measures separately: {exc}"
+        )
+        for output in outputs.values():
+            output.close()
+        for part_path in part_paths.values():
+            os.remove(part_path)
+        part_paths = {}
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    statuses = dict.fromkeys(measures, NOT_SPLIT)
+    for measure_id, part_path in part_paths.items():
+        os.replace(
+            part_path,
+            Path(download_path) / get_split_measure_filename(measures[measure_id]),
+        )
+        statuses[measure_id] = "downloaded"
+    timer.mark("download")
+    logger.info(f"Split {len(part_paths)} measures from {object_id}")
+
+    emit_file_metrics("MPD", object_id, "downloaded" if part_paths else "failed", timer)
+    return statuses
+
+
+def get_split_measure_filename(filename: str) -> str:
+    """
+    Get the filename of a measure split from its project dataset, eg
+    '47115.project.csv' for '47115.csv'.
+    """
+    path = Path(filename)
+    return str(path.with_name(f"{path.stem}.project{path.suffix}"))
+
+
+def get_split_measure_ids(plan: DownloadPlan, results: Dict) -> List:
+    """Get the ids of the measures split from their project by the group jobs"""
+    return [
+        measure_id
+        for id in plan.groups
+        if isinstance(results.get(id), dict)
+        for measure_id, status in results[id].items()
+        if status == "downloaded"
+    ]
+
+
+def get_unsplit_measure_jobs(plan: DownloadPlan, results: Dict) -> Dict:
+    """
+    Get measure request jobs for the measures that the group jobs of a plan
+    could not split from their project.
+
+    Args:
+        plan (DownloadPlan): plan from plan_mpd_files
+        results (Dict): results of the plan jobs
+
+    Returns:
+        Dict of job kwargs ('api_url', 'object_id', 'filename') by measure id
+    """
+    jobs = {}
+    for id in plan.groups:
+        if not isinstance(results.get(id), dict):
+            continue
+        for measure_id, status in results[id].items():
+            if status == NOT_SPLIT:
+                jobs[measure_id] = {
+                    "api_url": get_download_url_for_mpd({"measure_id": measure_id}),
+                    "object_id": measure_id,
+                    "filename": plan.statuses[measure_id].filename,
+                }
+    return jobs
+
+
+def download_mpd_file(
+    api_url: str,
+    object_id: str,
+    filename: str,
+    download_path: str = ".",
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = None,
+    sink_factory: Callable = None,
+    output_format: str = "csv",
+) -> str:
+    """Download a single MPD project or measure CSV, returning the status string."""
+    logger.info(f"Downloading {object_id} from {api_url}")
+    timer = PhaseTimer()
+    if output_format == "parquet":
+        parquet_path = Path(download_path) / Path(filename).with_suffix(".parquet")
+        saved = save_mpd_parquet(api_url, parquet_path, retry_policy=retry_policy)
+        timer.mark("download")
+        status = "downloaded" if saved else "failed"
+        emit_file_metrics("MPD", object_id, status, timer)
+        return status
+
+    sink = sink_factory(object_id, filename) if sink_factory is not None else None
+    result = fetch_from_url(
+        api_url=api_url,
+        headers=None,
+        download_path=download_path,
+        filename=filename,
+        cache=cache,
+        retry_policy=retry_policy,
+        file_id=object_id,
+        sink=sink,
+    )
+
+    timer.mark("download")
+    if not result.path:
+        status = "failed"
+    else:
+        status = result.status
+        logger.info(f"Downloaded MPD data -> {result.path}")
+
+    emit_file_metrics("MPD", object_id, status, timer)
+    return status
+
+
+def import_pyarrow():
+    """
+    Import pyarrow, which is an optional dependency for Arrow batches and
+    parquet output.
+
+    Raises:
+        ImportError: if pyarrow is not installed
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ImportError(
+            "pyarrow is needed for Arrow and parquet output, install it with "
+            "'pip install pyarrow'"
+        ) from exc
+    return pyarrow
+
+
+@contextmanager
+def open_mpd_stream(api_url: str, retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY):
+    """
+    Open the streaming response for an MPD CSV as a file-like object.
+
+    Args:
+        api_url (str): MPD download url
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Raises:
+        IOError: if the request fails
+    """
+    response = get_response(api_url, retry_policy=retry_policy)
+    if response is None:
+        raise IOError(f"Could not download MPD data from {api_url}")
+    try:
+        yield io.BufferedReader(
+            ChunkReader(iter_response_chunks(response, DEFAULT_CHUNK_SIZE))
+        )
+    finally:
+        response.close()
+
+
+def iter_mpd_batches(
+    file_metadata: Dict,
+    engine: str = "pandas",
+    batch_rows: int = DEFAULT_MPD_BATCH_ROWS,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> Iterator:
+    """
+    Download an MPD project or measure and parse the CSV as it arrives.
+
+    Only the current batch of rows and response chunk are held in memory,
+    so large measure dumps are never held both as CSV and as parsed data.
+    Nothing is written to disk.
+
+    Args:
+        file_metadata (Dict): MPD project or measure metadata
+        engine (str): "pandas" for DataFrame batches of batch_rows rows, or
+            "arrow" for pyarrow RecordBatches of about ARROW_BLOCK_SIZE bytes
+            of CSV, which needs pyarrow
+        batch_rows (int): number of rows in each DataFrame
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Yields:
+        pandas DataFrame or pyarrow RecordBatch
+
+    Raises:
+        ValueError: for invalid metadata, engine or CSV content
+        ImportError: if engine is "arrow" and pyarrow is not installed
+        IOError: if the download fails
+    """
+    if engine not in ("pandas", "arrow"):
+        raise ValueError(f"Invalid engine '{engine}', use 'pandas' or 'arrow'")
+    pyarrow = import_pyarrow() if engine == "arrow" else None
+    api_url = get_download_url_for_mpd(file_metadata)
+    if api_url is None:
+        raise ValueError(f"Invalid MPD metadata: {file_metadata}")
+
+    with open_mpd_stream(api_url, retry_policy=retry_policy) as stream:
+        if pyarrow is not None:
+            read_options = pyarrow.csv.ReadOptions(block_size=ARROW_BLOCK_SIZE)
+            yield from pyarrow.csv.open_csv(stream, read_options=read_options)
+        else:
+            with pd.read_csv(stream, chunksize=batch_rows) as reader:
+                yield from reader
+
+
+def read_mpd_data(
+    file_metadata: Dict,
+    engine: str = "pandas",
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+):
+    """
+    Download an MPD project or measure and parse the CSV as it arrives
+    into a single table, without saving or buffering the CSV.
+
+    Args:
+        file_metadata (Dict): MPD project or measure metadata
+        engine (str): "pandas" for a DataFrame or "arrow" for a pyarrow Table
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        pandas DataFrame or pyarrow Table, None if there are errors
+    """
+    try:
+        if engine == "arrow":
+            pyarrow = import_pyarrow()
+            api_url = get_download_url_for_mpd(file_metadata)
+            if api_url is None:
+                raise ValueError(f"Invalid MPD metadata: {file_metadata}")
+            with open_mpd_stream(api_url, retry_policy=retry_policy) as stream:
+                return pyarrow.csv.read_csv(stream)
+        return pd.concat(
+            iter_mpd_batches(file_metadata, engine=engine, retry_policy=retry_policy),
+            ignore_index=True,
+        )
+    except (IOError, ValueError, ImportError) as exc:
+        logger.critical(f"Could not read MPD data for {file_metadata}: {exc}")
+        return None
+
+
+def save_mpd_parquet(
+    api_url: str, parquet_path: str, retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY
+) -> bool:
+    """
+    Download an MPD CSV and write it to a parquet file one record batch at a time.
+
+    The file is written to '<parquet_path>.part' and renamed when it is complete.
+
+    Args:
+        api_url (str): MPD download url
+        parquet_path (str): path for the parquet file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        True if the parquet file was saved
+    """
+    pyarrow = import_pyarrow()
+    part_path = f"{parquet_path}.part"
+    try:
+        with open_mpd_stream(api_url, retry_policy=retry_policy) as stream:
+            read_options = pyarrow.csv.ReadOptions(block_size=ARROW_BLOCK_SIZE)
+            reader = pyarrow.csv.open_csv(stream, read_options=read_options)
+            with pyarrow.parquet.ParquetWriter(part_path, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+    except (IOError, ValueError, pyarrow.ArrowException) as exc:
+        logger.critical(f"Could not save MPD data from {api_url} as parquet: {exc}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+
+    os.replace(part_path, parquet_path)
+    logger.info(f"Saved MPD data -> {parquet_path}")
+    return True
+
+
+def plan_mpd_files(
+    file_metadata_list: List, coalesce_measures: bool = False
+) -> DownloadPlan:
+    """
+    Plan the downloads for a list of MPD projects or measures.
+
+    With coalesce_measures, measures with both 'measure_id' and 'project_symbol'
+    in their metadata are grouped by project. Projects with at least
+    MIN_COALESCED_MEASURES measures get one group job, with a 'measures' Dict
+    of filename by measure id, that downloads the project dataset and splits it
+    into measure files, see download_mpd_measures. Other measures are downloaded
+    with a measure request.
+
+    Args:
+        file_metadata_list (List of Dict): list of MPD projects or measures
+        coalesce_measures (bool): group the measures of a project
+
+    Returns:
+        DownloadPlan with job kwargs ('api_url', 'object_id', 'filename') by id
+    """
+    plan = DownloadPlan("MPD")
+    project_measures = {}
     for file_metadata in file_metadata_list:
+        if (
+            coalesce_measures
+            and isinstance(file_metadata, dict)
+            and "measure_id" in file_metadata
+            and "project_symbol" in file_metadata
+            and get_id(file_metadata) is None
+        ):
+            measure_id = file_metadata["measure_id"]
+            project_measures.setdefault(file_metadata["project_symbol"], []).append(
+                measure_id
+            )
+            file_metadata = {
+                key: value
+                for key, value in file_metadata.items()
+                if key != "project_symbol"
+            }
+
         object_id = get_id(file_metadata) or file_metadata.get("project_symbol") or file_metadata.get("measure_id")
         if not object_id:
             logger.warning(f"Invalid MPD metadata: {file_metadata}")
+            plan.add_skipped()
             continue
 
         filename = get_filename(file_metadata) or f"{object_id}.csv"
-        completed[object_id] = DownloadStatus(filename=filename, status="pending")
-
         download_url = get_download_url_for_mpd(file_metadata)
         if not download_url:
-            completed[object_id].status = "invalid url"
+            plan.add(object_id, filename, None)
             continue
 
-        logger.info(f"Downloading {object_id} from {download_url}")
-        downloaded_file = download_from_url(
-            api_url=download_url,
-            headers=None,
-            download_path=download_path,
-            filename=filename,
+        plan.add(
+            object_id,
+            filename,
+            {"api_url": download_url, "object_id": object_id, "filename": filename},
         )
 
-        if not downloaded_file:
-            completed[object_id].status = "failed"
+    for project_symbol, measure_ids in project_measures.items():
+        measure_ids = [id for id in dict.fromkeys(measure_ids) if id in plan.jobs]
+        if len(measure_ids) < MIN_COALESCED_MEASURES:
             continue
+        plan.group_jobs(
+            f"{project_symbol}/measures",
+            measure_ids,
+            {
+                "api_url": get_download_url_for_mpd({"project_symbol": project_symbol}),
+                "object_id": project_symbol,
+                "measures": {id: plan.statuses[id].filename for id in measure_ids},
+            },
+        )
 
-        completed[object_id].status = "downloaded"
-        logger.info(f"Downloaded MPD data -> {downloaded_file}")
-
-    return completed if completed else None
+    return plan.finish()
 
 
 def get_download_url_for_mpd(file_metadata: Dict) -> str:
@@ -0,0 +1,337 @@
+"""
+Progress reporting for long-running downloads.
+
+fetch_from_url and async_fetch_from_url report the progress of each transfer as
+FileProgress records, to the progress callback of the call and to every
+registered progress hook. Updates are throttled to one every PROGRESS_INTERVAL
+seconds per transfer, plus a final update when the transfer ends, so reporting
+costs one clock read per chunk in the write loop. Without a callback or
+registered hooks no progress is tracked.
+
+A ManifestProgress adds up the transfers of the retrievers, and counts the files
+in their download plans, and TqdmProgressRenderer draws it as a progress bar.
+
+Usage:
+    with TqdmProgressRenderer():
+        get_syracuse_qdr_files(wts_hostname, auth, file_metadata_list)
+
+    download_from_url(api_url, progress=lambda progress: print(progress.bytes))
+"""
+
+import dataclasses
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from cdislogging import get_logger
+
+from heal.metrics import add_metrics_hook, remove_metrics_hook
+
+logger = get_logger("__name__", log_level="debug")
+
+# minimum seconds between progress updates for a transfer or a manifest
+PROGRESS_INTERVAL = 0.5
+
+
+@dataclass
+class FileProgress:
+    """
+    Progress of one transfer by fetch_from_url.
+
+    Attributes:
+        api_url (str): url of the download
+        file_id (str): study_id or file_id, if known
+        filename (str): name of the downloaded file, once the response arrives
+        bytes (int): bytes received, including bytes of a resumed '.part' file
+        total (int): expected bytes from the response headers, None if unknown
+        rate (float): bytes per second since the previous update
+        elapsed_seconds (float): seconds since the transfer started
+        done (bool): True for the final update
+        status (str): download status in the final update
+    """
+
+    api_url: str
+    file_id: Optional[str] = None
+    filename: Optional[str] = None
+    bytes: int = 0
+    total: Optional[int] = None
+    rate: float = 0.0
+    elapsed_seconds: float = 0.0
+    done: bool = False
+    status: Optional[str] = None
+
+
+ProgressHook = Callable[[FileProgress], None]
+
+_progress_hooks: List[ProgressHook] = []
+_progress_hooks_lock = threading.Lock()
+
+
+def add_progress_hook(hook: ProgressHook) -> ProgressHook:
+    """
+    Register a hook to receive the progress of every transfer.
+
+    Args:
+        hook (Callable): called with a FileProgress for each update
+
+    Returns:
+        the hook, for passing to remove_progress_hook
+    """
+    with _progress_hooks_lock:
+        _progress_hooks.append(hook)
+    return hook
+
+
+def remove_progress_hook(hook: ProgressHook):
+    """Unregister a progress hook"""
+    with _progress_hooks_lock:
+        if hook in _progress_hooks:
+            _progress_hooks.remove(hook)
+
+
+def clear_progress_hooks():
+    """Unregister all progress hooks"""
+    with _progress_hooks_lock:
+        _progress_hooks.clear()
+
+
+def progress_enabled() -> bool:
+    """Check if any progress hooks are registered"""
+    return bool(_progress_hooks)
+
+
+def emit_progress(progress: FileProgress, callback: ProgressHook = None):
+    """
+    Send a progress update to a callback and the registered hooks.
+    Errors in hooks are logged and do not interrupt downloads.
+
+    Args:
+        progress (FileProgress): progress of a transfer
+        callback (Callable): progress callback of the download call
+    """
+    hooks = list(_progress_hooks)
+    if callback is not None:
+        hooks.insert(0, callback)
+    for hook in hooks:
+        try:
+            # each hook gets its own copy, so updates can be kept
+            hook(dataclasses.replace(progress))
+        except Exception as exc:
+            logger.warning(f"Progress hook {hook} failed: {exc}")
+
+
+class ProgressReporter:
+    """
+    Track the bytes of one transfer and send throttled FileProgress updates.
+
+    Args:
+        api_url (str): url of the download
+        file_id (str): study_id or file_id
+        callback (Callable): progress callback of the download call
+        interval (float): minimum seconds between updates
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        file_id: str = None,
+        callback: ProgressHook = None,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        self.progress = FileProgress(api_url=api_url, file_id=file_id)
+        self._callback = callback
+        self._interval = interval
+        self._start_time = self._last_time = time.perf_counter()
+        self._last_bytes = 0
+
+    def start(self, filename: str, received: int, total: Optional[int]):
+        """
+        Start or restart reading a response.
+
+        Args:
+            filename (str): name of the downloaded file
+            received (int): bytes already received, eg the size of a resumed file
+            total (int): expected bytes of the whole file, None if unknown
+        """
+        self.progress.filename = filename
+        self.progress.bytes = self._last_bytes = received
+        self.progress.total = total
+        self._report(time.perf_counter())
+
+    def update(self, size: int):
+        """Count received bytes and send an update if the interval has passed"""
+        self.progress.bytes += size
+        now = time.perf_counter()
+        if now - self._last_time >= self._interval:
+            self._report(now)
+
+    def iter_chunks(self, chunks):
+        """Yield chunks, counting their bytes"""
+        for data in chunks:
+            yield data
+            self.update(len(data))
+
+    def finish(self, status: str):
+        """Send the final update with the download status"""
+        self.progress.done = True
+        self.progress.status = status
+        self._report(time.perf_counter())
+
+    def _report(self, now: float):
+        seconds = now - self._last_time
+        if seconds > 0:
+            self.progress.rate = (self.progress.bytes - self._last_bytes) / seconds
+        self.progress.elapsed_seconds = now - self._start_time
+        self._last_time = now
+        self._last_bytes = self.progress.bytes
+        emit_progress(self.progress, self._callback)
+
+
+class ManifestProgress:
+    """
+    Aggregate progress of the downloads of one or more retriever calls.
+
+    While attached, transfers are added up from the progress hooks, and files
+    are counted from the 'plan', 'file' and 'manifest' metrics events: the jobs
+    of each plan are added to files_total, and each 'file' event adds to
+    files_done. Files downloaded in /datafiles batches are counted when their
+    manifest is complete.
+
+    Args:
+        callback (Callable): called with the ManifestProgress after each update,
+            at most once every interval seconds except when transfers end
+        interval (float): minimum seconds between callbacks
+
+    Attributes:
+        transfers (Dict): latest FileProgress by (api_url, file_id)
+        bytes (int): bytes received by all transfers
+        total (int): expected bytes of the transfers with a known total
+        rate (float): bytes per second since the previous callback
+        files_done (int): files and studies downloaded or failed
+        files_total (int): files and studies in the download plans
+        active (int): transfers in progress
+    """
+
+    def __init__(self, callback: Callable = None, interval: float = PROGRESS_INTERVAL):
+        self.transfers = {}
+        self.bytes = 0
+        self.total = 0
+        self.rate = 0.0
+        self.files_done = 0
+        self.files_total = 0
+        self.active = 0
+        self._callback = callback
+        self._interval = interval
+        self._planned = {}
+        self._done = {}
+        self._last_time = time.perf_counter()
+        self._last_bytes = 0
+        self._lock = threading.Lock()
+
+    def attach(self) -> "ManifestProgress":
+        """Register as a progress hook and a metrics hook"""
+        add_progress_hook(self.on_progress)
+        add_metrics_hook(self.on_metrics)
+        return self
+
+    def detach(self):
+        """Unregister the hooks"""
+        remove_progress_hook(self.on_progress)
+        remove_metrics_hook(self.on_metrics)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc_info):
+        self.detach()
+        self.close()
+
+    def on_progress(self, progress: FileProgress):
+        """Progress hook for the transfers"""
+        key = (progress.api_url, progress.file_id)
+        with self._lock:
+            previous = self.transfers.get(key)
+            if previous is None:
+                previous = FileProgress(api_url=progress.api_url, done=True)
+            self.transfers[key] = progress
+            self.bytes += progress.bytes - previous.bytes
+            self.total += (progress.total or 0) - (previous.total or 0)
+            self.active += previous.done - progress.done
+            self._update(force=progress.done)
+
+    def on_metrics(self, record: Dict):
+        """Metrics hook for the file counts"""
+        retriever = record.get("retriever")
+        with self._lock:
+            if record["event"] == "plan":
+                self._planned[retriever] = (
+                    self._planned.get(retriever, 0) + record["jobs"]
+                )
+            elif record["event"] == "file":
+                self._done[retriever] = self._done.get(retriever, 0) + 1
+            elif record["event"] == "manifest":
+                self._done[retriever] = max(
+                    self._done.get(retriever, 0), self._planned.get(retriever, 0)
+                )
+            else:
+                return
+            self.files_total = sum(self._planned.values())
+            self.files_done = sum(self._done.values())
+            self._update(force=True)
+
+    def close(self):
+        """Called when the progress is detached by the context manager"""
+
+    def render(self):
+        """Called after each update, for subclasses that draw the progress"""
+
+    def _update(self, force: bool):
+        now = time.perf_counter()
+        seconds = now - self._last_time
+        if seconds < self._interval and not force:
+            return
+        if seconds > 0:
+            self.rate = (self.bytes - self._last_bytes) / seconds
+        self._last_time = now
+        self._last_bytes = self.bytes
+        self.render()
+        if self._callback is not None:
+            self._callback(self)
+
+
+class TqdmProgressRenderer(ManifestProgress):
+    """
+    Draw the progress of a manifest as a tqdm progress bar of bytes, with the
+    files done and active transfers.
+
+    Args:
+        interval (float): minimum seconds between redraws
+        tqdm_kwargs: passed to tqdm, eg file=sys.stdout
+    """
+
+    def __init__(self, interval: float = PROGRESS_INTERVAL, **tqdm_kwargs):
+        super().__init__(interval=interval)
+        from tqdm import tqdm
+
+        self.bar = tqdm(
+            total=None,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            desc="Downloading",
+            **tqdm_kwargs,
+        )
+
+    def render(self):
+        self.bar.total = self.total or None
+        self.bar.n = self.bytes
+        self.bar.set_postfix(
+            files=f"{self.files_done}/{self.files_total}",
+            active=self.active,
+            refresh=False,
+        )
+        self.bar.refresh()
+
+    def close(self):
+        self.bar.close()
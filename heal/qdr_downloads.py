@@ -19,25 +19,56 @@ The WTS-SERVER is a Gen3 commons that has been configured to return
 tokens for the 'idp' specified in the external_file_metadata.
 """
 
+import time
 from pathlib import Path
 from typing import Dict, List
 
-from gen3.tools.download.drs_download import DownloadStatus, wts_get_token
+from gen3.tools.download.drs_download import wts_get_token
 
 from cdislogging import get_logger
+from heal.download_plan import DownloadPlan
+from heal.metrics import PhaseTimer, emit_file_metrics, emit_manifest_metrics
 from heal.utils import (
-    download_from_url,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_PER_HOST,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RETRY_POLICY,
+    DEFAULT_UNPACK_WORKERS,
+    DownloadCache,
+    DownloadScheduler,
+    RetryPolicy,
+    download_datafile_batch,
+    download_datafile_batches,
+    fetch_from_url,
+    get_checksums,
+    get_dataverse_checksums,
+    get_dataverse_study_file_urls,
     get_filename,
     get_id,
     get_idp_access_token,
-    unpackage_object,
+    get_zip_filename,
+    run_download_jobs,
+    unpack_download,
 )
 
 logger = get_logger("__name__", log_level="debug")
 
 
 def get_syracuse_qdr_files(
-    wts_hostname: str, auth, file_metadata_list: List, download_path: str = "."
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    download_path: str = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    stream_extract: bool = False,
+    unpack_workers: int = DEFAULT_UNPACK_WORKERS,
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    scheduler: DownloadScheduler = None,
+    verify_checksums: bool = False,
+    plan: DownloadPlan = None,
 ) -> Dict:
     """
     Retrieves external data from the Syracuse QDR.
@@ -47,6 +78,25 @@ def get_syracuse_qdr_files(
         auth (Gen3Auth): auth for commons with wts
         file_metadata_list (List of Dict): list of studies or files
         download_path (str): path to download files and unpack
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        stream_extract (bool): if True then extract zip files while they download
+            instead of saving the zip file and unpacking it afterwards
+        unpack_workers (int): number of threads for unpacking each zip file
+        cache (DownloadCache): cache for revalidating files that were downloaded
+            before, unmodified files have status "cached"
+        retry_policy (RetryPolicy): backoff and retries for throttled or failed
+            requests, None to disable retries
+        batch_size (int): if > 1 then download files with numeric file_ids from the
+            same Dataverse in zip files of up to batch_size files
+        scheduler (DownloadScheduler): shared scheduler with bandwidth and request
+            rate limits, used instead of max_workers and max_per_host
+        verify_checksums (bool): if True then get the checksum of files without
+            checksums in their metadata from the Dataverse file metadata, and do
+            not batch files. Files are always verified against checksums in their
+            metadata, and mismatched files have status "checksum mismatch"
+        plan (DownloadPlan): plan from plan_syracuse_qdr_files, used instead
+            of file_metadata_list
 
     Returns:
         Dict of download status
@@ -55,7 +105,182 @@ def get_syracuse_qdr_files(
         logger.critical(f"Download path does not exist: {download_path}")
         return None
 
-    completed = {}
+    start_time = time.perf_counter()
+    if plan is None:
+        plan = plan_syracuse_qdr_files(wts_hostname, auth, file_metadata_list)
+    jobs = plan.get_jobs()
+    results = {}
+    if batch_size > 1 and not verify_checksums:
+        batch_statuses, jobs = download_datafile_batches(
+            download_qdr_batch,
+            jobs,
+            batch_size,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            scheduler=scheduler,
+            wts_hostname=wts_hostname,
+            auth=auth,
+            download_path=download_path,
+            unpack_workers=unpack_workers,
+            retry_policy=retry_policy,
+        )
+        results.update(batch_statuses)
+    for job in jobs.values():
+        job.update(
+            wts_hostname=wts_hostname,
+            auth=auth,
+            download_path=download_path,
+            stream_extract=stream_extract,
+            unpack_workers=unpack_workers,
+            cache=cache,
+            retry_policy=retry_policy,
+            verify_checksums=verify_checksums,
+        )
+
+    results.update(
+        run_download_jobs(download_qdr_file, jobs, max_workers, max_per_host, scheduler)
+    )
+    completed = plan.get_completed(results)
+    emit_manifest_metrics("QDR", completed, start_time)
+
+    if not completed:
+        return None
+    return completed
+
+
+def download_qdr_file(
+    api_url: str,
+    id: str,
+    wts_hostname: str,
+    auth,
+    file_metadata: Dict,
+    download_path: str = ".",
+    stream_extract: bool = False,
+    unpack_workers: int = 1,
+    cache: DownloadCache = None,
+    retry_policy: RetryPolicy = None,
+    verify_checksums: bool = False,
+) -> str:
+    """
+    Download a single QDR study or file and unpack it if it is a zip file.
+
+    Args:
+        api_url (str): QDR download url
+        id (str): study_id or file_id
+        wts_hostname (str): hostname for commons with wts
+        auth (Gen3Auth): auth for commons with wts
+        file_metadata (Dict): metadata for the study or file
+        download_path (str): path to download files and unpack
+        stream_extract (bool): if True then extract zip files while downloading
+        unpack_workers (int): number of threads for unpacking a zip file
+        cache (DownloadCache): cache for revalidating files that were downloaded before
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+        verify_checksums (bool): if True and there are no checksums in file_metadata
+            then get the checksum from the Dataverse file metadata
+
+    Returns:
+        status string: "downloaded", "cached", "failed" or "checksum mismatch"
+    """
+    filename = get_filename(file_metadata)
+    if filename is not None:
+        logger.info(f"Filename = {filename}")
+
+    timer = PhaseTimer()
+    idp_access_token = get_idp_access_token(wts_hostname, auth, file_metadata)
+    timer.mark("token")
+    request_headers = get_request_headers(idp_access_token)
+    if "Authorization" not in request_headers:
+        logger.critical("WARNING Request headers do not include a bearer token.")
+
+    logger.debug(f"Request headers = {request_headers}")
+
+    checksums = get_checksums(file_metadata)
+    if not checksums and verify_checksums:
+        checksums = get_dataverse_checksums(
+            api_url, headers=request_headers, retry_policy=retry_policy
+        )
+        timer.mark("checksum")
+
+    logger.debug(f"Ready to send request to download_url: GET {api_url}")
+    result = fetch_from_url(
+        api_url=api_url,
+        headers=request_headers,
+        download_path=download_path,
+        filename=filename,
+        extract_zip=stream_extract,
+        cache=cache,
+        retry_policy=retry_policy,
+        file_id=id,
+        checksums=checksums,
+        zip_filename=get_zip_filename(api_url, file_metadata),
+    )
+    timer.mark("download")
+    status = unpack_download(id, result, unpack_workers, timer)
+
+    emit_file_metrics("QDR", id, status, timer)
+    return status
+
+
+def download_qdr_batch(
+    api_url: str,
+    ids: List[str],
+    wts_hostname: str,
+    auth,
+    file_metadata: Dict,
+    download_path: str = ".",
+    unpack_workers: int = 1,
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """
+    Download a batch of QDR files as one zip file and unpack it.
+
+    Args:
+        api_url (str): QDR /datafiles url for the batch
+        ids (List[str]): file_ids in the batch
+        wts_hostname (str): hostname for commons with wts
+        auth (Gen3Auth): auth for commons with wts
+        file_metadata (Dict): metadata for the first file in the batch,
+            all files in the batch have the same 'external_oidc_idp'
+        download_path (str): path to download files and unpack
+        unpack_workers (int): number of threads for unpacking the zip file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        status string: "downloaded" if every file was downloaded, otherwise "failed"
+    """
+    idp_access_token = get_idp_access_token(wts_hostname, auth, file_metadata)
+    return download_datafile_batch(
+        api_url,
+        ids,
+        headers=get_request_headers(idp_access_token),
+        download_path=download_path,
+        unpack_workers=unpack_workers,
+        retry_policy=retry_policy,
+    )
+
+
+def plan_syracuse_qdr_files(
+    wts_hostname: str,
+    auth,
+    file_metadata_list: List,
+    resolve_studies: bool = False,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> DownloadPlan:
+    """
+    Plan the downloads for a list of QDR studies and files.
+
+    Args:
+        wts_hostname (str): hostname for commons with wts, for listing study files
+        auth (Gen3Auth): auth for commons with wts, for listing study files
+        file_metadata_list (List of Dict): list of studies or files
+        resolve_studies (bool): if True then list the files of each study in the
+            QDR API and drop requests for files that are in a study
+        retry_policy (RetryPolicy): backoff and retries for listing study files
+
+    Returns:
+        DownloadPlan with job kwargs ('api_url', 'id', 'file_metadata') by id
+    """
+    plan = DownloadPlan("QDR")
     logger.debug(f"Input file metadata list={file_metadata_list}")
 
     for file_metadata in file_metadata_list:
@@ -64,56 +289,34 @@ def get_syracuse_qdr_files(
             logger.warning(
                 f"Could not find 'study_id' or 'file_id' in metadata {file_metadata}"
             )
+            plan.add_skipped()
             continue
         logger.info(f"ID = {id}")
-        completed[id] = DownloadStatus(filename=id, status="pending")
-
-        filename = get_filename(file_metadata)
-        if filename is not None:
-            logger.info(f"Filename = {filename}")
 
         download_url = get_download_url_for_qdr(file_metadata)
         if download_url is None:
             logger.critical(f"Could not get download_url for {id}")
-            completed[id].status = "invalid url"
+            plan.add(id, id, None)
             continue
 
-        idp_access_token = get_idp_access_token(wts_hostname, auth, file_metadata)
-        request_headers = get_request_headers(idp_access_token)
-        if "Authorization" not in request_headers:
-            logger.critical("WARNING Request headers do not include a bearer token.")
-
-        logger.debug(f"Request headers = {request_headers}")
-
-        logger.debug(f"Ready to send request to download_url: GET {download_url}")
-        downloaded_file = download_from_url(
-            api_url=download_url,
-            headers=request_headers,
-            download_path=download_path,
-            filename=filename,
+        plan.add(
+            id,
+            id,
+            {"api_url": download_url, "id": id, "file_metadata": file_metadata},
+            study="study_id" in file_metadata,
         )
-        if downloaded_file is None:
-            completed[id].status = "failed"
-            continue
 
-        if downloaded_file.endswith("zip"):
-            # unpack if download is zip file
-            try:
-                logger.debug(f"Ready to unpack {downloaded_file}.")
-                unpackage_object(filepath=downloaded_file)
-            except Exception as e:
-                logger.critical(f"{id} had an issue while being unpackaged: {e}")
-                completed[id].status = "failed"
-
-            completed[id].status = "downloaded"
-            # remove the zip file
-            Path(downloaded_file).unlink()
-        else:
-            completed[id].status = "downloaded"
-
-    if not completed:
-        return None
-    return completed
+    if resolve_studies:
+        plan.drop_covered_files(
+            lambda job: get_dataverse_study_file_urls(
+                job["api_url"],
+                headers=get_request_headers(
+                    get_idp_access_token(wts_hostname, auth, job["file_metadata"])
+                ),
+                retry_policy=retry_policy,
+            )
+        )
+    return plan.finish()
 
 
 def get_download_url_for_qdr(file_metadata: Dict) -> str:
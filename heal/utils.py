@@ -1,16 +1,683 @@
+import base64
+import bisect
+import hashlib
+import io
+import itertools
+import json
 import os
+import random
+import shutil
+import struct
+import threading
+import time
 import zipfile
-from typing import Dict
-from urllib.parse import unquote
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where cached files are always copied
+    fcntl = None
 
 import requests
 from gen3.auth import Gen3Auth
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from gen3.tools.download.drs_download import wts_get_token
 
 from cdislogging import get_logger
 
+from heal.metrics import PhaseTimer, emit_metrics, metrics_enabled
+from heal.progress import ProgressReporter, progress_enabled
+
 logger = get_logger("__name__", log_level="debug")
 
+# default limits for concurrent downloads
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_PER_HOST = 4
+
+# chunk sizes for streaming downloads to disk
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MIN_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# adaptive chunk sizes aim to receive one chunk in about this many seconds
+ADAPTIVE_CHUNK_SECONDS = 0.05
+
+# default number of threads for unpacking zip files, and the number of
+# uncompressed bytes extracted by a thread at a time
+DEFAULT_UNPACK_WORKERS = min(4, os.cpu_count() or 1)
+EXTRACTION_BATCH_SIZE = 4 * 1024 * 1024
+
+# default number of times to resume an interrupted download
+DEFAULT_MAX_RESUME_ATTEMPTS = 3
+
+# default maximum size of a DownloadCache in bytes
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+# Linux ioctl to clone a file on a copy-on-write filesystem
+FICLONE = 0x40049409
+
+# default number of pooled connections kept alive per host
+DEFAULT_POOL_SIZE = 10
+
+# seconds before expiry to refresh a cached idp token
+TOKEN_REFRESH_MARGIN = 60
+# seconds to keep an idp token that has no JWT expiry
+DEFAULT_TOKEN_TTL = 300
+
+# default number of Dataverse files per /datafiles request, 1 disables batching
+DEFAULT_BATCH_SIZE = 1
+# manifest added by Dataverse to /datafiles zip files
+DATAVERSE_MANIFEST = "MANIFEST.TXT"
+
+# (connect, read) seconds before a request times out, the read timeout applies
+# to each read of a streaming response body, as in the asyncio session timeout
+DEFAULT_REQUEST_TIMEOUT = (60, 300)
+
+_session_pool = {}
+_session_pool_size = DEFAULT_POOL_SIZE
+_session_pool_lock = threading.Lock()
+
+_connection_stats = {}
+_connection_stats_lock = threading.Lock()
+
+# (wts_hostname, idp, auth identity) -> (idp access token, expiry time)
+_token_cache = {}
+_token_locks = {}
+_token_cache_lock = threading.Lock()
+
+# limiters for the download running in this thread, set by DownloadScheduler
+_scheduler_state = threading.local()
+
+
+def _count_connection_event(pool: HTTPConnectionPool, event: str):
+    """Increment a connection counter for the host of a urllib3 connection pool"""
+    default_ports = {"http": 80, "https": 443}
+    host = f"{pool.scheme}://{pool.host}"
+    if pool.port is not None and pool.port != default_ports.get(pool.scheme):
+        host = f"{host}:{pool.port}"
+    with _connection_stats_lock:
+        host_stats = _connection_stats.setdefault(
+            host, {"requests": 0, "new_connections": 0}
+        )
+        host_stats[event] += 1
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def urlopen(self, *args, **kwargs):
+        _count_connection_event(self, "requests")
+        return super().urlopen(*args, **kwargs)
+
+    def _new_conn(self):
+        _count_connection_event(self, "new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def urlopen(self, *args, **kwargs):
+        _count_connection_event(self, "requests")
+        return super().urlopen(*args, **kwargs)
+
+    def _new_conn(self):
+        _count_connection_event(self, "new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools count requests and new connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+@dataclass
+class DownloadResult:
+    """
+    Outcome of fetch_from_url.
+
+    Attributes:
+        path (str): path to the downloaded file, None if the download failed
+        status (str): "downloaded", "cached", "failed" or "checksum mismatch"
+        hashes (Dict): hex digests of the downloaded bytes by algorithm,
+            if any were computed
+    """
+
+    path: Optional[str] = None
+    status: str = "failed"
+    hashes: Optional[Dict[str, str]] = None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed request.
+
+    Requests are retried after a timeout, a connection error or a response with
+    one of status_codes. The wait before retry n (from 0) is drawn uniformly from
+    [0, min(max_backoff, backoff_factor * 2**n)] ("full jitter"), so that parallel
+    downloads throttled at the same time do not retry in lockstep. A Retry-After
+    header on a 429 or 503 response is used as the wait instead, up to max_backoff.
+
+    Attributes:
+        max_retries (int): number of retries after the first attempt
+        backoff_factor (float): base wait in seconds
+        max_backoff (float): longest wait in seconds
+        status_codes (Tuple[int]): response status codes to retry
+        jitter (bool): randomise the exponential backoff
+    """
+
+    max_retries: int = 3
+    backoff_factor: float = 1.0
+    max_backoff: float = 60.0
+    status_codes: Tuple[int, ...] = (429, 500, 502, 503, 504)
+    jitter: bool = True
+
+    def get_backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Get the seconds to wait before a retry.
+
+        Args:
+            attempt (int): number of retries already made
+            retry_after (float): seconds from a Retry-After header, if any
+
+        Returns:
+            seconds to wait
+        """
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_backoff)
+        backoff = min(self.max_backoff, self.backoff_factor * 2**attempt)
+        if self.jitter:
+            backoff = random.uniform(0, backoff)
+        return backoff
+
+
+# retry policy used by the file retrievers
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class DownloadCache:
+    """
+    Content-addressed on-disk cache of downloaded files.
+
+    Each file is stored once, named by the sha256 of its content, under
+    '<cache_dir>/blobs'. An index maps a cache key (url and resolved file id)
+    to a blob and to the ETag and Last-Modified headers of the response, so
+    that cached files can be revalidated with If-None-Match and
+    If-Modified-Since requests. Least recently used entries are evicted when
+    the blobs take more than max_size bytes.
+
+    Files are copied between the cache and the download path, as copy-on-write
+    clones where the filesystem supports them, so downloaded files can be
+    modified without changing the cache.
+
+    Args:
+        cache_dir (str): directory for the cache, created if it does not exist
+        max_size (int): maximum number of bytes of cached files
+    """
+
+    INDEX_FILENAME = "index.json"
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.blob_dir = self.cache_dir / "blobs"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._index = self._read_index()
+
+    @staticmethod
+    def get_key(api_url: str, file_id: str = None) -> str:
+        """Get the cache key for a url and resolved file id"""
+        return hashlib.sha256(f"{api_url}\n{file_id or ''}".encode()).hexdigest()
+
+    @staticmethod
+    def get_conditional_headers(entry: Dict) -> Dict:
+        """Get the request headers for revalidating a cache entry"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get_entry(self, key: str) -> Dict:
+        """Get the cache entry for a key, None if the key is not cached"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None or not self._blob_path(entry).is_file():
+                return None
+            return dict(entry)
+
+    def store(
+        self,
+        key: str,
+        filepath: str,
+        api_url: str = None,
+        file_id: str = None,
+        etag: str = None,
+        last_modified: str = None,
+        sha256: str = None,
+    ) -> bool:
+        """
+        Add a downloaded file to the cache.
+
+        Files without an ETag or Last-Modified validator are not cached,
+        since they could not be revalidated.
+
+        Args:
+            sha256 (str): hex digest of the file if it is already known,
+                otherwise the file is read to compute it
+
+        Returns:
+            True if the file was cached
+        """
+        if not etag and not last_modified:
+            logger.debug(
+                f"Not caching {filepath}: response has no ETag or Last-Modified"
+            )
+            return False
+        try:
+            if sha256 is None:
+                sha256 = get_file_hash(filepath)
+            blob_path = self.blob_dir / sha256
+            if not blob_path.is_file():
+                clone_or_copy(filepath, blob_path)
+        except OSError as exc:
+            logger.warning(f"Could not cache {filepath}: {exc}")
+            return False
+
+        with self._lock:
+            self._index[key] = {
+                "api_url": api_url,
+                "file_id": file_id,
+                "etag": etag,
+                "last_modified": last_modified,
+                "filename": os.path.basename(filepath),
+                "sha256": sha256,
+                "size": blob_path.stat().st_size,
+                "last_used": time.time(),
+            }
+            self._evict()
+            self._write_index()
+        logger.debug(f"Cached {filepath} as {sha256}")
+        return True
+
+    def restore(self, key: str, target_path: str) -> bool:
+        """
+        Put the cached file for a key at target_path.
+
+        Nothing is written if target_path is already the cached file.
+
+        Returns:
+            True if the cached file is at target_path
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return False
+        blob_path = self._blob_path(entry)
+        try:
+            if not (
+                os.path.exists(target_path) and os.path.samefile(target_path, blob_path)
+            ):
+                clone_or_copy(blob_path, target_path)
+        except OSError as exc:
+            logger.critical(f"Could not restore cached file to {target_path}: {exc}")
+            return False
+
+        with self._lock:
+            if key in self._index:
+                self._index[key]["last_used"] = time.time()
+                self._write_index()
+        return True
+
+    def _blob_path(self, entry: Dict) -> Path:
+        return self.blob_dir / entry["sha256"]
+
+    def _evict(self):
+        """Remove least recently used entries until the blobs fit in max_size"""
+        blob_sizes = {entry["sha256"]: entry["size"] for entry in self._index.values()}
+        total_size = sum(blob_sizes.values())
+        for key, entry in sorted(
+            self._index.items(), key=lambda item: item[1]["last_used"]
+        ):
+            if total_size <= self.max_size:
+                break
+            del self._index[key]
+            if not any(
+                other["sha256"] == entry["sha256"] for other in self._index.values()
+            ):
+                self._blob_path(entry).unlink(missing_ok=True)
+                total_size -= entry["size"]
+                logger.debug(f"Evicted {entry['sha256']} from cache")
+
+    def _read_index(self) -> Dict:
+        index_path = self.cache_dir / self.INDEX_FILENAME
+        if not index_path.is_file():
+            return {}
+        try:
+            return json.loads(index_path.read_text())
+        except ValueError:
+            logger.warning(f"Could not read cache index {index_path}, starting empty")
+            return {}
+
+    def _write_index(self):
+        index_path = self.cache_dir / self.INDEX_FILENAME
+        tmp_path = index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._index))
+        os.replace(tmp_path, index_path)
+
+
+class DownloadHasher:
+    """
+    Compute hashes of a download incrementally as its chunks pass through,
+    so that the file does not have to be read again to verify it.
+
+    Usage:
+        hasher = DownloadHasher(["md5", "sha256"])
+        for chunk in hasher.iter_chunks(chunks):
+            file.write(chunk)
+        hasher.get_mismatches({"md5": expected_md5})
+
+    Args:
+        algorithms (List[str]): hashlib algorithm names, eg "md5" or "SHA-256"
+    """
+
+    def __init__(self, algorithms):
+        self.algorithms = sorted({get_hash_algorithm(name) for name in algorithms})
+        self.reset()
+
+    def reset(self):
+        """Start again from the first byte"""
+        self._hashes = {
+            algorithm: hashlib.new(algorithm) for algorithm in self.algorithms
+        }
+
+    def update(self, data: bytes):
+        """Add the next chunk to the hashes"""
+        for file_hash in self._hashes.values():
+            file_hash.update(data)
+
+    def iter_chunks(self, chunks):
+        """Pass through an iterator of chunks, adding each chunk to the hashes"""
+        for data in chunks:
+            self.update(data)
+            yield data
+
+    def hexdigests(self) -> Dict[str, str]:
+        """Get the hex digests by algorithm"""
+        return {
+            algorithm: file_hash.hexdigest()
+            for algorithm, file_hash in self._hashes.items()
+        }
+
+    def get_mismatches(self, checksums: Dict[str, str]) -> List[str]:
+        """
+        Compare the hashes with expected checksums.
+
+        Args:
+            checksums (Dict): expected hex digests by algorithm
+
+        Returns:
+            the algorithms whose hashes do not match
+        """
+        hashes = self.hexdigests()
+        return [
+            get_hash_algorithm(algorithm)
+            for algorithm, expected in checksums.items()
+            if hashes[get_hash_algorithm(algorithm)] != expected.lower()
+        ]
+
+
+def get_hash_algorithm(name: str) -> str:
+    """Get the hashlib name of a checksum algorithm, eg 'SHA-256' -> 'sha256'"""
+    return name.lower().replace("-", "")
+
+
+def get_checksums(file_metadata: Dict) -> Dict[str, str]:
+    """
+    Get the expected checksums of a file from its metadata.
+
+    Checksums are read from a 'checksums' dict of hex digests by algorithm,
+    or from 'md5sum', 'md5' or 'sha256' keys. Unsupported algorithms are ignored.
+
+    Args:
+        file_metadata (Dict)
+
+    Returns:
+        Dict of hex digests by hashlib algorithm name, empty if there are none
+    """
+    checksums = dict(file_metadata.get("checksums") or {})
+    if "md5sum" in file_metadata:
+        checksums["md5"] = file_metadata["md5sum"]
+    for algorithm in ["md5", "sha256"]:
+        if algorithm in file_metadata:
+            checksums[algorithm] = file_metadata[algorithm]
+
+    supported = {}
+    for name, value in checksums.items():
+        algorithm = get_hash_algorithm(name)
+        if algorithm not in hashlib.algorithms_available:
+            logger.warning(f"Unsupported checksum algorithm '{name}' in metadata")
+            continue
+        supported[algorithm] = str(value).lower()
+    return supported
+
+
+def get_dataverse_checksums(
+    api_url: str, headers: Dict = None, retry_policy: RetryPolicy = None
+) -> Dict[str, str]:
+    """
+    Get the checksum of a Dataverse file from the Dataverse file metadata.
+
+    Only single file downloads ('/api/access/datafile/<id>') have checksums,
+    since Dataverse builds study zip files on request. The checksum is of the
+    uploaded file, and Dataverse serves the ingested '.tab' version of tabular
+    files unless 'format=original' is requested, so ingested tabular files
+    have no checksum either.
+
+    Args:
+        api_url (str): Dataverse download url
+        headers (Dict): request headers, eg the Authorization header for QDR
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        Dict of hex digests by hashlib algorithm name, empty if there is no checksum
+    """
+    base_url, _, file_id = api_url.partition("/access/datafile/")
+    file_id, _, query = file_id.partition("?")
+    if not file_id:
+        return {}
+    if file_id.isdigit():
+        metadata_url = f"{base_url}/files/{file_id}"
+    else:
+        metadata_url = f"{base_url}/files/:persistentId/?persistentId={file_id}"
+
+    response = get_response(metadata_url, headers=headers, retry_policy=retry_policy)
+    if response is None:
+        logger.warning(f"Could not get Dataverse file metadata from {metadata_url}")
+        return {}
+    try:
+        data_file = response.json()["data"]["dataFile"]
+        checksum = data_file["checksum"]
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"No checksum in Dataverse file metadata from {metadata_url}")
+        return {}
+    finally:
+        response.close()
+    is_ingested = data_file.get("tabularData") or data_file.get("originalFileFormat")
+    if is_ingested and "original" not in parse_qs(query).get("format", []):
+        logger.info(
+            f"Not verifying the download of ingested tabular file {file_id}, "
+            "the Dataverse checksum is of the original file"
+        )
+        return {}
+    return get_checksums({"checksums": {checksum["type"]: checksum["value"]}})
+
+
+def get_dataverse_study_file_urls(
+    api_url: str, headers: Dict = None, retry_policy: RetryPolicy = None
+) -> Optional[Set[str]]:
+    """
+    Get the download urls of the files in a Dataverse study.
+
+    Files are listed from the latest version of the study, with a
+    '<base>/access/datafile/<id>' url for both the numeric id and the
+    persistent id of each file.
+
+    Args:
+        api_url (str): Dataverse study download url
+            ('<base>/access/dataset/:persistentId/?persistentId=<study_id>')
+        headers (Dict): request headers, eg the Authorization header for QDR
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        Set of file download urls, None if the files could not be listed
+    """
+    base_url, _, study_id = api_url.partition(
+        "/access/dataset/:persistentId/?persistentId="
+    )
+    if not study_id:
+        return None
+    files_url = (
+        f"{base_url}/datasets/:persistentId/versions/:latest/files"
+        f"?persistentId={study_id}"
+    )
+    response = get_response(files_url, headers=headers, retry_policy=retry_policy)
+    if response is None:
+        logger.warning(f"Could not list the files of study {study_id}")
+        return None
+    try:
+        data_files = [item["dataFile"] for item in response.json()["data"]]
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"Unexpected file list for study {study_id}")
+        return None
+    finally:
+        response.close()
+
+    urls = set()
+    for data_file in data_files:
+        for file_id in [data_file.get("id"), data_file.get("persistentId")]:
+            if file_id:
+                urls.add(f"{base_url}/access/datafile/{file_id}")
+    return urls
+
+
+def get_file_hash(filepath: str, algorithm: str = "sha256") -> str:
+    """Get the hex digest of the content of a file"""
+    file_hash = hashlib.new(algorithm)
+    with open(filepath, "rb") as file:
+        for data in iter(lambda: file.read(1024 * 1024), b""):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def clone_or_copy(source_path: str, target_path: str):
+    """
+    Copy source_path to target_path as a copy-on-write clone (reflink) where the
+    filesystem supports it, eg btrfs or xfs on Linux, otherwise as a full copy.
+    Unlike a hard link, changing either file does not change the other.
+    """
+    tmp_path = f"{target_path}.tmp"
+    try:
+        cloned = False
+        if fcntl is not None:
+            with open(source_path, "rb") as source, open(tmp_path, "wb") as target:
+                try:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                    cloned = True
+                except OSError:
+                    pass
+        if not cloned:
+            shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    except OSError:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def configure_session_pool(pool_size: int = DEFAULT_POOL_SIZE):
+    """
+    Set the number of pooled connections per host and close any existing sessions.
+
+    Args:
+        pool_size (int): maximum number of keep-alive connections per host.
+            Should be at least the number of concurrent downloads per host.
+    """
+    global _session_pool_size
+    with _session_pool_lock:
+        _session_pool_size = max(1, pool_size)
+    close_sessions()
+
+
+def get_session(api_url: str) -> requests.Session:
+    """
+    Get the shared requests.Session for the host of a url.
+
+    Sessions keep connections alive, so repeated downloads from one host
+    reuse connections rather than paying for a new TCP and TLS handshake.
+
+    Args:
+        api_url (str): url to be requested
+
+    Returns:
+        requests.Session
+    """
+    host = get_host(api_url)
+    with _session_pool_lock:
+        session = _session_pool.get(host)
+        if session is None:
+            logger.debug(
+                f"Creating session for {host} with pool size {_session_pool_size}"
+            )
+            session = requests.Session()
+            adapter = _CountingHTTPAdapter(pool_maxsize=_session_pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session_pool[host] = session
+    return session
+
+
+def close_sessions():
+    """Close all pooled sessions"""
+    with _session_pool_lock:
+        for session in _session_pool.values():
+            session.close()
+        _session_pool.clear()
+
+
+def get_connection_stats() -> Dict:
+    """
+    Get counters for pooled connections, by host.
+
+    Returns:
+        Dict of host to a dict with the number of 'requests', 'new_connections',
+        and 'reused_connections'
+    """
+    with _connection_stats_lock:
+        return {
+            host: {
+                **host_stats,
+                "reused_connections": host_stats["requests"]
+                - host_stats["new_connections"],
+            }
+            for host, host_stats in _connection_stats.items()
+        }
+
+
+def reset_connection_stats():
+    """Reset the counters for pooled connections"""
+    with _connection_stats_lock:
+        _connection_stats.clear()
+
 
 def get_filename_from_headers(headers: Dict) -> str:
     """
@@ -45,123 +712,2044 @@ def get_filename_from_headers(headers: Dict) -> str:
     return file_name
 
 
-def get_idp_access_token(wts_hostname: str, auth: Gen3Auth, file_metadata: Dict) -> str:
-    """Get an access token for QDR using a Gen3 commons WTS"""
+def get_token_expiry(token: str) -> Optional[float]:
+    """
+    Get the expiry time of a JWT from its 'exp' claim.
+
+    The token signature is not verified, the expiry is only used to decide
+    when a cached token should be refreshed.
+
+    Args:
+        token (str): access token
+
+    Returns:
+        expiry as seconds since the epoch, or None if the token is not a JWT with an 'exp' claim
+    """
     try:
-        logger.debug("Ready to get auth token")
-        wts_access_token = auth.get_access_token()
-        logger.debug("Ready to get idp token")
-        idp = file_metadata.get("external_oidc_idp")
-        idp_access_token = wts_get_token(
-            hostname=wts_hostname, idp=idp, access_token=wts_access_token
-        )
-    except Exception as e:
-        logger.critical(f"Could not get token: {e}")
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
         return None
 
-    return idp_access_token
 
+def clear_token_cache():
+    """Remove all cached idp access tokens"""
+    with _token_cache_lock:
+        _token_cache.clear()
+        _token_locks.clear()
 
-def unpackage_object(filepath: str):
-    """Unpackage the downloaded zip file"""
-    with zipfile.ZipFile(filepath, "r") as package:
-        package.extractall(os.path.dirname(filepath))
 
+def get_auth_identity(auth: Gen3Auth) -> str:
+    """
+    Identify the user of a Gen3Auth in the token cache, by a hash of its
+    endpoint and api key or client credentials. Other auth objects, eg
+    using a WTS access token, are identified by the object.
+
+    Args:
+        auth (Gen3Auth): auth for commons with wts
 
-def get_id(file_metadata: Dict) -> str:
+    Returns:
+        str identity of the auth
     """
-    Parse out the object id from the metadata.
+    refresh_token = getattr(auth, "_refresh_token", None)
+    if isinstance(refresh_token, dict) and refresh_token.get("api_key"):
+        credentials = refresh_token["api_key"]
+    elif isinstance(getattr(auth, "_client_credentials", None), tuple):
+        credentials = repr(auth._client_credentials)
+    else:
+        return f"object:{id(auth)}"
+    content = f"{getattr(auth, 'endpoint', None)}|{credentials}"
+    return f"sha256:{hashlib.sha256(content.encode()).hexdigest()}"
+
+
+def get_idp_access_token(wts_hostname: str, auth: Gen3Auth, file_metadata: Dict) -> str:
+    """
+    Get an access token for QDR using a Gen3 commons WTS.
+
+    Tokens are cached per (wts_hostname, idp, auth identity), see
+    get_auth_identity, and reused until they are within
+    TOKEN_REFRESH_MARGIN seconds of their JWT expiry, or DEFAULT_TOKEN_TTL seconds
+    for tokens without an expiry. If a refresh fails then a cached token that has
+    not yet expired is still returned. Concurrent callers for the same key wait
+    for a single request to the WTS.
 
     Args:
-        file_metadata (Dict)
+        wts_hostname (str): hostname for commons with wts
+        auth (Gen3Auth): auth for commons with wts
+        file_metadata (Dict): file metadata with 'external_oidc_idp'
 
     Returns:
-        string
+        idp access token, or None if a token could not be obtained
     """
-    id_types = ["study_id", "file_id"]
-    for id_type in id_types:
-        if id_type in file_metadata:
-            return file_metadata.get(id_type)
+    idp = file_metadata.get("external_oidc_idp")
+    key = (wts_hostname, idp, get_auth_identity(auth))
+    with _token_cache_lock:
+        key_lock = _token_locks.setdefault(key, threading.Lock())
 
-    return None
+    with key_lock:
+        cached_token, expires_at = _token_cache.get(key, (None, 0.0))
+        now = time.time()
+        if cached_token and now < expires_at - TOKEN_REFRESH_MARGIN:
+            return cached_token
 
+        try:
+            logger.debug("Ready to get auth token")
+            wts_access_token = auth.get_access_token()
+            logger.debug("Ready to get idp token")
+            idp_access_token = wts_get_token(
+                hostname=wts_hostname, idp=idp, access_token=wts_access_token
+            )
+        except Exception as e:
+            if cached_token and now < expires_at:
+                logger.warning(f"Could not refresh token, using cached token: {e}")
+                return cached_token
+            logger.critical(f"Could not get token: {e}")
+            return None
 
-def get_filename(file_metadata: Dict) -> str:
+        if idp_access_token:
+            expires_at = get_token_expiry(idp_access_token) or now + DEFAULT_TOKEN_TTL
+            with _token_cache_lock:
+                _token_cache[key] = (idp_access_token, expires_at)
+
+    return idp_access_token
+
+
+def unpackage_object(filepath: str, max_workers: int = 1, exclude: Set[str] = None):
     """
-    Get the filename from the external_file_metadata object.
+    Unpackage the downloaded zip file.
+
+    With max_workers > 1 the zip members are extracted in parallel, each worker
+    thread reading from its own handle on the zip file. Members are scheduled
+    largest first, and small members are batched together, so that one large
+    member does not hold up the end of the extraction. The extracted files are
+    the same as from ZipFile.extractall.
 
     Args:
-        file_metadata (Dict)
+        filepath (str): path to zip file, members are extracted into the same directory
+        max_workers (int): number of threads extracting members
+        exclude (Set[str]): names of members that are not extracted
+    """
+    if not metrics_enabled():
+        _unpackage_object(filepath, max_workers, exclude)
+        return
+
+    start_time = time.perf_counter()
+    _unpackage_object(filepath, max_workers, exclude)
+    total_seconds = time.perf_counter() - start_time
+    with zipfile.ZipFile(filepath, "r") as package:
+        members = get_extraction_members(package, exclude)
+    emit_metrics(
+        "unpack",
+        path=str(filepath),
+        members=len(members),
+        bytes=sum(member.file_size for member in members),
+        workers=max_workers,
+        total_seconds=total_seconds,
+    )
+
+
+def get_extraction_members(
+    package: zipfile.ZipFile, exclude: Set[str] = None
+) -> List[zipfile.ZipInfo]:
+    """Get the members of a zip file that are not excluded by name"""
+    return [
+        member
+        for member in package.infolist()
+        if member.filename not in (exclude or ())
+    ]
+
+
+def _unpackage_object(filepath: str, max_workers: int, exclude: Set[str] = None):
+    """Implementation of unpackage_object"""
+    target_dir = os.path.dirname(filepath)
+    if max_workers <= 1:
+        with zipfile.ZipFile(filepath, "r") as package:
+            package.extractall(
+                target_dir, members=get_extraction_members(package, exclude)
+            )
+        return
+
+    with zipfile.ZipFile(filepath, "r") as package:
+        # later members with the same name overwrite earlier ones in extractall
+        members = list(
+            {
+                member.filename: member
+                for member in get_extraction_members(package, exclude)
+            }.values()
+        )
+
+        # create directories up front so that workers do not race to create them
+        for member in members:
+            target_path = get_extract_path(member, target_dir)
+            if member.is_dir():
+                os.makedirs(target_path, exist_ok=True)
+            elif os.path.dirname(target_path):
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+    batches = get_extraction_batches(
+        [member for member in members if not member.is_dir()]
+    )
+    logger.debug(
+        f"Extracting {len(members)} members from {filepath} in {len(batches)} batches "
+        f"with {max_workers} workers"
+    )
+
+    thread_data = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def extract_batch(batch):
+        if not hasattr(thread_data, "package"):
+            thread_data.package = zipfile.ZipFile(filepath, "r")
+            with handles_lock:
+                handles.append(thread_data.package)
+        for member in batch:
+            thread_data.package.extract(member, target_dir)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(extract_batch, batch) for batch in batches]:
+                future.result()
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def get_extraction_batches(
+    members: List[zipfile.ZipInfo], batch_size: int = EXTRACTION_BATCH_SIZE
+) -> List[List[zipfile.ZipInfo]]:
+    """
+    Group zip members into batches for parallel extraction, largest first.
+
+    Members larger than batch_size are a batch by themselves, smaller members
+    are grouped until the batch holds about batch_size bytes.
+
+    Args:
+        members (List of ZipInfo): zip members to extract
+        batch_size (int): target number of uncompressed bytes per batch
 
     Returns:
-        string
+        List of batches of members
     """
-    return file_metadata.get("filename", None)
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for member in sorted(members, key=lambda member: member.file_size, reverse=True):
+        batch.append(member)
+        batch_bytes += member.file_size
+        if batch_bytes >= batch_size:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        batches.append(batch)
+    return batches
 
 
-def download_from_url(
-    api_url: str, headers=None, download_path: str = ".", filename: str = None
+def get_zip_extracted_size(filepath: str) -> int:
+    """Get the total uncompressed size of the members of a zip file"""
+    with zipfile.ZipFile(filepath, "r") as package:
+        return sum(member.file_size for member in package.infolist())
+
+
+def unpack_download(
+    id: str, result: DownloadResult, unpack_workers: int, timer: PhaseTimer
 ) -> str:
     """
-    Retrieve data file (study_id or file_id) from url.
-    Save the file based on the filename in the Content-Disposition response header.
+    Unpack a downloaded zip file and remove the zip file. Other downloads,
+    including zip files extracted while downloading, are left as they are.
 
     Args:
-        api_url (str): url for QDR or Harvard API
-        headers (Dict): request headers
-        download_path (str): path for saving downloaded zip file
-        filename (str): filename to save downloaded files to, default is to get a
-          filename by parsing response headers.
+        id (str): study_id or file_id
+        result (DownloadResult): outcome of the download
+        unpack_workers (int): number of threads for unpacking the zip file
+        timer (PhaseTimer): timer to record the unpack and cleanup phases
 
     Returns:
-        path to downloaded and renamed file.
+        status string: the download status, or "failed" if the zip file
+        could not be unpacked
     """
+    downloaded_file = result.path
+    if downloaded_file is None:
+        return result.status
+    if not (downloaded_file.endswith("zip") and Path(downloaded_file).is_file()):
+        logger.info(f"{id} {result.status} in {timer.total_seconds:.2f}s")
+        return result.status
+
+    status = result.status
+    peak_disk_usage = Path(downloaded_file).stat().st_size
     try:
-        response = requests.get(url=api_url, headers=headers, stream=True)
-        response.raise_for_status()
-    except requests.exceptions.Timeout:
-        logger.critical(
-            f"Was unable to get the download url: {api_url}. Timeout Error."
-        )
-        return None
-    except requests.exceptions.HTTPError as exc:
-        logger.critical(f"HTTPError in download {exc}")
-        return None
-    except requests.exceptions.ConnectionError as exc:
-        logger.critical(f"ConnectionError in download {exc}")
-        return None
-    except Exception as exc:
-        logger.critical(f"Error in download {exc}")
-        return None
-    logger.debug(f"Status code={response.status_code}")
-    if filename is not None:
-        downloaded_file_name = filename
-    else:
-        downloaded_file_name = get_filename_from_headers(response.headers)
-        if downloaded_file_name is None:
-            downloaded_file_name = api_url.split("/")[-1]
+        logger.debug(f"Ready to unpack {downloaded_file}.")
+        unpackage_object(filepath=downloaded_file, max_workers=unpack_workers)
+        peak_disk_usage += get_zip_extracted_size(downloaded_file)
+    except Exception as e:
+        logger.critical(f"{id} had an issue while being unpackaged: {e}")
+        status = "failed"
+    timer.mark("unpack")
 
-    if downloaded_file_name.endswith(
-        "zip"
-    ) and not "application/zip" in response.headers.get("Content-Type"):
-        logger.critical("Response headers do not show zipfile content-type")
+    # remove the zip file
+    Path(downloaded_file).unlink()
+    timer.mark("cleanup")
+    logger.info(
+        f"{id} downloaded and unpacked in {timer.total_seconds:.2f}s, "
+        f"peak disk usage = {peak_disk_usage} bytes"
+    )
+    return status
 
-    total_downloaded = 0
-    block_size = 8092  # 8K blocks might want to tune this.
-    download_filename = f"{download_path}/{downloaded_file_name}"
-    try:
-        logger.info(f"Saving download as {download_filename}")
-        with open(download_filename, "wb") as file:
-            for data in response.iter_content(block_size):
-                total_downloaded += len(data)
-                file.write(data)
-    except IOError as ex:
-        logger.critical(f"IOError opening {download_filename} for writing: {ex}")
-        return None
 
+def get_extract_path(member: zipfile.ZipInfo, target_dir: str) -> str:
+    """
+    Get the path that ZipFile.extractall would write a zip member to.
+
+    Absolute paths are made relative, and drive letters, empty, '.' and '..'
+    path components are removed, so that members cannot be written outside target_dir.
+
+    Args:
+        member (zipfile.ZipInfo): zip member
+        target_dir (str): directory to extract into
+
+    Returns:
+        path for the extracted member
+    """
+    arcname = member.filename.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ("", os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(
+        part for part in arcname.split(os.path.sep) if part not in invalid_path_parts
+    )
+    if os.path.sep == "\\":
+        arcname = zipfile.ZipFile._sanitize_windows_name(arcname, os.path.sep)
+
+    return os.path.normpath(os.path.join(target_dir, arcname))
+
+
+class StreamingZipError(zipfile.BadZipFile):
+    """The zip stream uses a layout that cannot be extracted while streaming"""
+
+    pass
+
+
+class StreamingZipExtractor:
+    """
+    Extract the members of a zip file from a stream of bytes as the bytes arrive.
+
+    Members are read from their local file headers, so the zip file is never
+    written to disk. Stored and deflated members are supported, including
+    members followed by a data descriptor, which is how Dataverse writes bundles.
+    Raises StreamingZipError for layouts that need the central directory, eg
+    encrypted members or stored members of unknown size.
+
+    Usage:
+        extractor = StreamingZipExtractor(target_dir)
+        for chunk in chunks:
+            extractor.write(chunk)
+        extractor.close()
+
+    Attributes:
+        bytes_received (int): number of zip bytes written to the extractor
+        bytes_written (int): number of extracted bytes written to disk
+        members (List): paths of the extracted members
+    """
+
+    LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+    LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+    DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+    END_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+
+    def __init__(self, target_dir: str):
+        self.target_dir = target_dir
+        self.bytes_received = 0
+        self.bytes_written = 0
+        self.members = []
+        self._buffer = bytearray()
+        self._state = "header"
+        self._member = None
+        self._output = None
+        self._decompressor = None
+        self._remaining = 0
+        self._crc = 0
+        self._zip64 = False
+
+    def write(self, data: bytes):
+        """Extract as much as possible from the next chunk of the zip stream"""
+        self.bytes_received += len(data)
+        if self._state == "end":
+            return
+        self._buffer += data
+        while self._process():
+            pass
+
+    def close(self):
+        """Finish extraction, raises zipfile.BadZipFile if the stream is incomplete"""
+        self._close_output()
+        if self._state != "end":
+            raise zipfile.BadZipFile("Zip stream ended before the central directory")
+
+    def abort(self):
+        """Stop extraction, leaving any partially extracted member on disk"""
+        self._close_output()
+        self._state = "end"
+
+    def _process(self) -> bool:
+        """Process the buffer, returns True if more processing may be possible"""
+        if self._state == "header":
+            return self._read_local_header()
+        if self._state == "data":
+            return self._read_data()
+        if self._state == "descriptor":
+            return self._read_data_descriptor()
+        return False
+
+    def _read_local_header(self) -> bool:
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature in self.END_SIGNATURES:
+            self._state = "end"
+            self._buffer.clear()
+            return False
+        if signature != self.LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("Bad local file header signature in zip stream")
+        if len(self._buffer) < self.LOCAL_HEADER.size:
+            return False
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            file_size,
+            name_length,
+            extra_length,
+        ) = self.LOCAL_HEADER.unpack_from(self._buffer)
+        header_size = self.LOCAL_HEADER.size + name_length + extra_length
+        if len(self._buffer) < header_size:
+            return False
+
+        name_end = self.LOCAL_HEADER.size + name_length
+        name = bytes(self._buffer[self.LOCAL_HEADER.size : name_end])
+        name = name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = bytes(self._buffer[name_end:header_size])
+        del self._buffer[:header_size]
+
+        if flags & 0x1:
+            raise StreamingZipError(f"Encrypted zip member '{name}'")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise StreamingZipError(f"Unsupported compression for zip member '{name}'")
+
+        self._zip64 = False
+        while len(extra) >= 4:
+            extra_id, extra_size = struct.unpack_from("<2H", extra)
+            if extra_id == 0x0001:
+                self._zip64 = True
+                values = extra[4 : 4 + extra_size]
+                if file_size == 0xFFFFFFFF and len(values) >= 8:
+                    file_size = struct.unpack_from("<Q", values)[0]
+                    values = values[8:]
+                if compressed_size == 0xFFFFFFFF and len(values) >= 8:
+                    compressed_size = struct.unpack_from("<Q", values)[0]
+            extra = extra[4 + extra_size :]
+
+        has_descriptor = bool(flags & 0x8)
+        if method == zipfile.ZIP_STORED and has_descriptor and compressed_size == 0:
+            raise StreamingZipError(f"Stored zip member '{name}' has unknown size")
+
+        self._member = {
+            "name": name,
+            "method": method,
+            "crc": crc,
+            "has_descriptor": has_descriptor,
+        }
+        self._remaining = compressed_size
+        self._crc = 0
+        self._decompressor = (
+            zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        )
+
+        member = zipfile.ZipInfo(name)
+        target_path = get_extract_path(member, self.target_dir)
+        upper_dirs = os.path.dirname(target_path)
+        if upper_dirs and not os.path.exists(upper_dirs):
+            os.makedirs(upper_dirs)
+        if member.is_dir():
+            if not os.path.isdir(target_path):
+                os.mkdir(target_path)
+        else:
+            self._output = open(target_path, "wb")
+            self.members.append(target_path)
+        self._state = "data"
+        return True
+
+    def _write_output(self, data: bytes):
+        if data:
+            self._crc = zlib.crc32(data, self._crc)
+            self.bytes_written += len(data)
+            if self._output is not None:
+                self._output.write(data)
+
+    def _close_output(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def _read_data(self) -> bool:
+        if self._decompressor is not None:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            try:
+                self._write_output(self._decompressor.decompress(data))
+            except zlib.error as exc:
+                raise zipfile.BadZipFile(
+                    f"Bad compressed data for zip member '{self._member['name']}': {exc}"
+                )
+            if not self._decompressor.eof:
+                return False
+            self._buffer += self._decompressor.unused_data
+        else:
+            data = bytes(self._buffer[: self._remaining])
+            del self._buffer[: self._remaining]
+            self._remaining -= len(data)
+            self._write_output(data)
+            if self._remaining > 0:
+                return False
+
+        if self._member["has_descriptor"]:
+            self._state = "descriptor"
+        else:
+            self._finish_member(self._member["crc"])
+        return True
+
+    def _read_data_descriptor(self) -> bool:
+        size_length = 8 if self._zip64 else 4
+        has_signature = self._buffer[:4] == self.DATA_DESCRIPTOR_SIGNATURE
+        descriptor_size = 4 + 2 * size_length + (4 if has_signature else 0)
+        if len(self._buffer) < max(4, descriptor_size):
+            return False
+        offset = 4 if has_signature else 0
+        crc = struct.unpack_from("<L", self._buffer, offset)[0]
+        del self._buffer[:descriptor_size]
+        self._finish_member(crc)
+        return True
+
+    def _finish_member(self, expected_crc: int):
+        self._close_output()
+        if self._crc != expected_crc:
+            raise zipfile.BadZipFile(
+                f"Bad CRC-32 for zip member '{self._member['name']}'"
+            )
+        self._member = None
+        self._decompressor = None
+        self._state = "header"
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only file-like view of an iterator of byte chunks, eg from
+    iter_response_chunks, for parsers that read from files.
+
+    Chunks are read from the iterator as the parser asks for more bytes, so
+    the whole content is never held in memory.
+
+    Usage:
+        stream = io.BufferedReader(ChunkReader(iter_response_chunks(response, chunk_size)))
+        for frame in pandas.read_csv(stream, chunksize=10000):
+            ...
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        self.bytes_read += size
+        return size
+
+
+class DownloadSink:
+    """
+    Adapt a caller-supplied sink to receive the bytes of a download.
+
+    The sink can be:
+        a file-like object with a write method, eg an open file, io.BytesIO or
+            a socket file, which is called with each chunk
+        a generator that receives each chunk with 'chunk = yield', eg to feed an
+            upload; it is primed before the first chunk and closed after the last
+        a callable, which is called with a memoryview of each chunk
+
+    Chunks are passed on as they are read from the response, without copying
+    them or writing them to disk. File-like objects are not closed.
+
+    Attributes:
+        bytes_written (int): number of bytes passed to the sink
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.bytes_written = 0
+        self._consumer = None
+        if hasattr(sink, "write"):
+            self._write = sink.write
+        elif hasattr(sink, "send"):
+            self._consumer = sink
+            next(sink)
+            self._write = lambda data: sink.send(memoryview(data))
+        elif callable(sink):
+            self._write = lambda data: sink(memoryview(data))
+        else:
+            raise TypeError(
+                f"Download sink must be file-like, a generator or callable: {sink!r}"
+            )
+
+    def write(self, data: bytes):
+        """Pass the next chunk to the sink"""
+        try:
+            self._write(data)
+        except StopIteration:
+            raise IOError("Download sink generator stopped before the download ended")
+        self.bytes_written += len(data)
+
+    def close(self):
+        """Close a generator sink after the last chunk"""
+        if self._consumer is not None:
+            self._consumer.close()
+            self._consumer = None
+
+
+def get_id(file_metadata: Dict) -> str:
+    """
+    Parse out the object id from the metadata.
+
+    Args:
+        file_metadata (Dict)
+
+    Returns:
+        string
+    """
+    id_types = ["study_id", "file_id"]
+    for id_type in id_types:
+        if id_type in file_metadata:
+            return file_metadata.get(id_type)
+
+    return None
+
+
+def get_filename(file_metadata: Dict) -> str:
+    """
+    Get the filename from the external_file_metadata object.
+
+    Args:
+        file_metadata (Dict)
+
+    Returns:
+        string
+    """
+    return file_metadata.get("filename", None)
+
+
+def get_zip_filename(api_url: str, file_metadata: Dict) -> Optional[str]:
+    """
+    Get a filename for saving the zip file of a study download.
+
+    Dataverse names every study zip file 'dataverse_files.zip', so a study
+    without a filename in its metadata is given a zip filename unique to its
+    url, so that concurrent study downloads do not write the same zip file.
+
+    Args:
+        api_url (str): download url of the study or file
+        file_metadata (Dict)
+
+    Returns:
+        string, None for files and for studies with a filename in the metadata
+    """
+    if "study_id" not in file_metadata or get_filename(file_metadata) is not None:
+        return None
+    return f"dataverse_files_{hashlib.sha1(api_url.encode()).hexdigest()[:16]}.zip"
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Get the seconds to wait from the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): response with status 429 or 503
+
+    Returns:
+        seconds to wait, None if there is no valid Retry-After header
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def get_content_total(response, received: int = 0) -> Optional[int]:
+    """
+    Get the expected size of a whole file from the headers of a response.
+
+    Args:
+        response: requests or aiohttp response
+        received (int): bytes received before a '206 Partial Content' response
+
+    Returns:
+        number of bytes, None if the response headers do not say
+    """
+    status_code = getattr(response, "status_code", None) or response.status
+    content_range = response.headers.get("Content-Range", "")
+    if status_code == 206 and content_range.rpartition("/")[2].isdigit():
+        return int(content_range.rpartition("/")[2])
+    content_length = response.headers.get("Content-Length", "")
+    if not content_length.isdigit():
+        return None
+    return int(content_length) + (received if status_code == 206 else 0)
+
+
+def get_response(
+    api_url: str,
+    headers=None,
+    retry_policy: RetryPolicy = None,
+    timeout: Tuple[float, float] = DEFAULT_REQUEST_TIMEOUT,
+) -> requests.Response:
+    """
+    Send a streaming GET request using the pooled session for the url host.
+
+    Args:
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        retry_policy (RetryPolicy): if set then retry timeouts, connection errors
+            and retryable status codes, default is no retries
+        timeout (Tuple): (connect, read) timeout in seconds, the read timeout
+            also applies to reading the streamed response body
+
+    Returns:
+        response, None if there are errors
+    """
+    attempt = 0
+    while True:
+        retry_after = None
+        wait_for_request_limiter(api_url)
+        try:
+            response = get_session(api_url).get(
+                url=api_url, headers=headers, stream=True, timeout=timeout
+            )
+            response.raise_for_status()
+            break
+        except requests.exceptions.Timeout:
+            error = f"Was unable to get the download url: {api_url}. Timeout Error."
+        except requests.exceptions.HTTPError as exc:
+            exc.response.close()
+            error = f"HTTPError in download {exc}"
+            if (
+                retry_policy is None
+                or exc.response.status_code not in retry_policy.status_codes
+            ):
+                logger.critical(error)
+                return None
+            if exc.response.status_code in (429, 503):
+                retry_after = get_retry_after(exc.response)
+        except requests.exceptions.ConnectionError as exc:
+            error = f"ConnectionError in download {exc}"
+        except Exception as exc:
+            logger.critical(f"Error in download {exc}")
+            return None
+
+        if retry_policy is None or attempt >= retry_policy.max_retries:
+            logger.critical(error)
+            return None
+        backoff = retry_policy.get_backoff(attempt, retry_after)
+        attempt += 1
+        logger.warning(
+            f"{error} Retrying in {backoff:.2f} seconds, "
+            f"attempt {attempt} of {retry_policy.max_retries}"
+        )
+        time.sleep(backoff)
+
+    logger.debug(f"Status code={response.status_code}")
+    return response
+
+
+def fetch_from_url(
+    api_url: str,
+    headers=None,
+    download_path: str = ".",
+    filename: str = None,
+    max_resume_attempts: int = DEFAULT_MAX_RESUME_ATTEMPTS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    adaptive_chunk_size: bool = False,
+    extract_zip: bool = False,
+    cache: "DownloadCache" = None,
+    file_id: str = None,
+    retry_policy: RetryPolicy = None,
+    sink=None,
+    checksums: Dict[str, str] = None,
+    hash_algorithms: List[str] = None,
+    progress: Callable = None,
+    zip_filename: str = None,
+) -> DownloadResult:
+    """
+    Retrieve data file (study_id or file_id) from url and report the outcome.
+    Save the file based on the filename in the Content-Disposition response header.
+
+    Data is written to a part file keyed by the filename and url, see
+    get_part_filename, and renamed when the download is complete. If the server
+    advertises 'Accept-Ranges: bytes' then an interrupted download is resumed
+    with a Range request. A part file left by an earlier call is resumed rather
+    than downloaded again if the ETag or Last-Modified date and the size saved
+    with it match the response, otherwise it is removed. Range requests are sent
+    with If-Range, and if the server ignores the Range request, or the
+    Content-Range of its response does not match the part file, then the file
+    is downloaded from the start.
+
+    With extract_zip=True a zip file is extracted into download_path while it
+    downloads, so the zip file is never written to disk. If the zip cannot be
+    extracted while streaming then it is downloaded and saved as usual.
+
+    With a sink the downloaded bytes are passed straight to the sink and nothing
+    is written to download_path, see DownloadSink. Interrupted downloads are
+    resumed from the number of bytes already passed to the sink. The cache and
+    extract_zip are not used.
+
+    Hashes of the downloaded bytes are computed while they are written, for the
+    algorithms of the expected checksums and hash_algorithms. A download whose
+    hashes do not match the checksums is removed and has the status
+    "checksum mismatch". For a zip file extracted while downloading the hashes
+    are of the zip stream, and the extracted files are left in place.
+
+    The progress of the transfer is sent to the progress callback and the
+    registered progress hooks as throttled FileProgress updates, see heal.progress.
+
+    Args:
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        download_path (str): path for saving downloaded zip file
+        filename (str): filename to save downloaded files to, default is to get a
+          filename by parsing response headers.
+        max_resume_attempts (int): number of times to resume an interrupted download
+        chunk_size (int): number of bytes read from the response and written to
+            file at a time
+        adaptive_chunk_size (bool): if True then start with chunk_size and
+            grow or shrink it based on the observed throughput
+        extract_zip (bool): if True then extract zip files while downloading
+        cache (DownloadCache): if set then send a conditional request for files
+            in the cache, and store downloaded files in the cache. A '304 Not Modified'
+            response is served from the cache and has status "cached".
+            Files extracted while streaming are not cached.
+        file_id (str): resolved study_id or file_id, used with api_url as the cache key
+        retry_policy (RetryPolicy): if set then retry requests that time out or fail
+            with a retryable status, default is no retries
+        sink: file-like object, generator or callable to receive the downloaded
+            bytes instead of a file
+        checksums (Dict): expected hex digests of the file by algorithm, eg from
+            get_checksums(file_metadata) or get_dataverse_checksums(api_url)
+        hash_algorithms (List[str]): algorithms of additional hashes to compute
+        progress (Callable): called with a FileProgress for the bytes received,
+            expected total bytes and rate, at most every PROGRESS_INTERVAL seconds
+            and when the download ends
+        zip_filename (str): if set and filename is not, then a zip file is saved
+            as zip_filename rather than the filename in the response headers,
+            see get_zip_filename
+
+    Returns:
+        DownloadResult with the path to the downloaded and renamed file,
+        or download_path if a zip file was extracted while downloading,
+        or the name of the file if it was passed to a sink,
+        a status of "downloaded", "cached", "failed" or "checksum mismatch",
+        and the computed hashes.
+    """
+    if sink is not None and not isinstance(sink, DownloadSink):
+        sink = DownloadSink(sink)
+    reporter = None
+    if progress is not None or progress_enabled():
+        reporter = ProgressReporter(api_url, file_id=file_id, callback=progress)
+    if not metrics_enabled():
+        result = _fetch_from_url(
+            api_url,
+            headers,
+            download_path,
+            filename,
+            max_resume_attempts,
+            chunk_size,
+            adaptive_chunk_size,
+            extract_zip,
+            cache,
+            file_id,
+            retry_policy,
+            sink,
+            checksums,
+            hash_algorithms,
+            reporter=reporter,
+            zip_filename=zip_filename,
+        )
+    else:
+        stats = {"response_time": None, "bytes": 0, "resumes": 0}
+        start_time = time.perf_counter()
+        result = _fetch_from_url(
+            api_url,
+            headers,
+            download_path,
+            filename,
+            max_resume_attempts,
+            chunk_size,
+            adaptive_chunk_size,
+            extract_zip,
+            cache,
+            file_id,
+            retry_policy,
+            sink,
+            checksums,
+            hash_algorithms,
+            stats,
+            reporter,
+            zip_filename,
+        )
+        end_time = time.perf_counter()
+        response_time = stats.pop("response_time") or end_time
+        emit_metrics(
+            "download",
+            api_url=api_url,
+            file_id=file_id,
+            status=result.status,
+            first_byte_seconds=response_time - start_time,
+            transfer_seconds=end_time - response_time,
+            total_seconds=end_time - start_time,
+            **stats,
+        )
+
+    if sink is not None:
+        # a generator sink is closed after a failed download as well
+        sink.close()
+    if reporter is not None:
+        reporter.finish(result.status)
+    return result
+
+
+def _fetch_from_url(
+    api_url: str,
+    headers,
+    download_path: str,
+    filename: str,
+    max_resume_attempts: int,
+    chunk_size: int,
+    adaptive_chunk_size: bool,
+    extract_zip: bool,
+    cache: "DownloadCache",
+    file_id: str,
+    retry_policy: RetryPolicy,
+    sink: DownloadSink = None,
+    checksums: Dict[str, str] = None,
+    hash_algorithms: List[str] = None,
+    stats: Dict = None,
+    reporter: ProgressReporter = None,
+    zip_filename: str = None,
+) -> DownloadResult:
+    """
+    Implementation of fetch_from_url.
+
+    Args:
+        stats (Dict): if set then 'response_time' (time.perf_counter() when the
+            response headers arrived), 'bytes' and 'resumes' are recorded for metrics
+        reporter (ProgressReporter): if set then the bytes received are reported
+        other args: see fetch_from_url
+    """
+    checksums = {
+        get_hash_algorithm(algorithm): value.lower()
+        for algorithm, value in (checksums or {}).items()
+    }
+    cache_key = None
+    cache_entry = None
+    if cache is not None and sink is None:
+        cache_key = cache.get_key(api_url, file_id)
+        cache_entry = cache.get_entry(cache_key)
+        if cache_entry is not None:
+            headers = {**(headers or {}), **cache.get_conditional_headers(cache_entry)}
+
+    response = get_response(api_url, headers=headers, retry_policy=retry_policy)
+    if response is None:
+        return DownloadResult(status="failed")
+    if stats is not None:
+        stats["response_time"] = time.perf_counter()
+
+    if response.status_code == 304 and cache_entry is not None:
+        response.close()
+        if checksums.get("sha256", cache_entry["sha256"]) != cache_entry["sha256"]:
+            logger.critical(f"Cached file for {api_url} does not match its sha256")
+            return DownloadResult(status="checksum mismatch")
+        cached_filename = f"{download_path}/{filename or cache_entry['filename']}"
+        if not cache.restore(cache_key, cached_filename):
+            return DownloadResult(status="failed")
+        logger.info(f"{api_url} is not modified, using cached file {cached_filename}")
+        return DownloadResult(path=cached_filename, status="cached")
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+    if filename is not None:
+        downloaded_file_name = filename
+    else:
+        downloaded_file_name = get_filename_from_headers(response.headers)
+        if downloaded_file_name is None:
+            downloaded_file_name = api_url.split("/")[-1]
+        if zip_filename is not None and downloaded_file_name.endswith("zip"):
+            downloaded_file_name = zip_filename
+
+    if downloaded_file_name.endswith(
+        "zip"
+    ) and not "application/zip" in response.headers.get("Content-Type", ""):
+        logger.critical("Response headers do not show zipfile content-type")
+
+    download_filename = f"{download_path}/{downloaded_file_name}"
+    part_filename = get_part_filename(download_filename, api_url)
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    if_range = get_range_validator(validators)
+    total = get_content_total(response)
+
+    extractor = None
+    if extract_zip and sink is None and downloaded_file_name.endswith("zip"):
+        extractor = StreamingZipExtractor(download_path)
+
+    requested_algorithms = {
+        get_hash_algorithm(algorithm)
+        for algorithm in [*checksums, *(hash_algorithms or [])]
+    }
+    algorithms = set(requested_algorithms)
+    if cache_key is not None:
+        # the cache names files by their sha256
+        algorithms.add("sha256")
+    hasher = DownloadHasher(algorithms) if algorithms else None
+
+    resume_from = 0
+    if extractor is None and sink is None and os.path.isfile(part_filename):
+        if accepts_ranges and is_resumable_part(part_filename, validators, total):
+            resume_from = os.path.getsize(part_filename)
+        else:
+            logger.info(f"Removing {part_filename}, it is not part of the current file")
+            remove_part_files(part_filename)
+        if resume_from > 0 and hasher is not None:
+            # the part file from an earlier call has to be read once
+            with open(part_filename, "rb") as file:
+                for data in iter(lambda: file.read(1024 * 1024), b""):
+                    hasher.update(data)
+        if resume_from > 0:
+            logger.info(f"Resuming download of {part_filename} from byte {resume_from}")
+            response.close()
+            response = get_range_response(
+                api_url,
+                headers,
+                resume_from,
+                retry_policy=retry_policy,
+                if_range=if_range,
+            )
+            if response is None:
+                return DownloadResult(status="failed")
+    if extractor is None and sink is None and resume_from == 0 and accepts_ranges:
+        save_part_info(part_filename, validators, total)
+
+    resume_attempts = 0
+    while True:
+        if (
+            resume_from > 0
+            and response.status_code == 206
+            and not is_matching_range(response, resume_from, total)
+        ):
+            logger.warning(
+                f"Content-Range '{response.headers.get('Content-Range')}' does not "
+                f"match byte {resume_from} of {downloaded_file_name}, "
+                "requesting whole file"
+            )
+            response.close()
+            response = get_response(api_url, headers=headers, retry_policy=retry_policy)
+            if response is None:
+                return DownloadResult(status="failed")
+        if resume_from > 0 and response.status_code != 206:
+            if sink is not None:
+                logger.critical(
+                    f"Server ignored the Range request, cannot resume {downloaded_file_name} "
+                    "after bytes were passed to the sink"
+                )
+                response.close()
+                return DownloadResult(status="failed")
+            logger.warning("Server ignored the Range request, downloading whole file")
+            resume_from = 0
+            if hasher is not None:
+                hasher.reset()
+            if extractor is not None:
+                # members that were already extracted will be overwritten
+                extractor.abort()
+                extractor = StreamingZipExtractor(download_path)
+        try:
+            chunks = iter_response_chunks(
+                response, chunk_size, adaptive=adaptive_chunk_size
+            )
+            if hasher is not None:
+                chunks = hasher.iter_chunks(chunks)
+            if reporter is not None:
+                reporter.start(
+                    downloaded_file_name,
+                    resume_from,
+                    get_content_total(response, resume_from),
+                )
+                chunks = reporter.iter_chunks(chunks)
+            if extractor is not None:
+                logger.info(f"Extracting download into {download_path}")
+                for data in chunks:
+                    extractor.write(data)
+                extractor.close()
+            elif sink is not None:
+                logger.info(f"Streaming download of {downloaded_file_name} to sink")
+                for data in chunks:
+                    sink.write(data)
+            else:
+                logger.info(f"Saving download as {download_filename}")
+                with open(part_filename, "ab" if resume_from > 0 else "wb") as file:
+                    for data in chunks:
+                        file.write(data)
+            break
+        except StreamingZipError as exc:
+            logger.warning(
+                f"Cannot extract {downloaded_file_name} while streaming: {exc}"
+            )
+            extractor.abort()
+            response.close()
+            return _fetch_from_url(
+                api_url,
+                headers,
+                download_path,
+                filename,
+                max_resume_attempts,
+                chunk_size,
+                adaptive_chunk_size,
+                False,
+                cache,
+                file_id,
+                retry_policy,
+                sink,
+                checksums,
+                hash_algorithms,
+                stats,
+                reporter,
+                zip_filename,
+            )
+        except zipfile.BadZipFile as exc:
+            logger.critical(f"Error extracting {downloaded_file_name}: {exc}")
+            extractor.abort()
+            return DownloadResult(status="failed")
+        except (
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ConnectionError,
+        ) as exc:
+            logger.critical(f"Download of {download_filename} interrupted: {exc}")
+            if not accepts_ranges or resume_attempts >= max_resume_attempts:
+                return DownloadResult(status="failed")
+        except IOError as ex:
+            if sink is not None:
+                logger.critical(f"IOError writing {downloaded_file_name} to sink: {ex}")
+                return DownloadResult(status="failed")
+            logger.critical(f"IOError opening {download_filename} for writing: {ex}")
+            if extractor is not None:
+                extractor.abort()
+            return DownloadResult(status="failed")
+        finally:
+            # return the connection to the session pool
+            response.close()
+
+        resume_attempts += 1
+        if stats is not None:
+            stats["resumes"] = resume_attempts
+        if extractor is not None:
+            resume_from = extractor.bytes_received
+        elif sink is not None:
+            resume_from = sink.bytes_written
+        else:
+            resume_from = os.path.getsize(part_filename)
+        logger.info(
+            f"Resuming download of {download_filename} from byte {resume_from}, "
+            f"attempt {resume_attempts} of {max_resume_attempts}"
+        )
+        response = get_range_response(
+            api_url, headers, resume_from, retry_policy=retry_policy, if_range=if_range
+        )
+        if response is None:
+            return DownloadResult(status="failed")
+
+    hashes = None
+    cache_sha256 = None
+    mismatches = []
+    if hasher is not None:
+        digests = hasher.hexdigests()
+        cache_sha256 = digests.get("sha256")
+        hashes = {
+            algorithm: digests[algorithm] for algorithm in sorted(requested_algorithms)
+        } or None
+        mismatches = hasher.get_mismatches(checksums)
+        if mismatches:
+            logger.critical(
+                f"Checksum mismatch for {downloaded_file_name} from {api_url}: "
+                + ", ".join(
+                    f"{algorithm} {hashes[algorithm]} != {checksums[algorithm]}"
+                    for algorithm in mismatches
+                )
+            )
+
+    if extractor is not None:
+        logger.info(
+            f"Extracted {len(extractor.members)} files ({extractor.bytes_written} bytes) "
+            f"from {extractor.bytes_received} byte zip stream, "
+            f"peak disk usage = {extractor.bytes_written} bytes"
+        )
+        if stats is not None:
+            stats["bytes"] = extractor.bytes_received
+        if mismatches:
+            return DownloadResult(status="checksum mismatch", hashes=hashes)
+        return DownloadResult(
+            path=str(download_path), status="downloaded", hashes=hashes
+        )
+
+    if sink is not None:
+        sink.close()
+        if sink.bytes_written == 0:
+            logger.critical("content-length is 0 and it should not be")
+            return DownloadResult(status="failed")
+        logger.debug(f"Download size = {sink.bytes_written}")
+        if stats is not None:
+            stats["bytes"] = sink.bytes_written
+        if mismatches:
+            return DownloadResult(status="checksum mismatch", hashes=hashes)
+        return DownloadResult(
+            path=downloaded_file_name, status="downloaded", hashes=hashes
+        )
+
+    if mismatches:
+        remove_part_files(part_filename)
+        return DownloadResult(status="checksum mismatch", hashes=hashes)
+
+    os.replace(part_filename, download_filename)
+    remove_part_files(part_filename)
+    total_downloaded = os.path.getsize(download_filename)
     if total_downloaded == 0:
         logger.critical("content-length is 0 and it should not be")
-        return None
+        return DownloadResult(status="failed")
     logger.debug(f"Download size = {total_downloaded}")
+    if stats is not None:
+        stats["bytes"] = total_downloaded
+
+    if cache is not None:
+        cache.store(
+            cache_key,
+            download_filename,
+            api_url=api_url,
+            file_id=file_id,
+            sha256=cache_sha256,
+            **validators,
+        )
+
+    return DownloadResult(path=download_filename, status="downloaded", hashes=hashes)
+
+
+def download_from_url(
+    api_url: str,
+    headers=None,
+    download_path: str = ".",
+    filename: str = None,
+    max_resume_attempts: int = DEFAULT_MAX_RESUME_ATTEMPTS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    adaptive_chunk_size: bool = False,
+    extract_zip: bool = False,
+    retry_policy: RetryPolicy = None,
+    sink=None,
+    checksums: Dict[str, str] = None,
+    progress: Callable = None,
+) -> str:
+    """
+    Retrieve data file (study_id or file_id) from url.
+    Save the file based on the filename in the Content-Disposition response header.
+    See fetch_from_url for resumed downloads, streaming extraction, sinks
+    and checksums.
+
+    Args:
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        download_path (str): path for saving downloaded zip file
+        filename (str): filename to save downloaded files to, default is to get a
+          filename by parsing response headers.
+        max_resume_attempts (int): number of times to resume an interrupted download
+        chunk_size (int): number of bytes read from the response and written to
+            file at a time
+        adaptive_chunk_size (bool): if True then start with chunk_size and
+            grow or shrink it based on the observed throughput
+        extract_zip (bool): if True then extract zip files while downloading
+        retry_policy (RetryPolicy): if set then retry requests that time out or fail
+            with a retryable status, default is no retries
+        sink: file-like object, generator or callable to receive the downloaded
+            bytes instead of a file, see DownloadSink
+        checksums (Dict): expected hex digests of the file by algorithm,
+            verified while the file downloads
+        progress (Callable): called with a FileProgress as the file downloads,
+            see heal.progress
+
+    Returns:
+        path to downloaded and renamed file,
+        or download_path if a zip file was extracted while downloading,
+        or the name of the file if it was passed to a sink,
+        None if the download failed or does not match the checksums.
+    """
+    return fetch_from_url(
+        api_url,
+        headers=headers,
+        download_path=download_path,
+        filename=filename,
+        max_resume_attempts=max_resume_attempts,
+        chunk_size=chunk_size,
+        adaptive_chunk_size=adaptive_chunk_size,
+        extract_zip=extract_zip,
+        retry_policy=retry_policy,
+        sink=sink,
+        checksums=checksums,
+        progress=progress,
+    ).path
+
+
+def iter_response_chunks(
+    response: requests.Response, chunk_size: int, adaptive: bool = False
+):
+    """
+    Iterate over the content of a streaming response.
+
+    In adaptive mode the chunk size is doubled when chunks arrive faster than
+    ADAPTIVE_CHUNK_SECONDS, and halved when they arrive much slower, within
+    MIN_CHUNK_SIZE and MAX_CHUNK_SIZE. Larger chunks on fast connections mean
+    fewer Python-level iterations and file writes per byte.
+
+    In a download run by a DownloadScheduler with a bandwidth limit, reading
+    the chunks waits for the scheduler's token bucket.
+
+    Args:
+        response (requests.Response): streaming response
+        chunk_size (int): bytes per chunk, or the initial bytes per chunk if adaptive
+        adaptive (bool): adjust the chunk size to the observed throughput
+
+    Returns:
+        iterator of chunks of bytes
+    """
+    if adaptive:
+        chunks = iter_adaptive_chunks(response, chunk_size)
+    else:
+        chunks = response.iter_content(chunk_size)
+    bandwidth_limiter = getattr(_scheduler_state, "bandwidth_limiter", None)
+    if bandwidth_limiter is not None:
+        chunks = iter_throttled_chunks(chunks, bandwidth_limiter)
+    return chunks
+
+
+def iter_throttled_chunks(chunks, bandwidth_limiter: "TokenBucket"):
+    """Yield chunks, waiting for the bandwidth limiter after each one"""
+    for data in chunks:
+        yield data
+        bandwidth_limiter.consume(len(data))
+
+
+def iter_adaptive_chunks(response: requests.Response, chunk_size: int):
+    """Yield chunks of a streaming response with an adaptive chunk size"""
+    chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    while True:
+        # iter_content continues from the current position in the stream
+        last_chunk_time = time.perf_counter()
+        for data in response.iter_content(chunk_size):
+            yield data
+            now = time.perf_counter()
+            elapsed = now - last_chunk_time
+            last_chunk_time = now
+            if elapsed < ADAPTIVE_CHUNK_SECONDS / 2 and chunk_size < MAX_CHUNK_SIZE:
+                chunk_size = chunk_size * 2
+                break
+            if elapsed > ADAPTIVE_CHUNK_SECONDS * 2 and chunk_size > MIN_CHUNK_SIZE:
+                chunk_size = chunk_size // 2
+                break
+        else:
+            return
+        logger.debug(f"Adaptive chunk size set to {chunk_size}")
+
+
+def get_range_response(
+    api_url: str,
+    headers,
+    resume_from: int,
+    retry_policy: RetryPolicy = None,
+    if_range: str = None,
+) -> requests.Response:
+    """
+    Request the remainder of a file, starting at byte resume_from.
+    Falls back to requesting the whole file if the Range request fails.
+
+    Args:
+        api_url (str): url for QDR or Harvard API
+        headers (Dict): request headers
+        resume_from (int): first byte to request
+        retry_policy (RetryPolicy): if set then retry failed requests
+        if_range (str): ETag or Last-Modified date of the partial file, so that
+            the server sends the whole file if it has changed
+
+    Returns:
+        response, None if there are errors
+    """
+    range_headers = {**(headers or {}), "Range": f"bytes={resume_from}-"}
+    if if_range is not None:
+        range_headers["If-Range"] = if_range
+    response = get_response(api_url, headers=range_headers, retry_policy=retry_policy)
+    if response is None:
+        logger.warning("Range request failed, requesting whole file")
+        response = get_response(api_url, headers=headers, retry_policy=retry_policy)
+    return response
+
+
+def get_part_filename(download_filename: str, api_url: str) -> str:
+    """
+    Get the name of the part file of a download.
+
+    Part files are keyed by the url as well as the filename, so that a part
+    file of another url with the same filename is never resumed.
+
+    Args:
+        download_filename (str): path of the downloaded file
+        api_url (str): download url
+
+    Returns:
+        path of the part file, '<download_filename>.<url hash>.part'
+    """
+    url_hash = hashlib.sha1(api_url.encode()).hexdigest()[:16]
+    return f"{download_filename}.{url_hash}.part"
+
+
+def get_range_validator(validators: Dict) -> Optional[str]:
+    """
+    Get the If-Range value for resuming a download.
+
+    Args:
+        validators (Dict): 'etag' and 'last_modified' headers of the response
+
+    Returns:
+        the ETag if it is a strong ETag, else the Last-Modified date or None
+    """
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def save_part_info(part_filename: str, validators: Dict, total: Optional[int]):
+    """
+    Save the If-Range validator and size of a download next to its part file,
+    for resuming the download in a later call.
+
+    Args:
+        part_filename (str): path of the part file
+        validators (Dict): 'etag' and 'last_modified' headers of the response
+        total (int): size of the whole file, None if not known
+    """
+    info = {"if_range": get_range_validator(validators), "total": total}
+    try:
+        with open(f"{part_filename}.json", "w") as file:
+            json.dump(info, file)
+    except IOError as exc:
+        logger.warning(f"Cannot save the download info of {part_filename}: {exc}")
+
+
+def is_resumable_part(
+    part_filename: str, validators: Dict, total: Optional[int]
+) -> bool:
+    """
+    Check that a part file from an earlier call is part of the current file.
+
+    Args:
+        part_filename (str): path of the part file
+        validators (Dict): 'etag' and 'last_modified' headers of the response
+        total (int): size of the whole file from the response, None if not known
+
+    Returns:
+        True if the validator and size saved with the part file match the response
+    """
+    try:
+        with open(f"{part_filename}.json") as file:
+            info = json.load(file)
+    except (IOError, ValueError):
+        return False
+    if_range = get_range_validator(validators)
+    return (
+        isinstance(info, dict)
+        and if_range is not None
+        and info.get("if_range") == if_range
+        and info.get("total") == total
+    )
+
+
+def is_matching_range(
+    response: requests.Response, resume_from: int, total: Optional[int]
+) -> bool:
+    """
+    Check that a '206 Partial Content' response continues the part file.
+
+    Args:
+        response (requests.Response): response to a Range request
+        resume_from (int): first byte requested
+        total (int): size of the whole file, None if not known
+
+    Returns:
+        True if the Content-Range starts at resume_from and has the expected total
+    """
+    content_range = response.headers.get("Content-Range", "")
+    unit, _, byte_range = content_range.partition(" ")
+    first_last, _, range_total = byte_range.partition("/")
+    first = first_last.partition("-")[0]
+    if unit != "bytes" or not first.isdigit() or int(first) != resume_from:
+        return False
+    return total is None or not range_total.isdigit() or int(range_total) == total
+
+
+def remove_part_files(part_filename: str):
+    """Remove a part file and its download info"""
+    for path in [part_filename, f"{part_filename}.json"]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_host(api_url: str) -> str:
+    """
+    Get the host (scheme and network location) of a url.
+
+    Args:
+        api_url (str): url
+
+    Returns:
+        host as string, eg 'https://data.qdr.syr.edu'
+    """
+    parsed_url = urlparse(api_url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def download_concurrently(
+    download_function: Callable,
+    jobs: Dict,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+) -> Dict:
+    """
+    Run download jobs on a bounded thread pool with a per-host concurrency limit.
+
+    Jobs are interleaved across hosts so that workers waiting on a busy host
+    do not hold up jobs for other hosts.
+
+    Args:
+        download_function (Callable): function called as download_function(**job)
+            for each job. Should return a status string, eg "downloaded" or "failed".
+        jobs (Dict): map of object id to a dict of keyword arguments for
+            download_function. Each job must include an 'api_url' key.
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+
+    Returns:
+        Dict of object id to the status returned by download_function
+    """
+    jobs_by_host = {}
+    for object_id, job in jobs.items():
+        jobs_by_host.setdefault(get_host(job["api_url"]), []).append(object_id)
+    host_limits = {
+        host: threading.BoundedSemaphore(max(1, max_per_host)) for host in jobs_by_host
+    }
+
+    # round-robin over hosts
+    ordered_ids = []
+    host_queues = list(jobs_by_host.values())
+    while host_queues:
+        for queue in host_queues:
+            ordered_ids.append(queue.pop(0))
+        host_queues = [queue for queue in host_queues if queue]
+
+    def run_job(object_id: str) -> str:
+        job = jobs[object_id]
+        with host_limits[get_host(job["api_url"])]:
+            try:
+                return download_function(**job)
+            except Exception as exc:
+                logger.critical(f"Error in download job for {object_id}: {exc}")
+                return "failed"
+
+    logger.debug(
+        f"Downloading {len(ordered_ids)} objects with max_workers={max_workers}, "
+        f"max_per_host={max_per_host}"
+    )
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            object_id: executor.submit(run_job, object_id) for object_id in ordered_ids
+        }
+        for object_id, future in futures.items():
+            results[object_id] = future.result()
+
+    return results
+
+
+def run_download_jobs(
+    download_function: Callable,
+    jobs: Dict,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    scheduler: "DownloadScheduler" = None,
+) -> Dict:
+    """
+    Run download jobs with a shared scheduler if there is one, otherwise with
+    download_concurrently.
+
+    Args:
+        download_function (Callable): function taking the job kwargs and
+            returning a status string
+        jobs (Dict): kwargs for download_function by id, each with an 'api_url'
+        max_workers (int): maximum number of concurrent downloads without a scheduler
+        max_per_host (int): maximum number of concurrent downloads per host
+            without a scheduler
+        scheduler (DownloadScheduler): shared scheduler for the jobs
+
+    Returns:
+        Dict of status string by id
+    """
+    if scheduler is not None:
+        return scheduler.run(download_function, jobs)
+    return download_concurrently(
+        download_function, jobs, max_workers=max_workers, max_per_host=max_per_host
+    )
+
+
+def get_datafile_batches(jobs: Dict, batch_size: int) -> Tuple[Dict, Dict]:
+    """
+    Group Dataverse file downloads into batches for the /datafiles endpoint.
+
+    Jobs for '<base>/datafile/<numeric id>' urls are grouped by base url and
+    'external_oidc_idp', in batches of up to batch_size ids. Jobs with a
+    'filename' or checksums in their metadata, other urls, and groups of one
+    stay single jobs, since files in a batch zip cannot be renamed or verified
+    while they download.
+
+    Args:
+        jobs (Dict): download job kwargs by id, with 'api_url' and 'file_metadata'
+        batch_size (int): maximum number of files in a batch
+
+    Returns:
+        Tuple of Dict of batches by batch url, each a Dict of job by id,
+        and Dict of the remaining single jobs by id
+    """
+    groups = {}
+    single_jobs = {}
+    for id, job in jobs.items():
+        base_url, separator, file_id = job["api_url"].rpartition("/datafile/")
+        file_metadata = job.get("file_metadata", {})
+        if (
+            not separator
+            or not file_id.isdigit()
+            or "filename" in file_metadata
+            or get_checksums(file_metadata)
+        ):
+            single_jobs[id] = job
+            continue
+        key = (base_url, file_metadata.get("external_oidc_idp"))
+        groups.setdefault(key, []).append((id, file_id, job))
+
+    batches = {}
+    for (base_url, _), group in groups.items():
+        for start in range(0, len(group), max(1, batch_size)):
+            batch = group[start : start + batch_size]
+            if len(batch) == 1:
+                id, _, job = batch[0]
+                single_jobs[id] = job
+                continue
+            batch_url = (
+                f"{base_url}/datafiles/{','.join(file_id for _, file_id, _ in batch)}"
+            )
+            batches[batch_url] = {id: job for id, _, job in batch}
+    return batches, single_jobs
+
+
+def download_datafile_batches(
+    download_batch: Callable,
+    jobs: Dict,
+    batch_size: int,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    scheduler: "DownloadScheduler" = None,
+    **kwargs,
+) -> Tuple[Dict, Dict]:
+    """
+    Download Dataverse files in /datafiles batches, see get_datafile_batches.
+
+    Files in a failed batch are returned as single jobs, so that each file gets
+    its own status when it is downloaded on its own.
+
+    Args:
+        download_batch (Callable): function taking api_url, ids, file_metadata
+            and kwargs, and returning "downloaded" if every file was downloaded
+        jobs (Dict): download job kwargs by id, with 'api_url' and 'file_metadata'
+        batch_size (int): maximum number of files in a batch
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        scheduler (DownloadScheduler): if set then run the batches with the
+            scheduler instead of max_workers and max_per_host
+        kwargs: passed to download_batch
+
+    Returns:
+        Tuple of Dict of status by id for files downloaded in batches,
+        and Dict of jobs by id still to be downloaded one at a time
+    """
+    batches, single_jobs = get_datafile_batches(jobs, batch_size)
+    batch_jobs = {
+        batch_url: {
+            "api_url": batch_url,
+            "ids": list(batch),
+            "file_metadata": next(iter(batch.values()))["file_metadata"],
+            **kwargs,
+        }
+        for batch_url, batch in batches.items()
+    }
+    results = run_download_jobs(
+        download_batch, batch_jobs, max_workers, max_per_host, scheduler
+    )
+
+    statuses = {}
+    for batch_url, status in results.items():
+        if status == "downloaded":
+            statuses.update({id: status for id in batches[batch_url]})
+        else:
+            logger.warning(
+                f"Batch download {batch_url} failed, "
+                f"downloading {len(batches[batch_url])} files one at a time"
+            )
+            single_jobs.update(batches[batch_url])
+    return statuses, single_jobs
+
+
+def download_datafile_batch(
+    api_url: str,
+    ids: List[str],
+    headers=None,
+    download_path: str = ".",
+    unpack_workers: int = 1,
+    retry_policy: RetryPolicy = None,
+) -> str:
+    """
+    Download a Dataverse /datafiles zip file and unpack it.
+
+    Dataverse leaves files that cannot be downloaded, eg restricted files, out of
+    the zip file, so the batch fails unless there is a file for every id.
+
+    Args:
+        api_url (str): '<base>/datafiles/<id1>,<id2>,...' url
+        ids (List[str]): ids of the files in the batch
+        headers (Dict): request headers
+        download_path (str): path to download files and unpack
+        unpack_workers (int): number of threads for unpacking the zip file
+        retry_policy (RetryPolicy): backoff and retries for failed requests
+
+    Returns:
+        status string: "downloaded" or "failed"
+    """
+    # a unique name, batches share the 'dataverse_files.zip' filename
+    zip_filename = f"datafiles_{hashlib.sha1(api_url.encode()).hexdigest()[:16]}.zip"
+    result = fetch_from_url(
+        api_url,
+        headers=headers,
+        download_path=download_path,
+        filename=zip_filename,
+        retry_policy=retry_policy,
+    )
+    if result.path is None:
+        return "failed"
+
+    try:
+        with zipfile.ZipFile(result.path, "r") as package:
+            files = [
+                member
+                for member in package.infolist()
+                if not member.is_dir() and member.filename != DATAVERSE_MANIFEST
+            ]
+        if len(files) < len(ids):
+            logger.warning(
+                f"Batch download {api_url} has {len(files)} of {len(ids)} files"
+            )
+            return "failed"
+        # every batch zip has a manifest, which was not requested
+        unpackage_object(
+            result.path, max_workers=unpack_workers, exclude={DATAVERSE_MANIFEST}
+        )
+    except Exception as e:
+        logger.critical(
+            f"Batch download {api_url} had an issue while being unpackaged: {e}"
+        )
+        return "failed"
+    finally:
+        Path(result.path).unlink()
+
+    logger.info(f"Downloaded {len(ids)} files from {api_url}")
+    return "downloaded"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens are added at rate per second, up to capacity. A consumer may take
+    more tokens than are available, leaving a debt that it waits out, so
+    concurrent consumers share the rate without busy waiting.
+
+    Args:
+        rate (float): tokens added per second
+        capacity (float): maximum tokens, the allowed burst, default is rate
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float = 1):
+        """Take amount tokens, waiting until they are available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last_time) * self.rate
+            )
+            self._last_time = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def wait_for_request_limiter(api_url: str):
+    """Wait for the per-host request rate limit of the scheduler running this download"""
+    request_limiters = getattr(_scheduler_state, "request_limiters", None)
+    if request_limiters is not None:
+        request_limiters(get_host(api_url)).consume(1)
+
+
+def get_content_length(api_url: str, headers: Dict = None) -> Optional[int]:
+    """
+    Get the size of a download from the Content-Length of a HEAD request.
+
+    Args:
+        api_url (str): download url
+        headers (Dict): request headers, eg an Authorization header
+
+    Returns:
+        size in bytes, None if the size is not known
+    """
+    try:
+        wait_for_request_limiter(api_url)
+        response = get_session(api_url).head(
+            api_url,
+            headers=headers,
+            allow_redirects=True,
+            timeout=DEFAULT_REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+    except Exception as exc:
+        logger.debug(f"Could not get size of {api_url}: {exc}")
+        return None
+
+
+class DownloadScheduler:
+    """
+    Run download jobs from several retrievers under shared limits.
+
+    Jobs submitted with run(), from any number of threads, share max_workers
+    threads, max_per_host concurrent downloads per host, a token bucket limit on
+    the total bandwidth, and a request rate limit per host. With shortest_first
+    the pending jobs are ordered by expected size, from HEAD request
+    Content-Length, so that small files are not stuck behind large ones. Jobs
+    without a known size, eg Dataverse studies that are zipped on request, run
+    after the jobs with known sizes, in the order they were submitted. Jobs
+    with an 'auth', eg QDR jobs that get an access token when they run, have
+    no HEAD request since it would not be authorized.
+
+    Usage:
+        scheduler = DownloadScheduler(bandwidth=50 * 1024 * 1024, requests_per_second=5)
+        get_harvard_dataverse_files(..., scheduler=scheduler)
+        get_mpd_files(..., scheduler=scheduler)
+
+    Args:
+        max_workers (int): maximum number of concurrent downloads
+        max_per_host (int): maximum number of concurrent downloads per host
+        bandwidth (float): maximum total bytes per second, None for no limit
+        requests_per_second (float): maximum requests per second to each host,
+            None for no limit
+        shortest_first (bool): run jobs with the smallest Content-Length first
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        bandwidth: float = None,
+        requests_per_second: float = None,
+        shortest_first: bool = True,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max(1, max_per_host)
+        self.shortest_first = shortest_first
+        self.bandwidth_limiter = TokenBucket(bandwidth) if bandwidth else None
+        self.requests_per_second = requests_per_second
+        self._request_limiters = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._host_running = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop the worker threads once the running jobs finish"""
+        self._executor.shutdown(wait=True)
+
+    def get_request_limiter(self, host: str) -> TokenBucket:
+        """Get the request rate limiter for a host"""
+        with self._lock:
+            if host not in self._request_limiters:
+                self._request_limiters[host] = TokenBucket(
+                    self.requests_per_second, capacity=1
+                )
+            return self._request_limiters[host]
+
+    def get_expected_sizes(self, jobs: Dict) -> Dict:
+        """
+        Get the expected download size of each job from a HEAD request, sent
+        with the job 'headers' if any. Jobs with an 'auth' are skipped.
+
+        Args:
+            jobs (Dict): job kwargs by id, each with an 'api_url'
+
+        Returns:
+            Dict of size in bytes, or None if not known, by id
+        """
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, initializer=self._set_request_limiters
+        ) as executor:
+            futures = {
+                id: executor.submit(
+                    get_content_length, job["api_url"], job.get("headers")
+                )
+                for id, job in jobs.items()
+                if job.get("auth") is None
+            }
+            sizes = {id: future.result() for id, future in futures.items()}
+        return {id: sizes.get(id) for id in jobs}
+
+    def run(self, download_function: Callable, jobs: Dict) -> Dict:
+        """
+        Run download jobs and wait for them to finish, see download_concurrently.
+
+        Args:
+            download_function (Callable): function taking the job kwargs and
+                returning a status string
+            jobs (Dict): kwargs for download_function by id, each with an 'api_url'
+
+        Returns:
+            Dict of status string by id, in the order of jobs
+        """
+        sizes = self.get_expected_sizes(jobs) if self.shortest_first else {}
+        futures = {}
+        with self._lock:
+            for id, job in jobs.items():
+                size = sizes.get(id)
+                order = (size is None, size or 0, next(self._sequence))
+                future = Future()
+                # orders are unique, so the jobs themselves are never compared
+                bisect.insort(
+                    self._pending, (order, (id, download_function, job, future))
+                )
+                futures[id] = future
+            self._dispatch()
+        return {id: future.result() for id, future in futures.items()}
+
+    def _set_request_limiters(self):
+        """Apply the per-host request rate limits to requests in this thread"""
+        if self.requests_per_second:
+            _scheduler_state.request_limiters = self.get_request_limiter
+
+    def _dispatch(self):
+        """Start pending jobs while there are free workers, called with the lock held"""
+        index = 0
+        while self._running < self.max_workers and index < len(self._pending):
+            id, download_function, job, future = self._pending[index][1]
+            host = get_host(job["api_url"])
+            if self._host_running.get(host, 0) >= self.max_per_host:
+                index += 1
+                continue
+            del self._pending[index]
+            self._running += 1
+            self._host_running[host] = self._host_running.get(host, 0) + 1
+            self._executor.submit(
+                self._run_job, id, download_function, job, future, host
+            )
 
-    return download_filename
+    def _run_job(
+        self,
+        id: str,
+        download_function: Callable,
+        job: Dict,
+        future: Future,
+        host: str,
+    ):
+        _scheduler_state.bandwidth_limiter = self.bandwidth_limiter
+        self._set_request_limiters()
+        status = "failed"
+        error = None
+        try:
+            status = download_function(**job)
+        except Exception as exc:
+            logger.critical(f"Error in download job for {id}: {exc}")
+        except BaseException as exc:
+            # eg KeyboardInterrupt, passed on so that run() does not wait forever
+            error = exc
+            raise
+        finally:
+            _scheduler_state.bandwidth_limiter = None
+            _scheduler_state.request_limiters = None
+            with self._lock:
+                self._running -= 1
+                self._host_running[host] -= 1
+                self._dispatch()
+            if error is None:
+                future.set_result(status)
+            else:
+                future.set_exception(error)
@@ -1,4 +1,8 @@
-from heal.vlmd.validate.validate import vlmd_validate, ExtractionError
+from heal.vlmd.validate.validate import (
+    vlmd_validate,
+    vlmd_validate_many,
+    ExtractionError,
+)
 
 # place 'extract' import after 'validate' import
 from heal.vlmd.extract.extract import vlmd_extract
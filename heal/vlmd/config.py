@@ -17,6 +17,8 @@ ALLOWED_FILE_TYPES = [
 ]
 ALLOWED_SCHEMA_TYPES = ["auto", "csv", "json", "tsv"]
 ALLOWED_OUTPUT_TYPES = ["csv", "json"]
+# validator backends, see heal.vlmd.validate.utils.get_validator
+ALLOWED_VALIDATOR_BACKENDS = ["fast", "jsonschema"]
 
 # schemas
 schema_dir_path = Path(__file__).parents[1].joinpath("vlmd/schemas")
@@ -17,8 +17,7 @@ from heal.vlmd.extract.conversion import convert_to_vlmd
 from heal.vlmd.extract.csv_dict_conversion import RedcapExtractionError
 from heal.vlmd.file_utils import get_output_filepath, write_vlmd_dict
 from heal.vlmd.validate.validate import file_type_to_fxn_map
-from heal.vlmd.utils import add_types_to_props
-from heal.vlmd.validate.utils import get_schema
+from heal.vlmd.validate.utils import get_schema, get_validator, validate_instance
 
 
 logger = get_logger("extract", log_level="info")
@@ -251,15 +250,14 @@ def vlmd_extract(
 
         schema_type = "csv"
         schema = get_schema(converted_dictionary, schema_type=output_type)
-        if output_type == "csv":
-            schema = add_types_to_props(schema)
         if schema is None:
             message = f"Could not get schema for type = {schema_type}"
             logger.error(message)
             raise ValueError(message)
+        validator = get_validator(schema, add_missing_types=output_type == "csv")
         try:
             logger.debug(f"Validating converted dictionary")
-            jsonschema.validate(instance=converted_dictionary, schema=schema)
+            validate_instance(validator, converted_dictionary)
         except jsonschema.ValidationError as err:
             logger.error("Error in validating converted dictionary")
             raise err
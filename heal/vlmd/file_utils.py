@@ -6,7 +6,7 @@ from pathlib import Path
 import pandas as pd
 from cdislogging import get_logger
 
-from heal.vlmd.config import OUTPUT_FILE_PREFIX
+from heal.vlmd.config import ALLOWED_INPUT_TYPES, OUTPUT_FILE_PREFIX
 
 logger = get_logger("vlmd-file-utils", log_level="info")
 
@@ -86,3 +86,21 @@ def write_vlmd_dict(dictionary, output_filepath, file_type="auto"):
 
     logger.warning(f"Unknown file type {file_type}")
     return None
+
+
+def get_input_files(input_dir, pattern="*"):
+    """
+    Get the dictionary files in a directory.
+
+    Args:
+        input_dir (str): directory to search
+        pattern (str): glob pattern relative to input_dir, eg "**/*.csv"
+
+    Returns:
+        sorted list of paths of the files with an allowed input type suffix
+    """
+    return sorted(
+        path
+        for path in Path(input_dir).glob(pattern)
+        if path.is_file() and path.suffix.replace(".", "") in ALLOWED_INPUT_TYPES
+    )
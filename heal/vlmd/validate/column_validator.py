@@ -0,0 +1,242 @@
+"""
+Column-wise validation of csv style dictionaries.
+
+A csv dictionary is a list of field records with the same keys, validated
+against an array schema such as CSV_SCHEMA. Instead of validating every record,
+each column is checked once against the schema of its property with pandas
+operations: required columns, types, enums, patterns and anyOf. Records with a
+value that may be invalid are flagged, and only the flagged records are
+validated by the row validator, so errors are the same as validating the whole
+list.
+
+The column checks are conservative: a value passes only if it is certainly
+valid, eg only builtin str, int, float and bool values are type checked.
+Schemas with keywords that have no column check flag every record.
+
+Usage:
+    flagged = find_flagged_rows(pd.DataFrame(records, dtype=object), item_schema)
+"""
+
+import re
+from typing import List
+
+import numpy as np
+import pandas as pd
+from cdislogging import get_logger
+
+logger = get_logger("column-validator", log_level="info")
+
+# shorter lists are faster to validate row by row
+MIN_COLUMN_VALIDATION_ROWS = 50
+
+# keywords checked for a column of values
+COLUMN_KEYWORDS = {"type", "enum", "pattern", "anyOf"}
+# keywords without a validation check, the schemas do not set a format_checker
+ANNOTATIONS = {
+    "$schema",
+    "$id",
+    "$comment",
+    "title",
+    "description",
+    "examples",
+    "default",
+    "version",
+    "additionalDescription",
+    "format",
+}
+
+TYPE_CLASSES = {
+    "string": (str,),
+    "boolean": (bool,),
+    "null": (type(None),),
+    "array": (list,),
+    "object": (dict,),
+    "number": (int, float),
+    # float values are also integers if they have no fraction, see below
+    "integer": (int,),
+}
+
+
+def is_column_data(instance) -> bool:
+    """
+    Check if data can be validated by column: a list of dicts with the same keys.
+    """
+    if not isinstance(instance, list) or len(instance) < MIN_COLUMN_VALIDATION_ROWS:
+        return False
+    if not all(type(record) is dict for record in instance):
+        return False
+    keys = instance[0].keys()
+    return all(record.keys() == keys for record in instance)
+
+
+def is_records_schema(schema) -> bool:
+    """Check if a schema is an array schema with an 'items' schema, eg for csv data"""
+    return (
+        isinstance(schema, dict)
+        and schema.get("type") == "array"
+        and isinstance(schema.get("items"), dict)
+        and set(schema) <= {"type", "items"} | ANNOTATIONS
+    )
+
+
+class Column:
+    """
+    Values of a column, factorized by type and by string value, so each check
+    of a type or string runs once per distinct value.
+
+    Args:
+        values (pd.Series): object series of the column values
+    """
+
+    def __init__(self, values: pd.Series):
+        self.values = values
+        self.type_codes, types = pd.factorize(values.map(type))
+        self.types = {value_type: code for code, value_type in enumerate(types)}
+        self.is_string = self.is_type(str)
+        self.string_codes, self.strings = pd.factorize(values[self.is_string])
+
+    def __len__(self):
+        return len(self.values)
+
+    def is_type(self, value_type) -> np.ndarray:
+        """Get a boolean array, True for values of exactly value_type"""
+        code = self.types.get(value_type)
+        if code is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.type_codes == code
+
+    def check_strings(self, check) -> np.ndarray:
+        """Get a boolean array, True for strings where check(value) is True"""
+        result = np.zeros(len(self), dtype=bool)
+        checked = np.array([bool(check(value)) for value in self.strings], dtype=bool)
+        result[self.is_string] = checked[self.string_codes]
+        return result
+
+
+def check_column(column: Column, schema) -> np.ndarray:
+    """
+    Check the values of a column against a property schema.
+
+    Args:
+        column (Column): column values
+        schema: property schema
+
+    Returns:
+        boolean array, True for values that are certainly valid
+    """
+    if schema is True or schema == {}:
+        return np.ones(len(column), dtype=bool)
+    if not isinstance(schema, dict) or not set(schema) <= COLUMN_KEYWORDS | ANNOTATIONS:
+        return np.zeros(len(column), dtype=bool)
+
+    valid = np.ones(len(column), dtype=bool)
+
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        valid_type = np.zeros(len(column), dtype=bool)
+        for type_name in types:
+            for type_class in TYPE_CLASSES.get(type_name, ()):
+                valid_type |= column.is_type(type_class)
+            if type_name == "integer":
+                is_float = column.is_type(float)
+                if is_float.any():
+                    valid_type[is_float] |= [
+                        value.is_integer() for value in column.values[is_float]
+                    ]
+        valid &= valid_type
+
+    if "enum" in schema:
+        enum = schema["enum"]
+        strings = {value for value in enum if isinstance(value, str)}
+        valid_enum = column.check_strings(lambda value: value in strings)
+        if None in enum:
+            valid_enum |= column.is_type(type(None))
+        valid &= valid_enum
+
+    if "pattern" in schema:
+        pattern = re.compile(schema["pattern"])
+        valid &= column.check_strings(pattern.search) | ~column.is_string
+
+    if "anyOf" in schema:
+        valid_any = np.zeros(len(column), dtype=bool)
+        for subschema in schema["anyOf"]:
+            valid_any |= check_column(column, subschema)
+        valid &= valid_any
+
+    return valid
+
+
+def find_flagged_rows(frame: pd.DataFrame, schema: dict) -> np.ndarray:
+    """
+    Find the rows of a csv style dictionary that may not be valid.
+
+    Args:
+        frame (pd.DataFrame): object frame of the records, one column per key
+        schema (dict): schema of one record, eg CSV_SCHEMA
+
+    Returns:
+        boolean array, True for rows to validate by row
+    """
+    rows = len(frame)
+    object_keywords = {
+        "type",
+        "required",
+        "properties",
+        "patternProperties",
+        "additionalProperties",
+    }
+    if not isinstance(schema, dict) or not set(schema) <= object_keywords | ANNOTATIONS:
+        return np.ones(rows, dtype=bool)
+    if schema.get("type", "object") != "object":
+        return np.ones(rows, dtype=bool)
+    if any(name not in frame.columns for name in schema.get("required", [])):
+        return np.ones(rows, dtype=bool)
+
+    properties = schema.get("properties", {})
+    pattern_properties = {
+        re.compile(pattern): subschema
+        for pattern, subschema in schema.get("patternProperties", {}).items()
+    }
+    additional = schema.get("additionalProperties", True)
+
+    valid = np.ones(rows, dtype=bool)
+    for name in frame.columns:
+        subschemas = [properties[name]] if name in properties else []
+        subschemas += [
+            subschema
+            for pattern, subschema in pattern_properties.items()
+            if pattern.search(name)
+        ]
+        if not subschemas:
+            subschemas = [additional]
+        column = Column(frame[name])
+        for subschema in subschemas:
+            valid &= check_column(column, subschema)
+            if not valid.any():
+                return ~valid
+    return ~valid
+
+
+def iter_record_errors(validator, records: List[dict]):
+    """
+    Iterate over the errors of a list of records, validating only the flagged
+    records with the validator.
+
+    Args:
+        validator: validator of an array schema with an 'items' schema
+        records (list): records with the same keys
+
+    Yields:
+        ValidationError with the same paths as validator.iter_errors(records)
+    """
+    # object dtype keeps the values, eg None is not converted to NaN
+    frame = pd.DataFrame(records, columns=list(records[0]), dtype=object)
+    flagged = np.flatnonzero(find_flagged_rows(frame, validator.schema["items"]))
+    logger.debug(f"Validating {len(flagged)} of {len(records)} records by row")
+    if len(flagged) == 0:
+        return
+    for error in validator.iter_errors([records[index] for index in flagged]):
+        # errors of the records are in the path of their index in the sublist
+        if error.path:
+            error.path[0] = int(flagged[error.path[0]])
+        yield error
@@ -0,0 +1,353 @@
+"""
+Code-generated validators for the VLMD schemas.
+
+A schema is compiled into the source of a Python module with one function per
+subschema, each returning True if the data is valid, in the style of
+fastjsonschema. The source is generated in each process that uses it, and a
+copy is saved in a cache directory, keyed by a hash of the schema, the
+validator class and the generator version. Only the source generated in memory
+is run: a cached source is compared with it to skip writing the same source
+again, and is never executed, so files written to the cache directory cannot
+change the code that runs.
+
+The generated code answers pass/fail only. When data is not valid the error
+is found by the jsonschema validator, so a FastValidator raises the same
+errors, with the same messages and paths, as the jsonschema validator.
+
+Only the keywords used by the VLMD schemas are compiled: type, enum, pattern,
+properties, patternProperties, additionalProperties, required, items,
+propertyNames and anyOf. Schemas with other validation keywords, eg $ref,
+cannot be compiled and raise UnsupportedSchemaError.
+
+Usage:
+    validator = FastValidator(schema)
+    errors = list(validator.iter_errors(data))
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import jsonschema
+from cdislogging import get_logger
+
+logger = get_logger("fast-validator", log_level="info")
+
+# change when the generated code changes, to ignore sources cached by older versions
+GENERATOR_VERSION = 2
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "heal" / "validators"
+
+# validator classes with the same semantics for the compiled keywords
+SUPPORTED_VALIDATORS = (
+    jsonschema.validators.Draft7Validator,
+    jsonschema.validators.Draft201909Validator,
+    jsonschema.validators.Draft202012Validator,
+)
+
+COMPILED_KEYWORDS = {
+    "type",
+    "enum",
+    "pattern",
+    "properties",
+    "patternProperties",
+    "additionalProperties",
+    "required",
+    "items",
+    "propertyNames",
+    "anyOf",
+    # only checked with a format_checker, which the validators do not use
+    "format",
+}
+
+TYPE_CHECKS = {
+    "array": "isinstance({x}, list)",
+    "boolean": "isinstance({x}, bool)",
+    "integer": (
+        "((isinstance({x}, int) and not isinstance({x}, bool))"
+        " or (isinstance({x}, float) and {x}.is_integer()))"
+    ),
+    "null": "{x} is None",
+    "number": "(isinstance({x}, Number) and not isinstance({x}, bool))",
+    "object": "isinstance({x}, dict)",
+    "string": "isinstance({x}, str)",
+}
+
+
+class UnsupportedSchemaError(ValueError):
+    pass
+
+
+class SchemaCompiler:
+    """
+    Generate the source of a validation module for a schema.
+
+    Args:
+        schema (dict): schema to compile
+        validator_class: jsonschema validator class for the schema, the
+            validation keywords of the class that are not compiled make
+            the schema unsupported
+
+    Attributes:
+        source (str): module source, with a 'validate' function
+    """
+
+    def __init__(self, schema, validator_class):
+        if validator_class not in SUPPORTED_VALIDATORS:
+            raise UnsupportedSchemaError(
+                f"Cannot compile schemas for {validator_class.__name__}"
+            )
+        self._keywords = set(validator_class.VALIDATORS)
+        self._constants = []
+        self._functions = []
+        root = self._compile(schema)
+        self.source = "\n".join(
+            [
+                f"# generated by heal.vlmd.validate.fast_validator {GENERATOR_VERSION}",
+                "import re",
+                "from numbers import Number",
+                "from jsonschema._utils import equal",
+                "",
+                *self._constants,
+                "",
+                *self._functions,
+                f"validate = {root}",
+                "",
+            ]
+        )
+
+    def _constant(self, expression: str) -> str:
+        name = f"_c{len(self._constants)}"
+        self._constants.append(f"{name} = {expression}")
+        return name
+
+    def _compile(self, schema) -> str:
+        """Add a function for a subschema and return its name"""
+        index = len(self._functions)
+        name = f"_v{index}"
+        # reserve the slot, the subschemas of this schema are added after it
+        self._functions.append(None)
+        if schema is True or schema == {}:
+            body = []
+        elif schema is False:
+            body = ["return False"]
+        elif isinstance(schema, dict):
+            body = self._compile_keywords(schema)
+        else:
+            raise UnsupportedSchemaError(f"Invalid subschema: {schema!r}")
+        lines = [
+            f"def {name}(x):",
+            *(f"    {line}" for line in body),
+            "    return True",
+        ]
+        self._functions[index] = "\n".join(lines) + "\n"
+        return name
+
+    def _compile_keywords(self, schema: dict) -> list:
+        unsupported = set(schema) & (self._keywords - COMPILED_KEYWORDS)
+        if unsupported:
+            raise UnsupportedSchemaError(
+                f"Cannot compile keywords {sorted(unsupported)}"
+            )
+
+        body = []
+        if "type" in schema:
+            types = (
+                schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+            )
+            if any(type not in TYPE_CHECKS for type in types):
+                raise UnsupportedSchemaError(f"Cannot compile type {schema['type']!r}")
+            checks = " or ".join(TYPE_CHECKS[type].format(x="x") for type in types)
+            body.append(f"if not ({checks}): return False")
+
+        if "enum" in schema:
+            enum = schema["enum"]
+            if all(isinstance(value, str) for value in enum):
+                values = self._constant(f"frozenset({sorted(enum)!r})")
+                body.append(
+                    f"if not (isinstance(x, str) and x in {values}): return False"
+                )
+            else:
+                values = self._constant(repr(enum))
+                body.append(
+                    f"if not any(equal(value, x) for value in {values}): return False"
+                )
+
+        if "pattern" in schema:
+            pattern = self._constant(f"re.compile({schema['pattern']!r})")
+            body.append(
+                f"if isinstance(x, str) and not {pattern}.search(x): return False"
+            )
+
+        if "items" in schema:
+            items = schema["items"]
+            if isinstance(items, list):
+                raise UnsupportedSchemaError("Cannot compile tuple items")
+            body.append("if isinstance(x, list):")
+            if items is False:
+                body.append("    if x: return False")
+            else:
+                function = self._compile(items)
+                body.append("    for item in x:")
+                body.append(f"        if not {function}(item): return False")
+
+        object_body = []
+        for property in schema.get("required", []):
+            object_body.append(f"if {property!r} not in x: return False")
+        for property, subschema in schema.get("properties", {}).items():
+            function = self._compile(subschema)
+            object_body.append(
+                f"if {property!r} in x and not {function}(x[{property!r}]): return False"
+            )
+        for pattern, subschema in schema.get("patternProperties", {}).items():
+            regex = self._constant(f"re.compile({pattern!r})")
+            function = self._compile(subschema)
+            object_body.append("for key, value in x.items():")
+            object_body.append(
+                f"    if {regex}.search(key) and not {function}(value): return False"
+            )
+        if "additionalProperties" in schema:
+            object_body.extend(self._compile_additional_properties(schema))
+        if "propertyNames" in schema:
+            function = self._compile(schema["propertyNames"])
+            object_body.append("for key in x:")
+            object_body.append(f"    if not {function}(key): return False")
+        if object_body:
+            body.append("if isinstance(x, dict):")
+            body.extend(f"    {line}" for line in object_body)
+
+        if "anyOf" in schema:
+            functions = [self._compile(subschema) for subschema in schema["anyOf"]]
+            checks = " or ".join(f"{function}(x)" for function in functions)
+            body.append(f"if not ({checks}): return False")
+
+        return body
+
+    def _compile_additional_properties(self, schema: dict) -> list:
+        """Find extra keys the same way as jsonschema find_additional_properties"""
+        additional = schema["additionalProperties"]
+        if additional is True or additional == {}:
+            return []
+        properties = self._constant(
+            f"frozenset({sorted(schema.get('properties', {}))!r})"
+        )
+        patterns = "|".join(schema.get("patternProperties", {}))
+        condition = f"key not in {properties}"
+        if patterns:
+            regex = self._constant(f"re.compile({patterns!r})")
+            condition += f" and not {regex}.search(key)"
+        if additional is False:
+            return [
+                "for key in x:",
+                f"    if {condition}: return False",
+            ]
+        function = self._compile(additional)
+        return [
+            "for key, value in x.items():",
+            f"    if {condition} and not {function}(value): return False",
+        ]
+
+
+def get_schema_key(schema: dict, validator_class) -> str:
+    """Get the cache key for the compiled source of a schema"""
+    content = json.dumps(
+        [GENERATOR_VERSION, validator_class.__name__, schema], sort_keys=True
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_cached_source(source_path: Path):
+    """Read a cached source, or None if it is not cached"""
+    try:
+        return source_path.read_text()
+    except OSError:
+        return None
+
+
+def save_cached_source(source: str, source_path: Path):
+    """Save a generated source, logging a warning if it cannot be saved"""
+    cache_dir = source_path.parent
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, suffix=".tmp", delete=False
+        ) as file:
+            file.write(source)
+        os.replace(file.name, source_path)
+        logger.debug(f"Saved compiled validator to {source_path}")
+    except OSError as exc:
+        logger.warning(f"Could not save compiled validator in {cache_dir}: {exc}")
+
+
+def exec_validation_function(source: str, source_path: Path):
+    """Run a generated source and get its validation function"""
+    namespace = {}
+    exec(compile(source, str(source_path), "exec"), namespace)
+    return namespace["validate"]
+
+
+def load_validation_function(schema: dict, validator_class, cache_dir=None):
+    """
+    Compile the validation function for a schema, and save its source in
+    cache_dir if the cached source is missing or different. The cached
+    source is never run.
+
+    Args:
+        schema (dict): schema to compile
+        validator_class: jsonschema validator class for the schema
+        cache_dir (str): directory for generated sources, default is
+            DEFAULT_CACHE_DIR
+
+    Returns:
+        function returning True if data is valid
+        Raises UnsupportedSchemaError if the schema cannot be compiled or
+        the generated source cannot be loaded.
+    """
+    source = SchemaCompiler(schema, validator_class).source
+    cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+    source_path = cache_dir / f"{get_schema_key(schema, validator_class)}.py"
+    if read_cached_source(source_path) == source:
+        logger.debug(f"Compiled validator matches the cached source {source_path}")
+    else:
+        save_cached_source(source, source_path)
+    try:
+        return exec_validation_function(source, source_path)
+    except Exception as exc:
+        raise UnsupportedSchemaError(
+            f"Could not load compiled validator: {exc}"
+        ) from exc
+
+
+class FastValidator:
+    """
+    Validator using code compiled from the schema to check data, and the
+    jsonschema validator to find the errors in data that is not valid.
+
+    Has the is_valid and iter_errors methods of a jsonschema validator.
+
+    Args:
+        schema (dict): schema, already checked
+        cache_dir (str): directory for generated sources, default is
+            DEFAULT_CACHE_DIR
+
+    Raises:
+        UnsupportedSchemaError: if the schema cannot be compiled
+    """
+
+    def __init__(self, schema: dict, cache_dir=None):
+        self.schema = schema
+        validator_class = jsonschema.validators.validator_for(schema)
+        self.validation_function = load_validation_function(
+            schema, validator_class, cache_dir=cache_dir
+        )
+        self.jsonschema_validator = validator_class(schema)
+
+    def is_valid(self, instance) -> bool:
+        return self.validation_function(instance)
+
+    def iter_errors(self, instance):
+        if self.validation_function(instance):
+            return iter(())
+        return self.jsonschema_validator.iter_errors(instance)
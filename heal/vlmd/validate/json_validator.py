@@ -3,11 +3,10 @@ from os import PathLike
 from pathlib import Path
 from typing import Dict
 
-import jsonschema
 from cdislogging import get_logger
 
 from heal.vlmd.config import ALLOWED_SCHEMA_TYPES
-from heal.vlmd.validate.utils import get_schema
+from heal.vlmd.validate.utils import get_schema, get_validator, validate_instance
 
 logger = get_logger("json-validator", log_level="info")
 
@@ -47,9 +46,9 @@ def vlmd_validate_json(data_or_path, schema_type: str) -> bool:
     if schema is None:
         raise ValueError(f"Could not get schema for type = {schema_type}")
     logger.debug("Checking schema")
-    jsonschema.validators.Draft7Validator.check_schema(schema)
+    validator = get_validator(schema)
 
     logger.debug("Validating data")
-    jsonschema.validate(instance=data, schema=schema)
+    validate_instance(validator, data)
 
     return True
@@ -0,0 +1,154 @@
+"""
+Reports of all the validation errors of a dictionary.
+
+collect_validation_errors gathers the errors of one validation pass, up to a
+maximum count, instead of stopping at the first error, and groups them by the
+field of the dictionary and the property of the field. Each error is the best
+matching error of one schema violation, ie the error raised by validate_instance
+if it were the only violation.
+
+Usage:
+    report = collect_validation_errors(validator, data, max_errors=100)
+    for field, properties in report.fields.items():
+        ...
+"""
+
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from jsonschema.exceptions import best_match
+
+from heal.vlmd.validate.utils import iter_validation_errors
+
+DEFAULT_MAX_ERRORS = 100
+# field key for errors that are not in a field, eg a missing root level property
+ROOT_FIELD = "$"
+
+
+@dataclass
+class ValidationReport:
+    """
+    Errors of a dictionary, grouped by field and property.
+
+    Attributes:
+        valid (bool): True if there are no errors
+        error_count (int): number of errors in the report
+        truncated (bool): True if there were more than max_errors errors
+        errors (List): error records in validation order, with the 'field',
+            'property', 'path', 'validator' and 'message' of each error
+        fields (Dict): error messages by field name and property, fields without
+            a name are keyed by their index, eg 'fields[3]' for json dictionaries
+            or '[3]' for csv dictionaries
+        converted_output: converted dictionary of a valid input, if requested
+    """
+
+    valid: bool = True
+    error_count: int = 0
+    truncated: bool = False
+    errors: List[Dict] = field(default_factory=list)
+    fields: Dict[str, Dict[str, List[str]]] = field(default_factory=dict)
+    converted_output: Any = None
+
+    def add_error(
+        self,
+        message: str,
+        field_name: str = ROOT_FIELD,
+        property: str = ROOT_FIELD,
+        path: Optional[list] = None,
+        validator: Optional[str] = None,
+    ):
+        """Add an error to the report"""
+        self.valid = False
+        self.error_count += 1
+        self.errors.append(
+            {
+                "field": field_name,
+                "property": property,
+                "path": path or [],
+                "validator": validator,
+                "message": message,
+            }
+        )
+        self.fields.setdefault(field_name, {}).setdefault(property, []).append(message)
+
+    def to_dict(self) -> Dict:
+        """Get the report as a json serializable dictionary, without the output"""
+        return {
+            "valid": self.valid,
+            "error_count": self.error_count,
+            "truncated": self.truncated,
+            "errors": self.errors,
+            "fields": self.fields,
+        }
+
+
+def get_error_location(error, instance):
+    """
+    Get the field and the property of a validation error.
+
+    Args:
+        error (ValidationError): error from validating instance
+        instance: the validated dictionary, a json dictionary or a list of csv
+            fields
+
+    Returns:
+        tuple of field name and property name
+    """
+    path = list(error.absolute_path)
+    field_name = ROOT_FIELD
+    if isinstance(instance, list) and path and isinstance(path[0], int):
+        record, field_name, path = instance[path[0]], f"[{path[0]}]", path[1:]
+    elif (
+        isinstance(instance, dict)
+        and len(path) > 1
+        and path[0] == "fields"
+        and isinstance(path[1], int)
+    ):
+        record = instance["fields"][path[1]]
+        field_name, path = f"fields[{path[1]}]", path[2:]
+    else:
+        record = None
+    if isinstance(record, dict) and isinstance(record.get("name"), str):
+        field_name = record["name"] or field_name
+
+    if error.validator == "required" and isinstance(error.instance, dict):
+        missing = [name for name in error.validator_value if name not in error.instance]
+        path = path + missing[:1]
+    property = ".".join(str(part) for part in path) or ROOT_FIELD
+    return field_name, property
+
+
+def collect_validation_errors(
+    validator, instance, max_errors: int = DEFAULT_MAX_ERRORS
+) -> ValidationReport:
+    """
+    Validate data and collect its errors in a report.
+
+    Args:
+        validator: validator from get_validator
+        instance: data to validate
+        max_errors (int): stop after this many errors, None for all errors
+
+    Returns:
+        ValidationReport
+    """
+    report = ValidationReport()
+    errors = iter_validation_errors(validator, instance)
+    limit = None if max_errors is None else max_errors + 1
+    for error in itertools.islice(errors, limit):
+        if max_errors is not None and report.error_count >= max_errors:
+            report.valid = False
+            report.truncated = True
+            break
+        field_name, property = get_error_location(error, instance)
+        # the most relevant error of a violation, as raised by validate_instance
+        error = best_match([error])
+        report.add_error(
+            error.message,
+            field_name=field_name,
+            property=property,
+            path=list(error.absolute_path),
+            validator=error.validator,
+        )
+    return report
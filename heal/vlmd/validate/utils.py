@@ -1,16 +1,35 @@
 import json
 import os
+import threading
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 import charset_normalizer
+import jsonschema
 import pandas as pd
 from cdislogging import get_logger
+from jsonschema.exceptions import best_match
 
-from heal.vlmd.config import CSV_SCHEMA, JSON_SCHEMA
+from heal.vlmd.config import ALLOWED_VALIDATOR_BACKENDS, CSV_SCHEMA, JSON_SCHEMA
+from heal.vlmd.utils import add_types_to_props
+from heal.vlmd.validate.column_validator import (
+    is_column_data,
+    is_records_schema,
+    iter_record_errors,
+)
+from heal.vlmd.validate.fast_validator import FastValidator, UnsupportedSchemaError
 
 logger = get_logger("validate-utils", log_level="info")
 
+CSV_ARRAY_SCHEMA = {"type": "array", "items": CSV_SCHEMA}
+# schemas returned by get_schema, by the schema type in the validator cache key
+VLMD_SCHEMAS = {"csv": CSV_ARRAY_SCHEMA, "json": JSON_SCHEMA}
+
+_validators = {}
+_validators_lock = threading.Lock()
+# default backend and cache directory, see set_validator_backend
+_backend = {"backend": "jsonschema", "cache_dir": None}
+
 
 def detect_file_encoding(file_path):
     """
@@ -88,13 +107,184 @@ def get_schema(data_or_path, schema_type: str):
         raise ValueError("Input should be path or dict or list")
 
     if schema_type == "csv" or (schema_type == "auto" and dictionary_type == "csv"):
-        schema = {"type": "array", "items": CSV_SCHEMA}
+        schema = CSV_ARRAY_SCHEMA
         return schema
     if schema_type == "tsv" or (schema_type == "auto" and dictionary_type == "tsv"):
-        schema = {"type": "array", "items": CSV_SCHEMA}
+        schema = CSV_ARRAY_SCHEMA
         return schema
     if schema_type == "json" or (schema_type == "auto" and dictionary_type == "json"):
         schema = JSON_SCHEMA
         return schema
 
     return None
+
+
+def set_validator_backend(backend: str, cache_dir: str = None):
+    """
+    Set the default backend of get_validator.
+
+    Args:
+        backend (str): "fast" for validators compiled by fast_validator,
+            "jsonschema" for jsonschema validators
+        cache_dir (str): directory for the sources of compiled validators,
+            default is fast_validator.DEFAULT_CACHE_DIR
+
+    Returns:
+        None
+        Raises ValueError for an unknown backend.
+    """
+    if backend not in ALLOWED_VALIDATOR_BACKENDS:
+        raise ValueError(
+            f"Validator backend should be one of {ALLOWED_VALIDATOR_BACKENDS}"
+        )
+    with _validators_lock:
+        _backend.update(backend=backend, cache_dir=cache_dir)
+        _validators.clear()
+
+
+def get_validator_backend() -> Tuple[str, Optional[str]]:
+    """Get the default backend and cache directory set by set_validator_backend"""
+    return _backend["backend"], _backend["cache_dir"]
+
+
+def warm_validators():
+    """Build the cached validators of the VLMD schemas, eg in a worker process"""
+    for schema in VLMD_SCHEMAS.values():
+        for add_missing_types in [False, True]:
+            get_validator(schema, add_missing_types=add_missing_types)
+
+
+def get_validator(schema: dict, add_missing_types: bool = False, backend: str = None):
+    """
+    Get a validator for a schema from get_schema.
+
+    Validators for the VLMD schemas are checked and built once, and cached by
+    (schema type, add_missing_types, backend), so repeated validations skip the
+    schema checks and add_types_to_props. Other schemas are checked and built on
+    every call.
+
+    Args:
+        schema (dict): schema from get_schema
+        add_missing_types (bool): validate csv style data, see add_types_to_props
+        backend (str): "fast" or "jsonschema", default from set_validator_backend
+
+    Returns:
+        jsonschema validator, or FastValidator with the same errors
+        Raises SchemaError if the schema is invalid.
+    """
+    backend = backend or _backend["backend"]
+    schema_type = next(
+        (key for key, vlmd_schema in VLMD_SCHEMAS.items() if vlmd_schema is schema),
+        None,
+    )
+    if schema_type is None:
+        return build_validator(schema, add_missing_types, backend)
+
+    key = (schema_type, add_missing_types, backend)
+    validator = _validators.get(key)
+    if validator is None:
+        with _validators_lock:
+            validator = _validators.get(key)
+            if validator is None:
+                logger.debug(f"Building validator for {key}")
+                validator = build_validator(schema, add_missing_types, backend)
+                _validators[key] = validator
+    return validator
+
+
+def build_validator(
+    schema: dict, add_missing_types: bool = False, backend: str = "jsonschema"
+):
+    """
+    Check a schema and build a validator with the same checks and validator
+    class as jsonschema.validate.
+
+    Schemas that cannot be compiled for the "fast" backend get a jsonschema
+    validator.
+
+    Args:
+        schema (dict): schema
+        add_missing_types (bool): validate csv style data, see add_types_to_props
+        backend (str): "fast" or "jsonschema"
+
+    Returns:
+        jsonschema validator, or FastValidator with the same errors
+        Raises SchemaError if the schema is invalid.
+    """
+    if backend not in ALLOWED_VALIDATOR_BACKENDS:
+        raise ValueError(
+            f"Validator backend should be one of {ALLOWED_VALIDATOR_BACKENDS}"
+        )
+    if add_missing_types:
+        schema = add_types_to_props(schema)
+    jsonschema.validators.Draft7Validator.check_schema(schema)
+    validator_class = jsonschema.validators.validator_for(schema)
+    if validator_class is not jsonschema.validators.Draft7Validator:
+        validator_class.check_schema(schema)
+    if backend == "fast":
+        try:
+            return FastValidator(schema, cache_dir=_backend["cache_dir"])
+        except UnsupportedSchemaError as err:
+            logger.warning(f"Using jsonschema validator: {err}")
+    return validator_class(schema)
+
+
+def build_fast_validators(cache_dir: str = None):
+    """
+    Generate the compiled validators for the VLMD schemas and save their
+    sources in cache_dir, eg when building an image, so later validations
+    do not write them again.
+
+    Args:
+        cache_dir (str): directory for the sources of compiled validators,
+            default is fast_validator.DEFAULT_CACHE_DIR
+
+    Returns:
+        None
+    """
+    for schema in VLMD_SCHEMAS.values():
+        for variant in [schema, add_types_to_props(schema)]:
+            FastValidator(variant, cache_dir=cache_dir or _backend["cache_dir"])
+
+
+def clear_validator_cache():
+    """Remove the cached validators"""
+    with _validators_lock:
+        _validators.clear()
+
+
+def iter_validation_errors(validator, instance):
+    """
+    Iterate over the errors of data, with a validator from get_validator.
+
+    Longer csv style dictionaries, ie lists of records with the same keys, are
+    checked by column and only the flagged records are validated by row, see
+    column_validator.
+
+    Args:
+        validator: jsonschema validator
+        instance: data to validate
+
+    Yields:
+        ValidationError for each error, in the order of validator.iter_errors
+    """
+    if is_column_data(instance) and is_records_schema(validator.schema):
+        return iter_record_errors(validator, instance)
+    return validator.iter_errors(instance)
+
+
+def validate_instance(validator, instance):
+    """
+    Validate data with a validator from get_validator.
+
+    Args:
+        validator: jsonschema validator
+        instance: data to validate
+
+    Returns:
+        None
+        Raises ValidationError with the best matching error if data is not valid.
+    """
+    error = best_match(iter_validation_errors(validator, instance))
+    if error is not None:
+        raise error
@@ -1,6 +1,10 @@
+import functools
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from os.path import isfile
 from pathlib import Path
+from typing import Dict, Iterable, Iterator
 
 import jsonschema
 from cdislogging import get_logger
@@ -14,16 +18,40 @@ from heal.vlmd.config import (
 )
 from heal.vlmd.extract.conversion import convert_to_vlmd
 from heal.vlmd.extract.csv_dict_conversion import RedcapExtractionError
-from heal.vlmd.utils import add_types_to_props
-from heal.vlmd.validate.utils import get_schema, read_data_from_json_file, read_delim
+from heal.vlmd.validate.report import DEFAULT_MAX_ERRORS, collect_validation_errors
+from heal.vlmd.validate.utils import (
+    get_schema,
+    get_validator,
+    get_validator_backend,
+    read_data_from_json_file,
+    read_delim,
+    set_validator_backend,
+    validate_instance,
+    warm_validators,
+)
 
 logger = get_logger("vlmd-validate-extract", log_level="info")
 
+# files sent to a worker process at a time by vlmd_validate_many
+DEFAULT_VALIDATION_CHUNKSIZE = 8
+
 
 class ExtractionError(Exception):
     pass
 
 
+def log_report(report):
+    """Log the result of a collect_errors validation"""
+    if report.valid:
+        logger.info("Dictionary is valid")
+        return
+    more = " or more" if report.truncated else ""
+    logger.error(
+        f"Found {report.error_count}{more} validation errors "
+        f"in {len(report.fields)} fields"
+    )
+
+
 file_type_to_fxn_map = {
     "csv": "csv-data-dict",
     "dataset_csv": "csv-data-set",
@@ -40,6 +68,8 @@ def vlmd_validate(
     schema_type="auto",
     output_type="json",
     return_converted_output=False,
+    collect_errors=False,
+    max_errors=DEFAULT_MAX_ERRORS,
 ):
     """
     Validates the input file against a VLMD schema.
@@ -58,11 +88,16 @@ def vlmd_validate(
             The default is "json".
         return_converted_output (bool): set to True to get converted output, else
             get a boolean for valid/invalid input.
+        collect_errors (bool): set to True to get a ValidationReport with all the
+            validation errors instead of raising the first ValidationError.
+        max_errors (int): maximum number of errors in the report, None for all.
 
     Returns:
         True if input is valid and return_converted_output=False.
         Returns a dictionary if input is valid and return_converted_output=True,
             where dictionary is converted if csv and dictionary is raw input if json.
+        Returns a ValidationReport if collect_errors=True, with the converted
+            output of a valid input if return_converted_output=True.
         Raises ValidationError if the input VLMD is not valid.
         Raises ValueError for unallowed input file types or unallowed schema types.
         Raises SchemaError if the schema is invalid.
@@ -118,14 +153,11 @@ def vlmd_validate(
         logger.error(message)
         raise ValueError(message)
 
-    if file_suffix in ["csv", "tsv"]:
-        schema = add_types_to_props(schema)
-    jsonschema.validators.Draft7Validator.check_schema(schema)
+    validator = get_validator(schema, add_missing_types=file_suffix in ["csv", "tsv"])
 
     # read the input file
     if file_suffix in ["csv", "tsv"]:
-        data = read_delim(input_file).to_dict(orient="records")
-        if len(data) == 0:
+        if len(read_delim(input_file)) == 0:
             message = "Could not read csv data from input"
             logger.error(message)
             raise ValidationError(message)
@@ -135,8 +167,14 @@ def vlmd_validate(
     # if input is json then try a validation and return input
     if file_suffix == "json":
         logger.debug("Validating json data")
+        if collect_errors:
+            report = collect_validation_errors(validator, data, max_errors)
+            log_report(report)
+            if report.valid and return_converted_output:
+                report.converted_output = data
+            return report
         try:
-            jsonschema.validate(instance=data, schema=schema)
+            validate_instance(validator, data)
         except jsonschema.ValidationError as err:
             logger.error("Error in validating json input")
             raise err
@@ -185,19 +223,22 @@ def vlmd_validate(
         file_suffix == "tsv" and output_type == "csv"
     ):
         schema = get_schema(converted_dictionary, schema_type=output_type)
-        if output_type == "csv":
-            schema = add_types_to_props(schema)
         if schema is None:
             message = f"Could not get schema for type = {schema_type}"
             logger.error(message)
             raise ValueError(message)
+        validator = get_validator(schema, add_missing_types=output_type == "csv")
 
-    try:
-        logger.debug(f"Validating converted dictionary")
-        jsonschema.validate(instance=converted_dictionary, schema=schema)
-    except jsonschema.ValidationError as err:
-        logger.error(f"Validation Error: {str(err.message)}")
-        raise err
+    if collect_errors:
+        logger.debug(f"Collecting errors of converted dictionary")
+        report = collect_validation_errors(validator, converted_dictionary, max_errors)
+    else:
+        try:
+            logger.debug(f"Validating converted dictionary")
+            validate_instance(validator, converted_dictionary)
+        except jsonschema.ValidationError as err:
+            logger.error(f"Validation Error: {str(err.message)}")
+            raise err
 
     # Special check not covered by jsonschema.validate: required props in csv output
     if output_type == "csv":
@@ -207,7 +248,19 @@ def vlmd_validate(
             if field not in existing_fields:
                 message = f"'{field}' is a required property in csv dictionaries"
                 logger.error(message)
-                raise Exception(message)
+                if not collect_errors:
+                    raise Exception(message)
+                if max_errors is not None and report.error_count >= max_errors:
+                    report.valid = False
+                    report.truncated = True
+                    break
+                report.add_error(message, property=field, validator="required")
+
+    if collect_errors:
+        log_report(report)
+        if report.valid and return_converted_output:
+            report.converted_output = converted_dictionary
+        return report
 
     logger.info("Converted dictionary is valid")
 
@@ -215,3 +268,100 @@ def vlmd_validate(
         return converted_dictionary
     else:
         return True
+
+
+def get_validation_result(input_file, **kwargs) -> Dict:
+    """
+    Validate a file with vlmd_validate and get the result as a json serializable
+    dictionary.
+
+    Args:
+        input_file (str): the path of the input HEAL VLMD file.
+        kwargs: options of vlmd_validate
+
+    Returns:
+        dictionary with the 'input_file' and 'valid', and the 'error_type' and
+        'message' of an error. With collect_errors=True the ValidationReport is
+        added, see ValidationReport.to_dict.
+    """
+    result = {"input_file": str(input_file)}
+    try:
+        outcome = vlmd_validate(input_file, **kwargs)
+    except ValidationError as err:
+        result.update(valid=False, error_type=type(err).__name__, message=err.message)
+    except Exception as err:
+        result.update(valid=False, error_type=type(err).__name__, message=str(err))
+    else:
+        if kwargs.get("collect_errors"):
+            result.update(outcome.to_dict())
+        else:
+            result["valid"] = True
+    return result
+
+
+def init_validation_worker(
+    backend: str, cache_dir: str, disabled_level: int = logging.NOTSET
+):
+    """
+    Set up a vlmd_validate_many worker process with warm validators, and with
+    the logging of the parent process disabled up to the same level.
+    """
+    logging.disable(disabled_level)
+    set_validator_backend(backend, cache_dir=cache_dir)
+    warm_validators()
+
+
+def vlmd_validate_many(
+    input_files: Iterable,
+    workers: int = None,
+    file_type="auto",
+    schema_type="auto",
+    output_type="json",
+    collect_errors=False,
+    max_errors=DEFAULT_MAX_ERRORS,
+    chunksize: int = DEFAULT_VALIDATION_CHUNKSIZE,
+) -> Iterator[Dict]:
+    """
+    Validate many input files in a pool of worker processes.
+
+    Each worker builds the validators once and validates its share of the files
+    with vlmd_validate. Errors are returned in the results instead of raised.
+    Logging disabled with logging.disable is also disabled in the workers.
+
+    Args:
+        input_files (Iterable): paths of the input HEAL VLMD files.
+        workers (int): number of worker processes, default is the cpu count.
+            With 1 the files are validated in this process.
+        file_type (str): the type of the input files, see vlmd_validate.
+        schema_type (str): the type of the schema, see vlmd_validate.
+        output_type (str): format of the converted dictionaries, see vlmd_validate.
+        collect_errors (bool): set to True to add a ValidationReport of all the
+            errors of each file to its result.
+        max_errors (int): maximum number of errors in a report, None for all.
+        chunksize (int): number of files sent to a worker at a time.
+
+    Returns:
+        iterator of the result of each file, in the order of input_files,
+            see get_validation_result
+    """
+    validate_file = functools.partial(
+        get_validation_result,
+        file_type=file_type,
+        schema_type=schema_type,
+        output_type=output_type,
+        collect_errors=collect_errors,
+        max_errors=max_errors,
+    )
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        warm_validators()
+        yield from map(validate_file, input_files)
+        return
+
+    logger.info(f"Validating files with {workers} worker processes")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_validation_worker,
+        initargs=(*get_validator_backend(), logging.root.manager.disable),
+    ) as executor:
+        yield from executor.map(validate_file, input_files, chunksize=chunksize)
@@ -9,7 +9,25 @@ from heal.vlmd.config import (
     JSON_SCHEMA,
     JSON_SCHEMA_VERSION,
 )
+from heal.utils import clear_token_cache
 from heal.vlmd.utils import clean_json_fields
+from heal.vlmd.validate.utils import set_validator_backend
+
+
+@pytest.fixture(autouse=True)
+def empty_token_cache():
+    """Start each test without cached idp tokens"""
+    clear_token_cache()
+    yield
+    clear_token_cache()
+
+
+@pytest.fixture(autouse=True, scope="session")
+def validator_cache_dir(tmp_path_factory):
+    """Save compiled validators in a temporary directory"""
+    cache_dir = tmp_path_factory.mktemp("validators")
+    set_validator_backend("jsonschema", cache_dir=cache_dir)
+    return cache_dir
 
 
 @pytest.fixture()
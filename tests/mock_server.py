@@ -0,0 +1,428 @@
+"""
+A local stand-in http server for exercising the download functions against real
+sockets, without reaching external repositories.
+"""
+
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class MockDownloadServer:
+    """
+    Serve in-memory files over http on localhost.
+
+    Files are served from GET /files/<name> with a Content-Disposition header
+    so that downloads are saved as <name>. HEAD /files/<name> returns the
+    Content-Length of the file.
+
+    Usage:
+        with MockDownloadServer(files={"a.txt": b"foo"}, latency=0.1) as server:
+            download_from_url(f"{server.url}/files/a.txt", download_path=tmp_path)
+
+    Args:
+        files (Dict): map of file name to file content (bytes)
+        latency (float): seconds to wait before sending each response
+        accept_ranges (bool): advertise 'Accept-Ranges: bytes' and answer
+            Range requests with 206 responses, unless an If-Range header does
+            not match the file
+        interruptions (int): number of responses to cut off after sending
+            interrupt_after bytes of the body
+        interrupt_after (int): number of body bytes to send before dropping
+            an interrupted connection
+        validators (bool): send ETag and Last-Modified headers and answer
+            matching conditional requests with '304 Not Modified'
+        failures (List[int]): error status codes to answer the first requests with,
+            one per request, before serving files normally
+        retry_after (str): Retry-After header value sent with the failures
+        bandwidth (int): if set then limit each response body to this many bytes
+            per second
+    """
+
+    def __init__(
+        self,
+        files: dict = None,
+        latency: float = 0.0,
+        accept_ranges: bool = False,
+        interruptions: int = 0,
+        interrupt_after: int = 0,
+        validators: bool = False,
+        failures: list = None,
+        retry_after: str = None,
+        bandwidth: int = None,
+    ):
+        self.files = files or {}
+        self.latency = latency
+        self.accept_ranges = accept_ranges
+        self.interruptions = interruptions
+        self.interrupt_after = interrupt_after
+        self.validators = validators
+        self.failures = list(failures or [])
+        self.retry_after = retry_after
+        self.bandwidth = bandwidth
+        self.request_times = []
+        self.requests = []
+        self.range_headers = []
+        self.if_range_headers = []
+        self.status_codes = []
+        self.request_count = 0
+        self.max_concurrent_requests = 0
+        self._concurrent_requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def get_file(self, path: str):
+        """
+        Get the file to serve for a request path.
+
+        Returns:
+            Tuple of file name, content and content type, None if there is no file
+        """
+        name = path.split("?")[0].rsplit("/", 1)[-1]
+        if not path.startswith("/files/") or name not in self.files:
+            return None
+        return name, self.files[name], "application/octet-stream"
+
+    def get_failure(self):
+        """Get the error status code to answer the next request with, or None"""
+        return self.failures.pop(0) if self.failures else None
+
+    def _write_body(self, wfile, body: bytes):
+        if not self.bandwidth:
+            wfile.write(body)
+            return
+        chunk_size = max(1, self.bandwidth // 20)
+        for start in range(0, len(body), chunk_size):
+            wfile.write(body[start : start + chunk_size])
+            wfile.flush()
+            time.sleep(0.05)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                with server._lock:
+                    server.requests.append(("HEAD", self.path))
+                file = server.get_file(self.path)
+                if file is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(file[1])))
+                self.end_headers()
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests.append(("GET", self.path))
+                    server.request_count += 1
+                    server.request_times.append(time.monotonic())
+                    failure = server.get_failure()
+                    server._concurrent_requests += 1
+                    server.max_concurrent_requests = max(
+                        server.max_concurrent_requests, server._concurrent_requests
+                    )
+                try:
+                    if server.latency:
+                        time.sleep(server.latency)
+                    if failure is not None:
+                        server.status_codes.append(failure)
+                        self.send_response(failure)
+                        if server.retry_after is not None:
+                            self.send_header("Retry-After", server.retry_after)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    file = server.get_file(self.path)
+                    if file is None:
+                        self.send_error(404)
+                        return
+                    name, content, content_type = file
+                    etag = f'"{hashlib.md5(content).hexdigest()}"'
+                    last_modified = "Wed, 01 Jan 2025 00:00:00 GMT"
+                    if server.validators and (
+                        self.headers.get("If-None-Match") == etag
+                        or (
+                            "If-None-Match" not in self.headers
+                            and self.headers.get("If-Modified-Since") == last_modified
+                        )
+                    ):
+                        server.status_codes.append(304)
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    range_header = self.headers.get("Range")
+                    server.range_headers.append(range_header)
+                    # a Range request for a file that changed gets the whole file
+                    if_range = self.headers.get("If-Range")
+                    server.if_range_headers.append(if_range)
+                    start = 0
+                    if (
+                        server.accept_ranges
+                        and range_header
+                        and if_range in (None, etag, last_modified)
+                    ):
+                        start = int(range_header.split("=")[1].split("-")[0])
+                        server.status_codes.append(206)
+                        self.send_response(206)
+                        self.send_header(
+                            "Content-Range",
+                            f"bytes {start}-{len(content) - 1}/{len(content)}",
+                        )
+                    else:
+                        server.status_codes.append(200)
+                        self.send_response(200)
+                    body = content[start:]
+                    self.send_header("Content-Type", content_type)
+                    self.send_header(
+                        "Content-Disposition", f"attachment; filename={name}"
+                    )
+                    if server.accept_ranges:
+                        self.send_header("Accept-Ranges", "bytes")
+                    if server.validators:
+                        self.send_header("ETag", etag)
+                        self.send_header("Last-Modified", last_modified)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    with server._lock:
+                        interrupt = server.interruptions > 0
+                        server.interruptions -= int(interrupt)
+                    if interrupt:
+                        self.wfile.write(body[: server.interrupt_after])
+                        self.wfile.flush()
+                        self.close_connection = True
+                        return
+                    server._write_body(self.wfile, body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client went away
+                    self.close_connection = True
+                finally:
+                    with server._lock:
+                        server._concurrent_requests -= 1
+
+        return Handler
+
+
+class MockRepositoryServer(MockDownloadServer):
+    """
+    Stand-in for the Dataverse API used by QDR and Harvard Dataverse, and the MPD API.
+
+    Endpoints:
+        GET /api/access/datafile/<file_id>: a file
+        GET /api/access/datafiles/<file_id>,<file_id>: zip file of the files
+            and a MANIFEST.TXT
+        GET /api/access/dataset/:persistentId/?persistentId=<study_id>: zip file
+            of the files in a study
+        GET /api/files/<file_id>: file metadata with the MD5 checksum
+        GET /api/datasets/:persistentId/versions/:latest/files?persistentId=<study_id>:
+            the files in a study
+        GET /api/projects/<project_symbol>/dataset?csv=yes and
+        GET /api/pheno/animalvals/<measure_id>?csv=yes: MPD CSV data
+
+    Latency, bandwidth, ranges, validators and failures work as in MockDownloadServer.
+    Use dataverse_url and mpd_url in place of the retrievers' download url functions.
+
+    Usage:
+        datafiles = make_payloads(100, 64 * 1024)
+        with MockRepositoryServer(datafiles=datafiles, latency=0.01) as server:
+            with mock.patch(
+                "heal.harvard_downloads.get_download_url_for_harvard_dataverse",
+                server.dataverse_url,
+            ):
+                get_harvard_dataverse_files(None, None, file_metadata_list, tmp_path)
+
+    Args:
+        datafiles (Dict): file content (bytes) by file id
+        studies (Dict): list of file ids by study id
+        mpd (Dict): CSV content (bytes) by project symbol or measure id
+        failure_rate (float): fraction of requests answered with a 503 error
+        seed (int): seed for the random failures
+        kwargs: MockDownloadServer args, eg latency or bandwidth
+    """
+
+    def __init__(
+        self,
+        datafiles: dict = None,
+        studies: dict = None,
+        mpd: dict = None,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.datafiles = datafiles or {}
+        self.studies = studies or {}
+        self.mpd = mpd or {}
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._zip_files = {}
+
+    def dataverse_url(self, file_metadata: dict) -> str:
+        """Get the download url of a study or file on this server"""
+        if "study_id" in file_metadata:
+            return (
+                f"{self.url}/api/access/dataset/:persistentId/"
+                f"?persistentId={file_metadata['study_id']}"
+            )
+        if "file_id" in file_metadata:
+            return f"{self.url}/api/access/datafile/{file_metadata['file_id']}"
+        return None
+
+    def mpd_url(self, file_metadata: dict) -> str:
+        """Get the download url of an MPD project or measure on this server"""
+        if "project_symbol" in file_metadata:
+            return (
+                f"{self.url}/api/projects/{file_metadata['project_symbol']}"
+                "/dataset?csv=yes"
+            )
+        if "measure_id" in file_metadata:
+            return (
+                f"{self.url}/api/pheno/animalvals/{file_metadata['measure_id']}?csv=yes"
+            )
+        return None
+
+    def get_failure(self):
+        failure = super().get_failure()
+        if failure is None and self._random.random() < self.failure_rate:
+            failure = 503
+        return failure
+
+    def get_file(self, path: str):
+        url = urlsplit(path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if parts[:3] == ["api", "access", "datafile"] and len(parts) == 4:
+            if parts[3] in self.datafiles:
+                return parts[3], self.datafiles[parts[3]], "application/octet-stream"
+        elif parts[:3] == ["api", "access", "datafiles"] and len(parts) == 4:
+            file_ids = [id for id in parts[3].split(",") if id in self.datafiles]
+            return self._get_zip_file(tuple(file_ids), manifest=True)
+        elif parts[:3] == ["api", "access", "dataset"]:
+            study_id = query.get("persistentId")
+            if study_id in self.studies:
+                return self._get_zip_file(tuple(self.studies[study_id]))
+        elif parts[:2] == ["api", "files"] and len(parts) == 3:
+            content = self.datafiles.get(parts[2])
+            if content is not None:
+                checksum = {"type": "MD5", "value": hashlib.md5(content).hexdigest()}
+                return self._get_json({"data": {"dataFile": {"checksum": checksum}}})
+        elif parts[:2] == ["api", "datasets"] and parts[-1] == "files":
+            study_id = query.get("persistentId")
+            if study_id in self.studies:
+                return self._get_json(
+                    {
+                        "data": [
+                            {"dataFile": {"id": file_id, "persistentId": ""}}
+                            for file_id in self.studies[study_id]
+                        ]
+                    }
+                )
+        elif parts[:2] == ["api", "projects"] and parts[-1] == "dataset":
+            if parts[2] in self.mpd:
+                return f"{parts[2]}.csv", self.mpd[parts[2]], "text/csv"
+        elif parts[:3] == ["api", "pheno", "animalvals"] and len(parts) == 4:
+            if parts[3] in self.mpd:
+                return f"{parts[3]}.csv", self.mpd[parts[3]], "text/csv"
+        return None
+
+    def _get_zip_file(self, file_ids: tuple, manifest: bool = False):
+        if not file_ids:
+            return None
+        with self._lock:
+            content = self._zip_files.get((file_ids, manifest))
+            if content is None:
+                content = make_zip_content(
+                    {f"file_{id}.dat": self.datafiles[id] for id in file_ids},
+                    manifest=manifest,
+                )
+                self._zip_files[(file_ids, manifest)] = content
+        return "dataverse_files.zip", content, "application/zip"
+
+    @staticmethod
+    def _get_json(data: dict):
+        return "metadata.json", json.dumps(data).encode(), "application/json"
+
+
+def make_zip_content(members: dict, manifest: bool = False) -> bytes:
+    """Make the content of a zip file from a dict of member name to content"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as package:
+        for name, data in members.items():
+            package.writestr(name, data)
+        if manifest:
+            package.writestr("MANIFEST.TXT", "\n".join(members))
+    return content.getvalue()
+
+
+def make_payloads(count: int, size: int, seed: int = 0) -> dict:
+    """Make count random payloads of size bytes, by numeric file id"""
+    generator = random.Random(seed)
+    return {str(100 + i): generator.randbytes(size) for i in range(count)}
+
+
+def make_mpd_csv(rows: int, seed: int = 0) -> bytes:
+    """Make MPD-like CSV content with the given number of data rows"""
+    generator = random.Random(seed)
+    lines = ["measnum,varname,strain,sex,animal_id,value"]
+    for row in range(rows):
+        lines.append(
+            f"{47115 + row % 7},bw_{row % 7},C57BL/6J,{'fm'[row % 2]},"
+            f"{row},{generator.uniform(10, 40):.3f}"
+        )
+    return ("\n".join(lines) + "\n").encode()
+
+
+@contextmanager
+def patched_retrievers(server: MockRepositoryServer):
+    """Point the retrievers at the mock server"""
+    with mock.patch(
+        "heal.qdr_downloads.get_download_url_for_qdr", server.dataverse_url
+    ), mock.patch(
+        "heal.harvard_downloads.get_download_url_for_harvard_dataverse",
+        server.dataverse_url,
+    ), mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd", server.mpd_url
+    ), mock.patch(
+        "heal.utils.wts_get_token", return_value="some-idp-token"
+    ):
+        yield
+
+
+def get_file_metadata_list(retriever: str, ids) -> list:
+    """Get a manifest of files for a retriever"""
+    return [
+        {"file_retriever": retriever, "file_id": id, "external_oidc_idp": "test-idp"}
+        for id in ids
+    ]
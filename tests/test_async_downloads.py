@@ -0,0 +1,275 @@
+import asyncio
+import contextlib
+import errno
+import io
+import zipfile
+from unittest import mock
+from unittest.mock import MagicMock
+
+import aiofiles
+import pytest
+from gen3.tools.download.drs_download import DownloadStatus
+
+from heal.async_downloads import (
+    async_download_concurrently,
+    async_download_from_url,
+    async_get_harvard_dataverse_files,
+    async_get_mpd_files,
+    async_get_syracuse_qdr_files,
+)
+from heal.utils import RetryPolicy
+from tests.mock_server import MockDownloadServer
+
+
+def make_zip_content(members):
+    """Make the bytes of a zip file"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as package:
+        for name, data in members.items():
+            package.writestr(name, data)
+    return content.getvalue()
+
+
+def test_async_download_from_url(tmp_path):
+    """Files are saved with the name from the response headers"""
+    content = b"x" * 200000
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        result = asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/data.bin", download_path=tmp_path, chunk_size=8192
+            )
+        )
+        assert result == f"{tmp_path}/data.bin"
+        assert (tmp_path / "data.bin").read_bytes() == content
+
+        result = asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/data.bin",
+                download_path=tmp_path,
+                filename="renamed.bin",
+            )
+        )
+        assert (tmp_path / "renamed.bin").read_bytes() == content
+
+        result = asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/missing.bin", download_path=tmp_path
+            )
+        )
+        assert result is None
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "data.bin",
+        "renamed.bin",
+    ]
+
+
+def test_async_download_from_url_retry(tmp_path):
+    """Throttled requests are retried"""
+    with MockDownloadServer(
+        files={"data.bin": b"content"}, failures=[429, 503], retry_after="0"
+    ) as server:
+        result = asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/data.bin",
+                download_path=tmp_path,
+                retry_policy=RetryPolicy(backoff_factor=0.01),
+            )
+        )
+    assert result == f"{tmp_path}/data.bin"
+    assert server.status_codes == [429, 503, 200]
+
+
+def test_async_download_from_url_cancel(tmp_path):
+    """Cancelling a download removes the partial file"""
+
+    async def cancel_download(server):
+        task = asyncio.create_task(
+            async_download_from_url(
+                f"{server.url}/files/data.bin", download_path=tmp_path, chunk_size=1024
+            )
+        )
+        while not list(tmp_path.glob("data.bin.*.part")):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await task
+
+    with MockDownloadServer(
+        files={"data.bin": b"x" * 1000000}, bandwidth=100000
+    ) as server:
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(cancel_download(server))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_async_download_from_url_write_error(tmp_path):
+    """A failed write removes the partial file"""
+    real_open = aiofiles.open
+
+    @contextlib.asynccontextmanager
+    async def failing_open(path, mode):
+        async with real_open(path, mode) as file:
+            write = file.write
+
+            async def write_and_fail(data):
+                await write(data)
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+            file.write = write_and_fail
+            yield file
+
+    with MockDownloadServer(files={"data.bin": b"x" * 100000}) as server, mock.patch(
+        "heal.async_downloads.aiofiles.open", failing_open
+    ):
+        result = asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/data.bin", download_path=tmp_path
+            )
+        )
+    assert result is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_async_download_concurrently():
+    """Downloads are limited per host and exceptions are failures"""
+    running = {"host_a": 0, "host_b": 0}
+    max_running = {"host_a": 0, "host_b": 0}
+
+    async def download(api_url, host):
+        running[host] += 1
+        max_running[host] = max(max_running[host], running[host])
+        await asyncio.sleep(0.05)
+        running[host] -= 1
+        if api_url.endswith("fail"):
+            raise Exception("download error")
+        return "downloaded"
+
+    jobs = {
+        f"{host}_{i}": {"api_url": f"https://{host}.org/{i}", "host": host}
+        for host in ["host_a", "host_b"]
+        for i in range(4)
+    }
+    jobs["host_a_fail"] = {"api_url": "https://host_a.org/fail", "host": "host_a"}
+    results = asyncio.run(
+        async_download_concurrently(download, jobs, max_workers=4, max_per_host=2)
+    )
+    assert list(results) == list(jobs)
+    assert results.pop("host_a_fail") == "failed"
+    assert set(results.values()) == {"downloaded"}
+    assert max_running == {"host_a": 2, "host_b": 2}
+
+
+def test_async_get_harvard_dataverse_files(tmp_path):
+    """The async retriever returns the same status as the sync retriever"""
+    files = {
+        "harvard_file_01": b"foo",
+        "dataverse_files.zip": make_zip_content({"MANIFEST.TXT": b"manifest"}),
+    }
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": "harvard_file_01"},
+        {"file_retriever": "Dataverse", "study_id": "harvard_study_01"},
+        {"file_retriever": "Dataverse", "file_id": "missing_file"},
+        {"file_retriever": "Dataverse", "missing": "id"},
+    ]
+    urls = {
+        "harvard_file_01": "harvard_file_01",
+        "harvard_study_01": "dataverse_files.zip",
+        "missing_file": "missing_file",
+    }
+    with MockDownloadServer(files=files) as server, mock.patch(
+        "heal.harvard_downloads.get_download_url_for_harvard_dataverse",
+        side_effect=lambda file_metadata: f"{server.url}/files/"
+        + urls[file_metadata.get("file_id") or file_metadata.get("study_id")],
+    ):
+        result = asyncio.run(
+            async_get_harvard_dataverse_files(
+                wts_hostname=None,
+                auth=None,
+                file_metadata_list=file_metadata_list,
+                download_path=tmp_path,
+            )
+        )
+    assert result == {
+        "harvard_file_01": DownloadStatus(
+            filename="harvard_file_01", status="downloaded"
+        ),
+        "harvard_study_01": DownloadStatus(
+            filename="harvard_study_01", status="downloaded"
+        ),
+        "missing_file": DownloadStatus(filename="missing_file", status="failed"),
+    }
+    # the zip file is unpacked and removed
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "MANIFEST.TXT",
+        "harvard_file_01",
+    ]
+
+
+def test_async_get_syracuse_qdr_files(tmp_path):
+    """The async QDR retriever sends the idp token"""
+    file_metadata_list = [
+        {
+            "external_oidc_idp": "test-external-idp",
+            "file_retriever": "QDR",
+            "file_id": "qdr_file_01",
+        },
+        {"file_retriever": "QDR", "file_id": "qdr_file_02", "filename": "qdr.pdf"},
+    ]
+    with MockDownloadServer(
+        files={"qdr_file_01": b"foo", "qdr_file_02": b"bar"}
+    ) as server, mock.patch(
+        "heal.qdr_downloads.get_download_url_for_qdr",
+        side_effect=lambda file_metadata: f"{server.url}/files/{file_metadata['file_id']}",
+    ), mock.patch(
+        "heal.utils.wts_get_token", return_value="some-idp-token"
+    ) as wts_get_token:
+        result = asyncio.run(
+            async_get_syracuse_qdr_files(
+                wts_hostname="test.commons.io",
+                auth=MagicMock(),
+                file_metadata_list=file_metadata_list,
+                download_path=tmp_path,
+            )
+        )
+    assert result == {
+        "qdr_file_01": DownloadStatus(filename="qdr_file_01", status="downloaded"),
+        "qdr_file_02": DownloadStatus(filename="qdr_file_02", status="downloaded"),
+    }
+    assert (tmp_path / "qdr.pdf").read_bytes() == b"bar"
+    assert wts_get_token.call_count == 2
+
+
+def test_async_get_mpd_files(tmp_path):
+    """The async MPD retriever saves csv files"""
+    test_data = b"project_id,strain,value\n1,C57BL/6J,10.5\n"
+    file_metadata_list = [{"file_retriever": "MPD", "project_symbol": "Gould2"}]
+    with MockDownloadServer(files={"Gould2": test_data}) as server, mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd",
+        return_value=f"{server.url}/files/Gould2",
+    ):
+        result = asyncio.run(
+            async_get_mpd_files(
+                wts_hostname="",
+                auth=None,
+                file_metadata_list=file_metadata_list,
+                download_path=tmp_path,
+            )
+        )
+    assert result == {
+        "Gould2": DownloadStatus(filename="Gould2.csv", status="downloaded")
+    }
+    assert (tmp_path / "Gould2.csv").read_bytes() == test_data
+
+
+def test_async_get_mpd_files_invalid_download_path():
+    """Test the download path is checked"""
+    assert (
+        asyncio.run(
+            async_get_mpd_files(
+                wts_hostname="",
+                auth=None,
+                file_metadata_list=[],
+                download_path="/path/does/not/exist",
+            )
+        )
+        is None
+    )
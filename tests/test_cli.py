@@ -1,4 +1,8 @@
+import json
 import os
+import shutil
+import subprocess
+import sys
 
 from click.testing import CliRunner
 
@@ -144,3 +148,77 @@ def test_validate_missing_input_file(tmp_path):
     runner = CliRunner()
     result = runner.invoke(cli_module.main, ["vlmd", "validate"])
     assert result.exit_code != 0
+
+
+def test_validate_input_dir(tmp_path):
+    """Test the cli validation of a directory, with a json line for each file"""
+    for name in ["vlmd_valid.csv", "vlmd_valid.json"]:
+        shutil.copy(f"tests/test_data/vlmd/valid/{name}", tmp_path)
+    shutil.copy("tests/test_data/vlmd/invalid/vlmd_missing_name.json", tmp_path)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_module.main,
+        ["vlmd", "validate", "--input_dir", tmp_path, "--workers", "1"],
+    )
+    assert result.exit_code == 0
+    results = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [
+        (os.path.basename(result["input_file"]), result["valid"]) for result in results
+    ] == [
+        ("vlmd_missing_name.json", False),
+        ("vlmd_valid.csv", True),
+        ("vlmd_valid.json", True),
+    ]
+    assert results[0]["fields"] == {
+        "fields[0]": {"name": ["'name' is a required property"]}
+    }
+
+    result = runner.invoke(
+        cli_module.main,
+        ["vlmd", "validate", "--input_dir", tmp_path, "--glob", "*.csv"],
+    )
+    assert result.exit_code == 0
+    assert len(result.stdout.splitlines()) == 1
+
+
+def test_validate_input_dir_stdout(tmp_path):
+    """Stdout only has the json lines, without the validation logs"""
+    for name in ["vlmd_valid.csv", "vlmd_valid.json"]:
+        shutil.copy(f"tests/test_data/vlmd/valid/{name}", tmp_path)
+    shutil.copy("tests/test_data/vlmd/invalid/vlmd_missing_name.json", tmp_path)
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "heal.cli.heal_cli",
+            "vlmd",
+            "validate",
+            "--input_dir",
+            tmp_path,
+            "--workers",
+            "2",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    results = [json.loads(line) for line in process.stdout.splitlines()]
+    assert [result["valid"] for result in results] == [False, True, True]
+    assert "2 of 3 files are valid" in process.stderr
+
+
+def test_validate_input_file_and_dir(tmp_path):
+    """Test the cli validation with both an input file and directory"""
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_module.main,
+        [
+            "vlmd",
+            "validate",
+            "--input_file",
+            "tests/test_data/vlmd/valid/vlmd_valid.json",
+            "--input_dir",
+            tmp_path,
+        ],
+    )
+    assert result.exit_code != 0
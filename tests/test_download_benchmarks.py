@@ -0,0 +1,294 @@
+"""
+Download benchmarks for the QDR, Harvard Dataverse and MPD retrievers against
+a local MockRepositoryServer, and of the download_from_url chunk sizes,
+reporting files/sec and MB/sec.
+
+The benchmarks need pytest-benchmark and are skipped without it:
+    pip install pytest-benchmark
+    pytest tests/test_download_benchmarks.py --benchmark-columns=mean,rounds
+"""
+
+import asyncio
+import importlib.util
+import itertools
+import os
+from unittest import mock
+
+import pytest
+from gen3.tools.download.drs_download import DownloadStatus
+
+from heal.async_downloads import async_get_harvard_dataverse_files
+from heal.harvard_downloads import get_harvard_dataverse_files
+from heal.mpd_downloads import get_mpd_files
+from heal.qdr_downloads import get_syracuse_qdr_files
+from heal.utils import MIN_CHUNK_SIZE, RetryPolicy, download_from_url
+from tests.mock_server import (
+    MockDownloadServer,
+    MockRepositoryServer,
+    get_file_metadata_list,
+    make_mpd_csv,
+    make_payloads,
+    patched_retrievers,
+)
+
+requires_benchmark = pytest.mark.skipif(
+    importlib.util.find_spec("pytest_benchmark") is None,
+    reason="pytest-benchmark is not installed",
+)
+
+FILE_COUNT = 20
+FILE_SIZE = 256 * 1024
+CHUNK_BENCHMARK_SIZE = 32 * 1024 * 1024
+MPD_ROWS = 20000
+LATENCY = 0.005
+STUDY_ID = "doi:10.5064/F6BENCH"
+
+
+def run_benchmark(benchmark, retrieve, tmp_path, files: int, size: int):
+    """
+    Benchmark a retriever call with a new download path for each round,
+    and record files/sec and MB/sec.
+    """
+    rounds = itertools.count()
+
+    def setup():
+        download_path = tmp_path / f"round_{next(rounds)}"
+        download_path.mkdir()
+        return (download_path,), {}
+
+    result = benchmark.pedantic(retrieve, setup=setup, rounds=5, iterations=1)
+    mean_seconds = benchmark.stats.stats.mean
+    benchmark.extra_info["files_per_second"] = files / mean_seconds
+    benchmark.extra_info["mb_per_second"] = size / 1024**2 / mean_seconds
+    return result
+
+
+def test_mock_repository_server(tmp_path):
+    """The retrievers download from the mock Dataverse and MPD endpoints"""
+    datafiles = make_payloads(4, 1024)
+    mpd = {"Gould2": make_mpd_csv(10), "47115": make_mpd_csv(5)}
+    with MockRepositoryServer(
+        datafiles=datafiles,
+        studies={STUDY_ID: ["100", "101"]},
+        mpd=mpd,
+    ) as server, patched_retrievers(server):
+        qdr_result = get_syracuse_qdr_files(
+            wts_hostname="test.commons.io",
+            auth=mock.MagicMock(),
+            file_metadata_list=get_file_metadata_list("QDR", ["102", "103"]),
+            download_path=tmp_path,
+            batch_size=2,
+            verify_checksums=False,
+        )
+        harvard_result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=[{"file_retriever": "Dataverse", "study_id": STUDY_ID}],
+            download_path=tmp_path,
+        )
+        mpd_result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=[
+                {"file_retriever": "MPD", "project_symbol": "Gould2"},
+                {"file_retriever": "MPD", "measure_id": 47115},
+            ],
+            download_path=tmp_path,
+        )
+    assert set(status.status for status in qdr_result.values()) == {"downloaded"}
+    assert harvard_result == {
+        STUDY_ID: DownloadStatus(filename=STUDY_ID, status="downloaded")
+    }
+    assert set(status.status for status in mpd_result.values()) == {"downloaded"}
+    # one batch request for the QDR files
+    assert [path for method, path in server.requests if "datafiles" in path] == [
+        "/api/access/datafiles/102,103"
+    ]
+    for id in ["100", "101", "102", "103"]:
+        assert (tmp_path / f"file_{id}.dat").read_bytes() == datafiles[id]
+    assert (tmp_path / "Gould2.csv").read_bytes() == mpd["Gould2"]
+
+
+def test_mock_repository_server_failures(tmp_path):
+    """Injected failures are retried, and checksums come from the file metadata"""
+    datafiles = make_payloads(10, 1024)
+    with MockRepositoryServer(
+        datafiles=datafiles, failure_rate=0.3, retry_after="0"
+    ) as server, patched_retrievers(server):
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=get_file_metadata_list("Dataverse", datafiles),
+            download_path=tmp_path,
+            retry_policy=RetryPolicy(max_retries=10, backoff_factor=0.001),
+            verify_checksums=True,
+        )
+    assert set(status.status for status in result.values()) == {"downloaded"}
+    assert 503 in server.status_codes
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(datafiles)
+
+
+@pytest.mark.parametrize("retriever", ["QDR", "Dataverse", "async Dataverse"])
+def test_concurrent_studies(tmp_path, retriever):
+    """Studies downloaded at the same time do not share a zip file"""
+    datafiles = make_payloads(40, 16 * 1024)
+    file_ids = list(datafiles)
+    studies = {f"{STUDY_ID}.{i}": file_ids[i * 5 : i * 5 + 5] for i in range(8)}
+    file_metadata_list = [
+        {"file_retriever": "QDR", "study_id": study_id, "external_oidc_idp": "idp"}
+        for study_id in studies
+    ]
+    with MockRepositoryServer(
+        datafiles=datafiles, studies=studies, latency=LATENCY, bandwidth=4 * 1024**2
+    ) as server, patched_retrievers(server):
+        if retriever == "QDR":
+            result = get_syracuse_qdr_files(
+                "test.commons.io", mock.MagicMock(), file_metadata_list, tmp_path
+            )
+        elif retriever == "Dataverse":
+            result = get_harvard_dataverse_files(
+                None, None, file_metadata_list, tmp_path
+            )
+        else:
+            result = asyncio.run(
+                async_get_harvard_dataverse_files(
+                    None, None, file_metadata_list, tmp_path
+                )
+            )
+    assert [status.status for status in result.values()] == ["downloaded"] * 8
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        f"file_{id}.dat" for id in file_ids
+    )
+    for id in file_ids:
+        assert (tmp_path / f"file_{id}.dat").read_bytes() == datafiles[id]
+
+
+@requires_benchmark
+@pytest.mark.parametrize("batch_size", [1, 10])
+def test_benchmark_qdr_files(benchmark, tmp_path, batch_size):
+    """QDR files, one request per file or in /datafiles batches"""
+    datafiles = make_payloads(FILE_COUNT, FILE_SIZE)
+    file_metadata_list = get_file_metadata_list("QDR", datafiles)
+    with MockRepositoryServer(
+        datafiles=datafiles, latency=LATENCY
+    ) as server, patched_retrievers(server):
+        result = run_benchmark(
+            benchmark,
+            lambda download_path: get_syracuse_qdr_files(
+                wts_hostname="test.commons.io",
+                auth=mock.MagicMock(),
+                file_metadata_list=file_metadata_list,
+                download_path=download_path,
+                batch_size=batch_size,
+            ),
+            tmp_path,
+            files=FILE_COUNT,
+            size=FILE_COUNT * FILE_SIZE,
+        )
+    assert set(status.status for status in result.values()) == {"downloaded"}
+
+
+@requires_benchmark
+@pytest.mark.parametrize("stream_extract", [False, True])
+def test_benchmark_harvard_study(benchmark, tmp_path, stream_extract):
+    """A Harvard Dataverse study zip, unpacked after or while downloading"""
+    datafiles = make_payloads(FILE_COUNT, FILE_SIZE)
+    with MockRepositoryServer(
+        datafiles=datafiles, studies={STUDY_ID: list(datafiles)}, latency=LATENCY
+    ) as server, patched_retrievers(server):
+        result = run_benchmark(
+            benchmark,
+            lambda download_path: get_harvard_dataverse_files(
+                wts_hostname=None,
+                auth=None,
+                file_metadata_list=[
+                    {"file_retriever": "Dataverse", "study_id": STUDY_ID}
+                ],
+                download_path=download_path,
+                stream_extract=stream_extract,
+            ),
+            tmp_path,
+            files=FILE_COUNT,
+            size=FILE_COUNT * FILE_SIZE,
+        )
+    assert result[STUDY_ID].status == "downloaded"
+
+
+@requires_benchmark
+@pytest.mark.parametrize("bandwidth", [None, 4 * 1024 * 1024])
+def test_benchmark_harvard_files(benchmark, tmp_path, bandwidth):
+    """Harvard Dataverse files, with and without a per-response bandwidth limit"""
+    datafiles = make_payloads(FILE_COUNT, FILE_SIZE)
+    file_metadata_list = get_file_metadata_list("Dataverse", datafiles)
+    with MockRepositoryServer(
+        datafiles=datafiles, latency=LATENCY, bandwidth=bandwidth
+    ) as server, patched_retrievers(server):
+        result = run_benchmark(
+            benchmark,
+            lambda download_path: get_harvard_dataverse_files(
+                wts_hostname=None,
+                auth=None,
+                file_metadata_list=file_metadata_list,
+                download_path=download_path,
+            ),
+            tmp_path,
+            files=FILE_COUNT,
+            size=FILE_COUNT * FILE_SIZE,
+        )
+    assert set(status.status for status in result.values()) == {"downloaded"}
+
+
+@requires_benchmark
+def test_benchmark_mpd_files(benchmark, tmp_path):
+    """MPD project CSV files"""
+    symbols = [f"Project{i}" for i in range(FILE_COUNT)]
+    mpd = {symbol: make_mpd_csv(MPD_ROWS, seed=i) for i, symbol in enumerate(symbols)}
+    file_metadata_list = [
+        {"file_retriever": "MPD", "project_symbol": symbol} for symbol in symbols
+    ]
+    with MockRepositoryServer(mpd=mpd, latency=LATENCY) as server, patched_retrievers(
+        server
+    ):
+        result = run_benchmark(
+            benchmark,
+            lambda download_path: get_mpd_files(
+                wts_hostname="",
+                auth=None,
+                file_metadata_list=file_metadata_list,
+                download_path=download_path,
+            ),
+            tmp_path,
+            files=FILE_COUNT,
+            size=sum(len(content) for content in mpd.values()),
+        )
+    assert set(status.status for status in result.values()) == {"downloaded"}
+
+
+@requires_benchmark
+@pytest.mark.parametrize(
+    "chunk_size, adaptive",
+    [
+        (8 * 1024, False),
+        (64 * 1024, False),
+        (1024 * 1024, False),
+        (MIN_CHUNK_SIZE, True),
+    ],
+    ids=["8 KiB", "64 KiB", "1 MiB", "adaptive"],
+)
+def test_benchmark_chunk_size(benchmark, tmp_path, chunk_size, adaptive):
+    """A single large file, read in fixed size or adaptive chunks"""
+    content = make_payloads(1, CHUNK_BENCHMARK_SIZE)["100"]
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        download_filename = run_benchmark(
+            benchmark,
+            lambda download_path: download_from_url(
+                f"{server.url}/files/data.bin",
+                download_path=download_path,
+                chunk_size=chunk_size,
+                adaptive_chunk_size=adaptive,
+            ),
+            tmp_path,
+            files=1,
+            size=len(content),
+        )
+    assert os.path.getsize(download_filename) == len(content)
@@ -0,0 +1,207 @@
+import io
+import zipfile
+
+import requests_mock
+from gen3.tools.download.drs_download import DownloadStatus
+
+from heal.download_plan import DownloadPlan
+from heal.harvard_downloads import (
+    get_harvard_dataverse_files,
+    plan_harvard_dataverse_files,
+)
+from heal.metrics import add_metrics_hook, clear_metrics_hooks
+from heal.mpd_downloads import plan_mpd_files
+
+BASE_URL = "https://dataverse.harvard.edu/api"
+STUDY_ID = "doi:10.7910/DVN/TEST01"
+
+
+def make_zip_content(members):
+    """Make the bytes of a zip file"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as package:
+        for name, data in members.items():
+            package.writestr(name, data)
+    return content.getvalue()
+
+
+def test_download_plan_dedup():
+    """Repeated ids keep one job, the last entry wins if the entries differ"""
+    plan = DownloadPlan("Test")
+    plan.add("a", "a", {"api_url": "https://test.org/a"})
+    plan.add("b", "b", {"api_url": "https://test.org/b"})
+    plan.add("a", "a", {"api_url": "https://test.org/a"})
+    plan.add("b", "b", {"api_url": "https://test.org/b2"})
+    plan.add("c", "c", None)
+    plan.add_skipped()
+    plan.finish()
+
+    assert plan.jobs == {
+        "a": {"api_url": "https://test.org/a"},
+        "b": {"api_url": "https://test.org/b2"},
+    }
+    assert plan.duplicates == {"a": 1, "b": 1}
+    summary = plan.summary()
+    assert summary.pop("planning_seconds") >= 0
+    assert summary == {
+        "entries": 6,
+        "jobs": 2,
+        "studies": 0,
+        "duplicates": 2,
+        "covered": 0,
+        "invalid": 1,
+    }
+    assert plan.get_completed({"a": "downloaded", "b": "failed"}) == {
+        "a": DownloadStatus(filename="a", status="downloaded"),
+        "b": DownloadStatus(filename="b", status="failed"),
+        "c": DownloadStatus(filename="c", status="invalid url"),
+    }
+
+
+def test_download_plan_covered_files():
+    """Files in a study are dropped and get the status of the study"""
+    plan = DownloadPlan("Test")
+    plan.add("file_1", "file_1", {"api_url": "https://test.org/file/1"})
+    plan.add("study", "study", {"api_url": "https://test.org/study"}, study=True)
+    plan.add("file_2", "file_2", {"api_url": "https://test.org/file/2"})
+    plan.add(
+        "file_3",
+        "file_3",
+        {"api_url": "https://test.org/file/3", "file_metadata": {"filename": "x.csv"}},
+    )
+    plan.drop_covered_files(
+        lambda job: {f"https://test.org/file/{i}" for i in [1, 3, 4]}
+    )
+    plan.finish()
+
+    assert plan.covered == {"file_1": "study"}
+    # studies are downloaded first
+    assert list(plan.jobs) == ["study", "file_2", "file_3"]
+    completed = plan.get_completed({"study": "downloaded", "file_2": "failed"})
+    assert completed["file_1"].status == "downloaded"
+    assert completed["file_2"].status == "failed"
+    # the plan is not changed by running it
+    assert plan.statuses["file_1"].status == "pending"
+
+
+def test_download_plan_groups():
+    """Group jobs replace the jobs of their members"""
+    plan = DownloadPlan("Test")
+    for id in ["a", "b", "c"]:
+        plan.add(id, id, {"api_url": f"https://test.org/{id}"})
+    plan.group_jobs("ab", ["a", "b"], {"api_url": "https://test.org/ab"})
+    plan.finish()
+
+    assert list(plan.jobs) == ["c", "ab"]
+    assert plan.get_completed(
+        {"ab": {"a": "downloaded", "b": "failed"}, "c": "downloaded"}
+    ) == {
+        "a": DownloadStatus(filename="a", status="downloaded"),
+        "b": DownloadStatus(filename="b", status="failed"),
+        "c": DownloadStatus(filename="c", status="downloaded"),
+    }
+    completed = plan.get_completed({"ab": "failed"})
+    assert [status.status for status in completed.values()] == [
+        "failed",
+        "failed",
+        "pending",
+    ]
+
+
+def test_plan_metrics():
+    """Planning emits a plan record"""
+    records = []
+    add_metrics_hook(records.append)
+    try:
+        plan_mpd_files(
+            [
+                {"file_retriever": "MPD", "project_symbol": "Gould2"},
+                {"file_retriever": "MPD", "project_symbol": "Gould2"},
+            ]
+        )
+    finally:
+        clear_metrics_hooks()
+    (record,) = records
+    assert record["event"] == "plan"
+    assert record["retriever"] == "MPD"
+    assert record["jobs"] == 1
+    assert record["duplicates"] == 1
+
+
+def test_plan_harvard_dataverse_files(tmp_path):
+    """Files in a study are not downloaded separately"""
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": "101"},
+        {"file_retriever": "Dataverse", "study_id": STUDY_ID},
+        {"file_retriever": "Dataverse", "file_id": "doi:10.7910/DVN/TEST01/F2"},
+        {"file_retriever": "Dataverse", "file_id": "103"},
+        {"file_retriever": "Dataverse", "file_id": "101"},
+    ]
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"{BASE_URL}/datasets/:persistentId/versions/:latest/files"
+            f"?persistentId={STUDY_ID}",
+            json={
+                "data": [
+                    {"dataFile": {"id": 101, "persistentId": ""}},
+                    {
+                        "dataFile": {
+                            "id": 102,
+                            "persistentId": "doi:10.7910/DVN/TEST01/F2",
+                        }
+                    },
+                ]
+            },
+        )
+        plan = plan_harvard_dataverse_files(file_metadata_list, resolve_studies=True)
+        assert m.call_count == 1
+
+    assert plan.covered == {"101": STUDY_ID, "doi:10.7910/DVN/TEST01/F2": STUDY_ID}
+    assert list(plan.jobs) == [STUDY_ID, "103"]
+    assert plan.duplicates == {"101": 1}
+
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"{BASE_URL}/access/dataset/:persistentId/?persistentId={STUDY_ID}",
+            headers={
+                "Content-Type": "application/zip",
+                "Content-Disposition": "application; filename=dataverse_files.zip",
+            },
+            content=make_zip_content({"file_101.csv": b"101", "file_102.csv": b"102"}),
+        )
+        m.get(f"{BASE_URL}/access/datafile/103", status_code=404)
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=[],
+            download_path=tmp_path,
+            plan=plan,
+        )
+        assert m.call_count == 2
+    assert result == {
+        "101": DownloadStatus(filename="101", status="downloaded"),
+        STUDY_ID: DownloadStatus(filename=STUDY_ID, status="downloaded"),
+        "doi:10.7910/DVN/TEST01/F2": DownloadStatus(
+            filename="doi:10.7910/DVN/TEST01/F2", status="downloaded"
+        ),
+        "103": DownloadStatus(filename="103", status="failed"),
+    }
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "file_101.csv",
+        "file_102.csv",
+    ]
+
+
+def test_plan_harvard_dataverse_files_unresolved():
+    """Without resolve_studies no study files are listed"""
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "study_id": STUDY_ID},
+        {"file_retriever": "Dataverse", "file_id": "101"},
+        {"file_retriever": "Dataverse", "missing": "id"},
+    ]
+    with requests_mock.Mocker() as m:
+        plan = plan_harvard_dataverse_files(file_metadata_list)
+        assert not m.called
+    assert list(plan.jobs) == [STUDY_ID, "101"]
+    assert plan.studies == {STUDY_ID}
+    assert plan.entries == 3
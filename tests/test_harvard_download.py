@@ -1,4 +1,7 @@
+import hashlib
+import io
 import os
+import zipfile
 from pathlib import Path
 from typing import Dict
 from unittest.mock import MagicMock
@@ -13,7 +16,12 @@ from heal.harvard_downloads import (
     get_id,
     is_valid_harvard_file_metadata,
 )
-from heal.utils import download_from_url, get_filename, get_filename_from_headers
+from heal.utils import (
+    RetryPolicy,
+    download_from_url,
+    get_filename,
+    get_filename_from_headers,
+)
 
 
 @pytest.fixture(scope="session")
@@ -397,3 +405,252 @@ def test_get_harvard_dataverse_files(download_dir):
         downloaded_file_path = Path(download_dir) / metadata_filename
         assert downloaded_file_path.exists()
         assert downloaded_file_path.read_text() == test_data
+
+
+def test_get_harvard_dataverse_files_multiple_files(download_dir):
+    """Test concurrent download of several files"""
+    test_file_ids = [f"harvard_file_{i}" for i in range(5)]
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": file_id} for file_id in test_file_ids
+    ]
+    expected_status = {
+        file_id: DownloadStatus(filename=file_id, status="downloaded")
+        for file_id in test_file_ids
+    }
+    with requests_mock.Mocker() as m:
+        for file_id in test_file_ids:
+            m.get(
+                f"https://dataverse.harvard.edu/api/access/datafile/{file_id}",
+                headers={"Content-Type": "application/pdf"},
+                content=bytes(file_id, "utf-8"),
+            )
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=download_dir,
+            max_workers=3,
+        )
+    assert result == expected_status
+    assert list(result.keys()) == test_file_ids
+    for file_id in test_file_ids:
+        assert (Path(download_dir) / file_id).read_text() == file_id
+
+
+@pytest.mark.parametrize("stream_extract", [False, True])
+def test_get_harvard_dataverse_files_unpack_zip(tmp_path, stream_extract):
+    """Study zip files are unpacked and removed, with or without streaming extraction"""
+    test_study_id = "harvard_study_01"
+    members = {"MANIFEST.TXT": b"manifest", "data/file.csv": b"a,b\n1,2\n" * 1000}
+    zip_content = io.BytesIO()
+    with zipfile.ZipFile(zip_content, "w", compression=zipfile.ZIP_DEFLATED) as package:
+        for name, content in members.items():
+            package.writestr(name, content)
+    file_metadata_list = [{"file_retriever": "Dataverse", "study_id": test_study_id}]
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"https://dataverse.harvard.edu/api/access/dataset/:persistentId/?persistentId={test_study_id}",
+            headers={
+                "Content-Type": "application/zip",
+                "Content-Disposition": "application; filename=dataverse_files.zip",
+            },
+            content=zip_content.getvalue(),
+        )
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            stream_extract=stream_extract,
+        )
+    assert result == {
+        test_study_id: DownloadStatus(filename=test_study_id, status="downloaded")
+    }
+    assert not (tmp_path / "dataverse_files.zip").exists()
+    for name, content in members.items():
+        assert (tmp_path / name).read_bytes() == content
+
+
+@pytest.mark.parametrize(
+    "retry_policy, expected",
+    [
+        (RetryPolicy(backoff_factor=0.01), "downloaded"),
+        (None, "failed"),
+    ],
+)
+def test_get_harvard_dataverse_files_throttled(tmp_path, retry_policy, expected):
+    """Throttled requests are retried with the retriever retry policy"""
+    test_file_id = "harvard_file_01"
+    file_metadata_list = [{"file_retriever": "Dataverse", "file_id": test_file_id}]
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"https://dataverse.harvard.edu/api/access/datafile/{test_file_id}",
+            [
+                {"status_code": 429, "headers": {"Retry-After": "0"}},
+                {"status_code": 503},
+                {"content": b"foo", "headers": {"Content-Type": "application/pdf"}},
+            ],
+        )
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            retry_policy=retry_policy,
+        )
+    assert result == {
+        test_file_id: DownloadStatus(filename=test_file_id, status=expected)
+    }
+
+
+def make_datafiles_zip(filenames):
+    """Make a Dataverse /datafiles zip file with a MANIFEST.TXT"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as package:
+        package.writestr("MANIFEST.TXT", "manifest")
+        for filename in filenames:
+            package.writestr(filename, filename)
+    return content.getvalue()
+
+
+def test_get_harvard_dataverse_files_batch(tmp_path):
+    """Files are downloaded in /datafiles batches, each with its own status"""
+    test_file_ids = ["101", "102", "103", "104", "105"]
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": file_id} for file_id in test_file_ids
+    ]
+    base_url = "https://dataverse.harvard.edu/api/access"
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"{base_url}/datafiles/101,102",
+            content=make_datafiles_zip(["file_101.csv", "file_102.csv"]),
+            headers={"Content-Type": "application/zip"},
+        )
+        m.get(
+            f"{base_url}/datafiles/103,104",
+            content=make_datafiles_zip(["file_103.csv", "file_104.csv"]),
+            headers={"Content-Type": "application/zip"},
+        )
+        m.get(
+            f"{base_url}/datafile/105",
+            content=b"file_105.csv",
+            headers={"Content-Disposition": "attachment; filename=file_105.csv"},
+        )
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            batch_size=2,
+        )
+        assert m.call_count == 3
+    assert result == {
+        file_id: DownloadStatus(filename=file_id, status="downloaded")
+        for file_id in test_file_ids
+    }
+    # the batch manifests are not extracted
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"file_{file_id}.csv" for file_id in test_file_ids
+    ]
+
+
+@pytest.mark.parametrize(
+    "batch_response",
+    [
+        # one of the files is missing from the zip file
+        {
+            "content": make_datafiles_zip(["file_101.csv"]),
+            "headers": {"Content-Type": "application/zip"},
+        },
+        {"status_code": 403},
+    ],
+)
+def test_get_harvard_dataverse_files_batch_fallback(tmp_path, batch_response):
+    """Files in a failed batch are downloaded one at a time"""
+    base_url = "https://dataverse.harvard.edu/api/access"
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": file_id}
+        for file_id in ["101", "102"]
+    ]
+    with requests_mock.Mocker() as m:
+        m.get(f"{base_url}/datafiles/101,102", **batch_response)
+        m.get(
+            f"{base_url}/datafile/101",
+            content=b"file_101.csv",
+            headers={"Content-Disposition": "attachment; filename=file_101.csv"},
+        )
+        m.get(f"{base_url}/datafile/102", status_code=403)
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            batch_size=2,
+            retry_policy=None,
+        )
+    assert result == {
+        "101": DownloadStatus(filename="101", status="downloaded"),
+        "102": DownloadStatus(filename="102", status="failed"),
+    }
+    assert [path.name for path in tmp_path.iterdir()] == ["file_101.csv"]
+
+
+def test_get_harvard_dataverse_files_checksums(tmp_path):
+    """Files are verified against metadata or Dataverse checksums"""
+    base_url = "https://dataverse.harvard.edu/api"
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "file_id": "101"},
+        {"file_retriever": "Dataverse", "file_id": "102"},
+        {
+            "file_retriever": "Dataverse",
+            "file_id": "103",
+            "md5sum": hashlib.md5(b"file_103").hexdigest(),
+        },
+    ]
+    with requests_mock.Mocker() as m:
+        for file_id in ["101", "102", "103"]:
+            m.get(
+                f"{base_url}/access/datafile/{file_id}",
+                content=f"file_{file_id}".encode(),
+                headers={
+                    "Content-Disposition": f"attachment; filename=file_{file_id}.csv"
+                },
+            )
+        m.get(
+            f"{base_url}/files/101",
+            json={
+                "data": {
+                    "dataFile": {
+                        "checksum": {
+                            "type": "MD5",
+                            "value": hashlib.md5(b"file_101").hexdigest(),
+                        }
+                    }
+                }
+            },
+        )
+        m.get(
+            f"{base_url}/files/102",
+            json={"data": {"dataFile": {"checksum": {"type": "MD5", "value": "0"}}}},
+        )
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            batch_size=10,
+            verify_checksums=True,
+        )
+        # the checksum of 103 is in its metadata
+        assert f"{base_url}/files/103" not in [
+            request.url for request in m.request_history
+        ]
+    assert result == {
+        "101": DownloadStatus(filename="101", status="downloaded"),
+        "102": DownloadStatus(filename="102", status="checksum mismatch"),
+        "103": DownloadStatus(filename="103", status="downloaded"),
+    }
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "file_101.csv",
+        "file_103.csv",
+    ]
@@ -0,0 +1,245 @@
+import io
+import json
+import zipfile
+from unittest import mock
+from unittest.mock import MagicMock
+
+import pytest
+import requests_mock
+
+from heal.harvard_downloads import get_harvard_dataverse_files
+from heal.metrics import (
+    JSONLinesMetricsHook,
+    PhaseTimer,
+    PrometheusTextfileHook,
+    add_metrics_hook,
+    clear_metrics_hooks,
+    emit_metrics,
+    metrics_enabled,
+    remove_metrics_hook,
+)
+from heal.qdr_downloads import get_syracuse_qdr_files
+from heal.utils import download_from_url, unpackage_object
+from tests.mock_server import MockDownloadServer
+
+
+@pytest.fixture
+def records():
+    """Fixture collecting the emitted metrics records"""
+    records = []
+    add_metrics_hook(records.append)
+    yield records
+    clear_metrics_hooks()
+
+
+def make_zip_content(members):
+    """Make the bytes of a zip file"""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as package:
+        for name, data in members.items():
+            package.writestr(name, data)
+    return content.getvalue()
+
+
+def test_metrics_hooks():
+    """Test registering hooks"""
+    assert not metrics_enabled()
+    records = []
+    hook = add_metrics_hook(records.append)
+    assert metrics_enabled()
+    emit_metrics("test", value=1)
+    remove_metrics_hook(hook)
+    assert not metrics_enabled()
+    emit_metrics("test", value=2)
+
+    assert len(records) == 1
+    assert records[0]["event"] == "test"
+    assert records[0]["value"] == 1
+    assert "timestamp" in records[0]
+
+
+def test_metrics_hook_errors(records):
+    """A failing hook does not stop other hooks"""
+    add_metrics_hook(MagicMock(side_effect=Exception("hook error")))
+    add_metrics_hook(records.append)
+    emit_metrics("test")
+    assert [record["event"] for record in records] == ["test", "test"]
+
+
+def test_metrics_disabled(tmp_path):
+    """No records are built without hooks"""
+    with MockDownloadServer(files={"data.bin": b"content"}) as server, mock.patch(
+        "heal.utils.emit_metrics"
+    ) as emit:
+        assert download_from_url(f"{server.url}/files/data.bin", download_path=tmp_path)
+    emit.assert_not_called()
+
+
+def test_phase_timer():
+    """Test the phases of a PhaseTimer"""
+    timer = PhaseTimer()
+    timer.mark("token")
+    timer.mark("download")
+    timer.mark("download")
+    assert list(timer.phases) == ["token_seconds", "download_seconds"]
+    assert sum(timer.phases.values()) <= timer.total_seconds
+
+
+def test_download_metrics(tmp_path, records):
+    """download_from_url emits a download record"""
+    content = b"x" * 100000
+    with MockDownloadServer(files={"data.bin": content}, latency=0.1) as server:
+        api_url = f"{server.url}/files/data.bin"
+        download_from_url(api_url, download_path=tmp_path)
+        download_from_url(f"{server.url}/files/missing.bin", download_path=tmp_path)
+
+    downloaded, failed = records
+    assert downloaded["event"] == "download"
+    assert downloaded["api_url"] == api_url
+    assert downloaded["status"] == "downloaded"
+    assert downloaded["bytes"] == len(content)
+    assert downloaded["resumes"] == 0
+    assert downloaded["first_byte_seconds"] >= 0.1
+    assert downloaded["total_seconds"] == pytest.approx(
+        downloaded["first_byte_seconds"] + downloaded["transfer_seconds"]
+    )
+    assert failed["status"] == "failed"
+    assert failed["bytes"] == 0
+
+
+def test_unpack_metrics(tmp_path, records):
+    """unpackage_object emits an unpack record"""
+    zip_path = tmp_path / "study.zip"
+    zip_path.write_bytes(make_zip_content({"a.txt": b"aaaa", "b/c.txt": b"cc"}))
+    unpackage_object(zip_path, max_workers=2)
+    assert records == [
+        {
+            "event": "unpack",
+            "timestamp": records[0]["timestamp"],
+            "path": str(zip_path),
+            "members": 2,
+            "bytes": 6,
+            "workers": 2,
+            "total_seconds": records[0]["total_seconds"],
+        }
+    ]
+
+
+def test_harvard_metrics(tmp_path, records):
+    """The retriever emits file and manifest records"""
+    test_study_id = "harvard_study_01"
+    file_metadata_list = [
+        {"file_retriever": "Dataverse", "study_id": test_study_id},
+        {"file_retriever": "Dataverse", "file_id": "missing_file"},
+    ]
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"https://dataverse.harvard.edu/api/access/dataset/:persistentId/?persistentId={test_study_id}",
+            headers={
+                "Content-Type": "application/zip",
+                "Content-Disposition": "application; filename=dataverse_files.zip",
+            },
+            content=make_zip_content({"MANIFEST.TXT": b"manifest"}),
+        )
+        m.get(
+            "https://dataverse.harvard.edu/api/access/datafile/missing_file",
+            status_code=404,
+        )
+        get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            max_workers=1,
+        )
+
+    events = {}
+    for record in records:
+        events.setdefault(record["event"], []).append(record)
+    assert [record["status"] for record in events["download"]] == [
+        "downloaded",
+        "failed",
+    ]
+    assert len(events["unpack"]) == 1
+    study, missing = events["file"]
+    assert study["retriever"] == "Dataverse"
+    assert study["file_id"] == test_study_id
+    assert study["status"] == "downloaded"
+    assert set(study) >= {
+        "download_seconds",
+        "unpack_seconds",
+        "cleanup_seconds",
+        "total_seconds",
+    }
+    assert missing["status"] == "failed"
+    assert "unpack_seconds" not in missing
+    (manifest,) = events["manifest"]
+    assert manifest["retriever"] == "Dataverse"
+    assert manifest["files"] == 2
+    assert manifest["failed"] == 1
+
+
+def test_qdr_metrics(tmp_path, records):
+    """The QDR retriever times the token request"""
+    file_metadata_list = [
+        {
+            "external_oidc_idp": "test-external-idp",
+            "file_retriever": "QDR",
+            "file_id": "qdr_file_01",
+        }
+    ]
+    with requests_mock.Mocker() as m, mock.patch(
+        "heal.utils.wts_get_token", return_value="some-idp-token"
+    ):
+        m.get(
+            "https://data.qdr.syr.edu/api/access/datafile/qdr_file_01",
+            headers={"Content-Type": "application/pdf"},
+            content=b"foo",
+        )
+        get_syracuse_qdr_files(
+            wts_hostname="test.commons.io",
+            auth=MagicMock(),
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+        )
+    (file_record,) = [record for record in records if record["event"] == "file"]
+    assert file_record["retriever"] == "QDR"
+    assert set(file_record) >= {"token_seconds", "download_seconds"}
+
+
+def test_json_lines_metrics_hook(tmp_path):
+    """Records are appended as JSON lines"""
+    path = tmp_path / "metrics.jsonl"
+    hook = JSONLinesMetricsHook(path)
+    hook({"event": "download", "bytes": 10})
+    hook({"event": "unpack", "path": tmp_path})
+    lines = path.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"event": "download", "bytes": 10},
+        {"event": "unpack", "path": str(tmp_path)},
+    ]
+
+
+def test_prometheus_textfile_hook(tmp_path):
+    """Records are totalled in the Prometheus text format"""
+    path = tmp_path / "heal.prom"
+    hook = PrometheusTextfileHook(path)
+    for seconds in [1.5, 2.5]:
+        hook(
+            {
+                "event": "file",
+                "timestamp": 1700000000.0,
+                "retriever": "QDR",
+                "file_id": "file_01",
+                "status": "downloaded",
+                "download_seconds": seconds,
+            }
+        )
+    hook({"event": "file", "retriever": 'Data"verse', "status": "failed"})
+    assert path.read_text().splitlines() == [
+        "# TYPE heal_file_download_seconds_total counter",
+        'heal_file_download_seconds_total{retriever="QDR",status="downloaded"} 4.0',
+        "# TYPE heal_file_total counter",
+        'heal_file_total{retriever="Data\\"verse",status="failed"} 1',
+        'heal_file_total{retriever="QDR",status="downloaded"} 2',
+    ]
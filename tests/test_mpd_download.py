@@ -1,8 +1,11 @@
+import io
 import os
 from pathlib import Path
 from typing import Dict
+from unittest import mock
 from unittest.mock import MagicMock
 
+import pandas as pd
 import pytest
 import requests_mock
 from gen3.tools.download.drs_download import DownloadStatus
@@ -11,8 +14,11 @@ from heal.mpd_downloads import (
     get_download_url_for_mpd,
     get_mpd_files,
     is_valid_mpd_file_metadata,
+    iter_mpd_batches,
+    read_mpd_data,
 )
-from heal.utils import get_filename, get_id
+from heal.utils import DownloadCache, DownloadScheduler, get_filename, get_id
+from tests.mock_server import MockRepositoryServer, make_mpd_csv
 
 
 @pytest.fixture(scope="session")
@@ -410,3 +416,259 @@ def test_get_mpd_files_multiple_files(download_dir):
         assert measure_file.exists()
         assert project_file.read_text() == test_project_data
         assert measure_file.read_text() == test_measure_data
+
+
+def test_get_mpd_files_cached(tmp_path):
+    """Test that unmodified MPD files are restored from the download cache"""
+    test_data = "project_id,strain,value\n1,C57BL/6J,10.5\n"
+    test_project = "Gould2"
+    api_url = f"https://phenome.jax.org/api/projects/{test_project}/dataset?csv=yes"
+    file_metadata_list = [{"file_retriever": "MPD", "project_symbol": test_project}]
+    cache = DownloadCache(tmp_path / "cache")
+
+    with requests_mock.Mocker() as m:
+        m.get(
+            api_url,
+            [
+                {"text": test_data, "headers": {"ETag": '"v1"'}},
+                {"status_code": 304, "headers": {"ETag": '"v1"'}},
+            ],
+        )
+        for expected in ["downloaded", "cached"]:
+            result = get_mpd_files(
+                wts_hostname="",
+                auth=MagicMock(),
+                file_metadata_list=file_metadata_list,
+                download_path=tmp_path,
+                cache=cache,
+            )
+            assert result == {
+                test_project: DownloadStatus(
+                    filename=f"{test_project}.csv", status=expected
+                )
+            }
+        assert m.request_history[1].headers["If-None-Match"] == '"v1"'
+
+    assert (tmp_path / f"{test_project}.csv").read_text() == test_data
+
+
+def test_get_mpd_files_with_scheduler(tmp_path):
+    """Test that MPD files are downloaded with a shared scheduler"""
+    file_metadata_list = [
+        {"file_retriever": "MPD", "project_symbol": "Gould2"},
+        {"file_retriever": "MPD", "measure_id": "2908"},
+    ]
+    project_url = "https://phenome.jax.org/api/projects/Gould2/dataset?csv=yes"
+    measure_url = "https://phenome.jax.org/api/pheno/animalvals/2908?csv=yes"
+    with requests_mock.Mocker() as m, DownloadScheduler(max_workers=1) as scheduler:
+        m.head(project_url, headers={"Content-Length": "5000"})
+        m.head(measure_url, headers={"Content-Length": "50"})
+        m.get(project_url, text="project data")
+        m.get(measure_url, text="measure data")
+        result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            scheduler=scheduler,
+        )
+        # the smaller measure is downloaded first
+        assert [
+            request.url for request in m.request_history if request.method == "GET"
+        ] == [measure_url, project_url]
+    assert result == {
+        "Gould2": DownloadStatus(filename="Gould2.csv", status="downloaded"),
+        "2908": DownloadStatus(filename="2908.csv", status="downloaded"),
+    }
+
+
+def test_get_mpd_files_with_sink(tmp_path):
+    """Test that MPD files can be passed to sinks instead of saved"""
+    file_metadata_list = [
+        {"file_retriever": "MPD", "project_symbol": "Gould2"},
+        {"file_retriever": "MPD", "measure_id": "2908"},
+    ]
+    sinks = {}
+
+    def sink_factory(object_id, filename):
+        sinks[filename] = io.BytesIO()
+        return sinks[filename]
+
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://phenome.jax.org/api/projects/Gould2/dataset?csv=yes",
+            text="project data",
+        )
+        m.get(
+            "https://phenome.jax.org/api/pheno/animalvals/2908?csv=yes",
+            text="measure data",
+        )
+        result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            sink_factory=sink_factory,
+        )
+    assert result == {
+        "Gould2": DownloadStatus(filename="Gould2.csv", status="downloaded"),
+        "2908": DownloadStatus(filename="2908.csv", status="downloaded"),
+    }
+    assert {filename: sink.getvalue() for filename, sink in sinks.items()} == {
+        "Gould2.csv": b"project data",
+        "2908.csv": b"measure data",
+    }
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_iter_mpd_batches():
+    """MPD CSV is parsed into DataFrames as it downloads"""
+    content = make_mpd_csv(2500)
+    file_metadata = {"file_retriever": "MPD", "project_symbol": "Gould2"}
+    with MockRepositoryServer(mpd={"Gould2": content}) as server, mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd", server.mpd_url
+    ):
+        batches = list(iter_mpd_batches(file_metadata, batch_rows=1000))
+        data = read_mpd_data(file_metadata)
+        assert read_mpd_data({"file_retriever": "MPD", "measure_id": 1}) is None
+
+    assert [len(batch) for batch in batches] == [1000, 1000, 500]
+    expected = pd.read_csv(io.BytesIO(content))
+    pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), expected)
+    pd.testing.assert_frame_equal(data, expected)
+
+
+def test_iter_mpd_batches_invalid():
+    """Invalid engines and metadata raise errors"""
+    with pytest.raises(ValueError):
+        next(iter_mpd_batches({"project_symbol": "Gould2"}, engine="polars"))
+    with pytest.raises(ValueError):
+        next(iter_mpd_batches({"file_retriever": "MPD"}))
+    assert read_mpd_data({"file_retriever": "MPD"}) is None
+
+
+def test_get_mpd_files_arrow(tmp_path):
+    """MPD CSV is parsed into Arrow batches, or saved as parquet"""
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    content = make_mpd_csv(2500)
+    file_metadata = {"file_retriever": "MPD", "project_symbol": "Gould2"}
+    with MockRepositoryServer(mpd={"Gould2": content}) as server, mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd", server.mpd_url
+    ):
+        table = pyarrow.Table.from_batches(
+            list(iter_mpd_batches(file_metadata, engine="arrow"))
+        )
+        assert read_mpd_data(file_metadata, engine="arrow").equals(table)
+        result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=[file_metadata],
+            download_path=tmp_path,
+            output_format="parquet",
+        )
+    assert table.num_rows == 2500
+    assert result == {
+        "Gould2": DownloadStatus(filename="Gould2.parquet", status="downloaded")
+    }
+    assert pyarrow.parquet.read_table(tmp_path / "Gould2.parquet").equals(table)
+    assert [path.name for path in tmp_path.iterdir()] == ["Gould2.parquet"]
+
+
+def test_get_mpd_files_invalid_output_format(tmp_path):
+    """Test the output format is checked"""
+    assert (
+        get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=[],
+            download_path=tmp_path,
+            output_format="json",
+        )
+        is None
+    )
+
+
+def test_get_mpd_files_coalesce_measures(tmp_path):
+    """Measures of a project are split from one project dataset request"""
+    project = make_mpd_csv(200)
+    measure = b"measnum,strain,value\n99999,C57BL/6J,1.5\n"
+    file_metadata_list = [
+        {"file_retriever": "MPD", "measure_id": 47115, "project_symbol": "Gould2"},
+        {"file_retriever": "MPD", "measure_id": 47116, "project_symbol": "Gould2"},
+        {"file_retriever": "MPD", "measure_id": 47115, "project_symbol": "Gould2"},
+        # not in the project dataset
+        {"file_retriever": "MPD", "measure_id": 99999, "project_symbol": "Gould2"},
+        # the only measure of its project
+        {"file_retriever": "MPD", "measure_id": 47117, "project_symbol": "Other"},
+        {"file_retriever": "MPD", "project_symbol": "Gould2", "filename": "all.csv"},
+    ]
+    with MockRepositoryServer(
+        mpd={"Gould2": project, "99999": measure, "47117": b"measure 47117"}
+    ) as server, mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd", server.mpd_url
+    ):
+        result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            coalesce_measures=True,
+        )
+    assert result == {
+        47115: DownloadStatus(filename="47115.project.csv", status="downloaded"),
+        47116: DownloadStatus(filename="47116.project.csv", status="downloaded"),
+        99999: DownloadStatus(filename="99999.csv", status="downloaded"),
+        47117: DownloadStatus(filename="47117.csv", status="downloaded"),
+        "Gould2": DownloadStatus(filename="all.csv", status="downloaded"),
+    }
+    assert sorted(path for method, path in server.requests) == [
+        "/api/pheno/animalvals/47117?csv=yes",
+        "/api/pheno/animalvals/99999?csv=yes",
+        "/api/projects/Gould2/dataset?csv=yes",
+        "/api/projects/Gould2/dataset?csv=yes",
+    ]
+    expected = pd.read_csv(io.BytesIO(project), dtype=str)
+    for measure_id in ["47115", "47116"]:
+        assert not (tmp_path / f"{measure_id}.csv").exists()
+        data = pd.read_csv(tmp_path / f"{measure_id}.project.csv", dtype=str)
+        pd.testing.assert_frame_equal(
+            data,
+            expected[expected["measnum"] == measure_id].reset_index(drop=True),
+        )
+    assert (tmp_path / "99999.csv").read_bytes() == measure
+    assert (tmp_path / "all.csv").read_bytes() == project
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_get_mpd_files_coalesce_measures_fallback(tmp_path):
+    """Measures are downloaded in parallel jobs if the project cannot be split"""
+    file_metadata_list = [
+        {"file_retriever": "MPD", "measure_id": 1, "project_symbol": "Gould2"},
+        {"file_retriever": "MPD", "measure_id": 2, "project_symbol": "Gould2"},
+    ]
+    with DownloadScheduler(max_workers=2) as scheduler, MockRepositoryServer(
+        mpd={"Gould2": b"strain,value\nC57BL/6J,1.5\n", "1": b"measure 1"}
+    ) as server, mock.patch(
+        "heal.mpd_downloads.get_download_url_for_mpd", server.mpd_url
+    ), mock.patch.object(scheduler, "run", wraps=scheduler.run) as run:
+        result = get_mpd_files(
+            wts_hostname="",
+            auth=None,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            coalesce_measures=True,
+            retry_policy=None,
+            scheduler=scheduler,
+        )
+    assert result == {
+        1: DownloadStatus(filename="1.csv", status="downloaded"),
+        2: DownloadStatus(filename="2.csv", status="failed"),
+    }
+    assert [path.name for path in tmp_path.iterdir()] == ["1.csv"]
+    # the project job, then one job per measure
+    assert [list(call.args[1]) for call in run.call_args_list] == [
+        ["Gould2/measures"],
+        [1, 2],
+    ]
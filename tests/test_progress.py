@@ -0,0 +1,206 @@
+import asyncio
+import io
+import os
+
+import pytest
+import requests
+import requests_mock
+
+from heal.async_downloads import async_download_from_url
+from heal.harvard_downloads import get_harvard_dataverse_files
+from heal.progress import (
+    FileProgress,
+    ManifestProgress,
+    ProgressReporter,
+    TqdmProgressRenderer,
+    add_progress_hook,
+    clear_progress_hooks,
+    progress_enabled,
+)
+from heal.utils import download_from_url, get_content_total
+from tests.mock_server import (
+    MockDownloadServer,
+    MockRepositoryServer,
+    get_file_metadata_list,
+    make_payloads,
+    patched_retrievers,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_progress_hooks():
+    """Remove progress hooks added by a test"""
+    yield
+    clear_progress_hooks()
+
+
+def test_progress_reporter_throttled():
+    """Updates are sent at most once per interval, plus start and finish"""
+    updates = []
+    reporter = ProgressReporter(
+        "https://test.org/file", file_id="1", callback=updates.append, interval=60
+    )
+    reporter.start("file.csv", 100, 1100)
+    for data in reporter.iter_chunks([b"x" * 10] * 100):
+        pass
+    reporter.finish("downloaded")
+
+    assert [(update.bytes, update.done) for update in updates] == [
+        (100, False),
+        (1100, True),
+    ]
+    assert updates[-1] == FileProgress(
+        api_url="https://test.org/file",
+        file_id="1",
+        filename="file.csv",
+        bytes=1100,
+        total=1100,
+        rate=updates[-1].rate,
+        elapsed_seconds=updates[-1].elapsed_seconds,
+        done=True,
+        status="downloaded",
+    )
+    assert updates[-1].rate > 0
+
+
+def test_download_from_url_progress(tmp_path):
+    """Progress has the bytes, total and rate of the transfer"""
+    content = os.urandom(200000)
+    updates = []
+    with MockDownloadServer(files={"data.bin": content}, bandwidth=400000) as server:
+        path = download_from_url(
+            f"{server.url}/files/data.bin",
+            download_path=tmp_path,
+            chunk_size=4096,
+            progress=updates.append,
+        )
+    assert path == f"{tmp_path}/data.bin"
+    # about 50 chunks in 0.5 seconds
+    assert 2 <= len(updates) <= 10
+    assert [update.bytes for update in updates] == sorted(
+        update.bytes for update in updates
+    )
+    assert all(update.total == len(content) for update in updates)
+    assert updates[-1].bytes == len(content)
+    assert updates[-1].status == "downloaded"
+    assert updates[-1].filename == "data.bin"
+
+
+def test_download_from_url_progress_resumed(tmp_path):
+    """Resumed downloads report the bytes and total of the whole file"""
+    content = os.urandom(100000)
+    updates = []
+    add_progress_hook(updates.append)
+    assert progress_enabled()
+    with MockDownloadServer(
+        files={"data.bin": content},
+        accept_ranges=True,
+        interruptions=1,
+        interrupt_after=30000,
+    ) as server:
+        download_from_url(
+            f"{server.url}/files/data.bin", download_path=tmp_path, chunk_size=8192
+        )
+        download_from_url(f"{server.url}/files/missing.bin", download_path=tmp_path)
+
+    starts = [update for update in updates if update.bytes and not update.done]
+    assert starts[0].total == len(content)
+    assert 0 < starts[0].bytes < len(content)
+    assert [(update.bytes, update.status) for update in updates if update.done] == [
+        (len(content), "downloaded"),
+        (0, "failed"),
+    ]
+
+
+def test_progress_hook_errors(tmp_path):
+    """Errors in progress hooks do not interrupt downloads"""
+
+    def hook(progress):
+        raise ValueError("hook error")
+
+    with requests_mock.Mocker() as m:
+        m.get("https://test.org/file", content=b"content")
+        path = download_from_url(
+            "https://test.org/file", download_path=tmp_path, progress=hook
+        )
+    assert (tmp_path / "file").read_bytes() == b"content"
+    assert path == f"{tmp_path}/file"
+
+
+def test_get_content_total():
+    """The total comes from Content-Range or Content-Length"""
+    with requests_mock.Mocker() as m:
+        m.get("https://test.org/full", headers={"Content-Length": "100"})
+        m.get(
+            "https://test.org/partial",
+            status_code=206,
+            headers={"Content-Range": "bytes 40-99/100", "Content-Length": "60"},
+        )
+        m.get(
+            "https://test.org/unknown",
+            status_code=206,
+            headers={"Content-Range": "bytes 40-99/*", "Content-Length": "60"},
+        )
+        m.get("https://test.org/chunked", headers={"Content-Length": ""})
+        assert get_content_total(requests.get("https://test.org/full")) == 100
+        assert get_content_total(requests.get("https://test.org/partial"), 40) == 100
+        assert get_content_total(requests.get("https://test.org/unknown"), 40) == 100
+        assert get_content_total(requests.get("https://test.org/chunked")) is None
+
+
+def test_manifest_progress(tmp_path):
+    """Manifest progress adds up the transfers and files of a retriever"""
+    datafiles = make_payloads(6, 10000)
+    updates = []
+    with MockRepositoryServer(datafiles=datafiles) as server, patched_retrievers(
+        server
+    ), ManifestProgress(
+        callback=lambda progress: updates.append((progress.files_done, progress.active))
+    ) as progress:
+        result = get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=get_file_metadata_list("Dataverse", datafiles),
+            download_path=tmp_path,
+        )
+    assert set(status.status for status in result.values()) == {"downloaded"}
+    assert progress.files_total == progress.files_done == 6
+    assert progress.bytes == progress.total == 60000
+    assert progress.active == 0
+    assert len(progress.transfers) == 6
+    assert updates[-1] == (6, 0)
+    assert not progress_enabled()
+
+
+def test_tqdm_progress_renderer(tmp_path):
+    """The renderer draws a progress bar of the bytes and files"""
+    output = io.StringIO()
+    datafiles = make_payloads(3, 10000)
+    with MockRepositoryServer(datafiles=datafiles) as server, patched_retrievers(
+        server
+    ), TqdmProgressRenderer(file=output, interval=0):
+        get_harvard_dataverse_files(
+            wts_hostname=None,
+            auth=None,
+            file_metadata_list=get_file_metadata_list("Dataverse", datafiles),
+            download_path=tmp_path,
+        )
+    assert "files=3/3" in output.getvalue()
+    assert "29.3k/29.3k" in output.getvalue()
+
+
+def test_async_download_from_url_progress(tmp_path):
+    """Async downloads report progress"""
+    content = os.urandom(50000)
+    updates = []
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        asyncio.run(
+            async_download_from_url(
+                f"{server.url}/files/data.bin",
+                download_path=tmp_path,
+                progress=updates.append,
+            )
+        )
+    assert updates[0].bytes == 0
+    assert updates[-1].bytes == updates[-1].total == len(content)
+    assert updates[-1].status == "downloaded"
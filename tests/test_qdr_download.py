@@ -1,4 +1,6 @@
+import io
 import os
+import zipfile
 from pathlib import Path
 from typing import Dict
 from unittest import mock
@@ -16,7 +18,7 @@ from heal.qdr_downloads import (
     get_syracuse_qdr_files,
     is_valid_qdr_file_metadata,
 )
-from heal.utils import download_from_url, get_filename_from_headers
+from heal.utils import DownloadResult, download_from_url, get_filename_from_headers
 
 
 @pytest.fixture(scope="session")
@@ -551,11 +553,9 @@ def test_get_syracuse_qdr_files_failed_download(wts_hostname, download_dir):
             headers=valid_response_headers,
             content=bytes(test_data, "utf-8"),
         )
-        with mock.patch(
-            "heal.qdr_downloads.download_from_url"
-        ) as mock_download_from_url:
+        with mock.patch("heal.qdr_downloads.fetch_from_url") as mock_fetch_from_url:
             # failed download
-            mock_download_from_url.return_value = None
+            mock_fetch_from_url.return_value = DownloadResult(status="failed")
 
             result = get_syracuse_qdr_files(
                 wts_hostname=wts_hostname,
@@ -564,3 +564,44 @@ def test_get_syracuse_qdr_files_failed_download(wts_hostname, download_dir):
                 download_path=download_dir,
             )
             assert result == expected_status
+
+
+def test_get_syracuse_qdr_files_batch(wts_hostname, tmp_path):
+    """QDR files are downloaded in a /datafiles batch with the idp token"""
+    test_idp = "test-external-idp"
+    file_metadata_list = [
+        {"external_oidc_idp": test_idp, "file_retriever": "QDR", "file_id": file_id}
+        for file_id in ["101", "102"]
+    ]
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as package:
+        package.writestr("file_101.pdf", "foo")
+        package.writestr("file_102.pdf", "bar")
+    mock_auth = MagicMock()
+    mock_auth.get_access_token.return_value = "some_token"
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"https://{wts_hostname}/wts/token/?idp={test_idp}",
+            json={"token": "some-idp-token"},
+        )
+        m.get(
+            "https://data.qdr.syr.edu/api/access/datafiles/101,102",
+            headers={"Content-Type": "application/zip"},
+            content=content.getvalue(),
+        )
+        result = get_syracuse_qdr_files(
+            wts_hostname=wts_hostname,
+            auth=mock_auth,
+            file_metadata_list=file_metadata_list,
+            download_path=tmp_path,
+            batch_size=10,
+        )
+        assert m.last_request.headers["Authorization"] == "Bearer some-idp-token"
+    assert result == {
+        "101": DownloadStatus(filename="101", status="downloaded"),
+        "102": DownloadStatus(filename="102", status="downloaded"),
+    }
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "file_101.pdf",
+        "file_102.pdf",
+    ]
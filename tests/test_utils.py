@@ -0,0 +1,1463 @@
+import base64
+import hashlib
+import email.utils
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from pathlib import Path
+from unittest import mock
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+import requests_mock
+from gen3.auth import Gen3Auth
+
+from heal.metrics import PhaseTimer
+from heal.utils import (
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    ChunkReader,
+    DownloadCache,
+    DownloadHasher,
+    DownloadResult,
+    DownloadScheduler,
+    DownloadSink,
+    RetryPolicy,
+    StreamingZipError,
+    StreamingZipExtractor,
+    TokenBucket,
+    clear_token_cache,
+    close_sessions,
+    configure_session_pool,
+    download_concurrently,
+    download_from_url,
+    fetch_from_url,
+    get_checksums,
+    get_connection_stats,
+    get_datafile_batches,
+    get_dataverse_checksums,
+    get_extraction_batches,
+    get_host,
+    get_idp_access_token,
+    get_part_filename,
+    get_response,
+    get_retry_after,
+    get_session,
+    get_token_expiry,
+    iter_response_chunks,
+    reset_connection_stats,
+    save_part_info,
+    unpack_download,
+    unpackage_object,
+)
+from tests.mock_server import MockDownloadServer
+
+
+@pytest.mark.parametrize(
+    "api_url, expected",
+    [
+        (
+            "https://data.qdr.syr.edu/api/access/datafile/123",
+            "https://data.qdr.syr.edu",
+        ),
+        ("http://127.0.0.1:8080/files/a.txt", "http://127.0.0.1:8080"),
+    ],
+)
+def test_get_host(api_url, expected):
+    """Test get host from url"""
+    assert get_host(api_url) == expected
+
+
+def test_download_concurrently():
+    """Test results are returned for every job"""
+    jobs = {
+        f"id_{i}": {"api_url": f"https://host_{i % 2}.org/{i}", "value": i}
+        for i in range(6)
+    }
+
+    def download_function(api_url, value):
+        return "downloaded" if value % 3 else "failed"
+
+    results = download_concurrently(download_function, jobs, max_workers=3)
+    assert list(results.keys()) == list(jobs.keys())
+    assert results == {
+        f"id_{i}": ("downloaded" if i % 3 else "failed") for i in range(6)
+    }
+
+
+def test_download_concurrently_exception():
+    """An exception in a job is reported as a failed download"""
+
+    def download_function(api_url):
+        if api_url.endswith("bad"):
+            raise ValueError("some error")
+        return "downloaded"
+
+    jobs = {
+        "good": {"api_url": "https://host.org/good"},
+        "bad": {"api_url": "https://host.org/bad"},
+    }
+    results = download_concurrently(download_function, jobs)
+    assert results == {"good": "downloaded", "bad": "failed"}
+
+
+def test_download_concurrently_max_per_host():
+    """Concurrent jobs for one host should not exceed max_per_host"""
+    lock = threading.Lock()
+    in_flight = {}
+    max_in_flight = {}
+
+    def download_function(api_url):
+        host = get_host(api_url)
+        with lock:
+            in_flight[host] = in_flight.get(host, 0) + 1
+            max_in_flight[host] = max(max_in_flight.get(host, 0), in_flight[host])
+        time.sleep(0.02)
+        with lock:
+            in_flight[host] -= 1
+        return "downloaded"
+
+    jobs = {f"id_{i}": {"api_url": f"https://host_{i % 2}.org/{i}"} for i in range(12)}
+    results = download_concurrently(
+        download_function, jobs, max_workers=8, max_per_host=2
+    )
+    assert set(results.values()) == {"downloaded"}
+    assert max_in_flight == {"https://host_0.org": 2, "https://host_1.org": 2}
+
+
+def test_download_concurrently_throughput(tmp_path):
+    """Downloads from a slow local server should scale with the number of workers"""
+    number_of_files = 8
+    latency = 0.2
+    files = {f"file_{i}.txt": bytes(f"content {i}", "utf-8") for i in range(8)}
+
+    def download_function(api_url):
+        return (
+            "downloaded"
+            if download_from_url(api_url, download_path=tmp_path)
+            else "failed"
+        )
+
+    with MockDownloadServer(files=files, latency=latency) as server:
+        jobs = {name: {"api_url": f"{server.url}/files/{name}"} for name in files}
+
+        start = time.perf_counter()
+        results = download_concurrently(download_function, jobs, max_workers=1)
+        serial_time = time.perf_counter() - start
+        assert set(results.values()) == {"downloaded"}
+        assert server.max_concurrent_requests == 1
+
+        start = time.perf_counter()
+        results = download_concurrently(
+            download_function, jobs, max_workers=number_of_files, max_per_host=4
+        )
+        parallel_time = time.perf_counter() - start
+        assert set(results.values()) == {"downloaded"}
+        assert server.max_concurrent_requests == 4
+
+    assert serial_time >= number_of_files * latency
+    # 8 files across 4 connections should take about 2 round trips
+    assert parallel_time < serial_time / 2
+    for name, content in files.items():
+        assert (Path(tmp_path) / name).read_bytes() == content
+
+
+def test_get_session():
+    """Sessions are shared per host"""
+    session = get_session("https://data.qdr.syr.edu/api/access/datafile/1")
+    assert session is get_session("https://data.qdr.syr.edu/api/access/datafile/2")
+    assert session is not get_session("https://dataverse.harvard.edu/api/access")
+    close_sessions()
+    assert session is not get_session("https://data.qdr.syr.edu/api/access")
+
+
+def test_download_from_url_reuses_connections(tmp_path):
+    """Serial downloads from one host should use a single keep-alive connection"""
+    files = {f"file_{i}.txt": bytes(f"content {i}", "utf-8") for i in range(5)}
+    close_sessions()
+    reset_connection_stats()
+    with MockDownloadServer(files=files) as server:
+        for name in files:
+            assert download_from_url(
+                f"{server.url}/files/{name}", download_path=tmp_path
+            )
+        # a failed request should not leak its connection
+        assert (
+            download_from_url(f"{server.url}/files/missing", download_path=tmp_path)
+            is None
+        )
+        stats = get_connection_stats()[server.url]
+    assert stats == {"requests": 6, "new_connections": 1, "reused_connections": 5}
+
+
+def test_configure_session_pool(tmp_path):
+    """Concurrent downloads open no more connections than the pool size"""
+    files = {f"file_{i}.txt": bytes(f"content {i}", "utf-8") for i in range(12)}
+
+    def download_function(api_url):
+        return (
+            "downloaded"
+            if download_from_url(api_url, download_path=tmp_path)
+            else "failed"
+        )
+
+    configure_session_pool(pool_size=3)
+    reset_connection_stats()
+    try:
+        with MockDownloadServer(files=files, latency=0.05) as server:
+            jobs = {name: {"api_url": f"{server.url}/files/{name}"} for name in files}
+            results = download_concurrently(
+                download_function, jobs, max_workers=3, max_per_host=3
+            )
+            stats = get_connection_stats()[server.url]
+    finally:
+        configure_session_pool()
+    assert set(results.values()) == {"downloaded"}
+    assert stats["requests"] == 12
+    assert stats["new_connections"] <= 3
+    assert stats["reused_connections"] >= 9
+
+
+def test_download_from_url_resumes_interrupted_download(tmp_path):
+    """Interrupted downloads are resumed with Range requests"""
+    content = os.urandom(100000)
+    with MockDownloadServer(
+        files={"study.zip": content},
+        accept_ranges=True,
+        interruptions=2,
+        interrupt_after=30000,
+    ) as server:
+        download_filename = download_from_url(
+            f"{server.url}/files/study.zip", download_path=tmp_path, chunk_size=8192
+        )
+    assert download_filename == f"{tmp_path}/study.zip"
+    assert Path(download_filename).read_bytes() == content
+    assert list(Path(tmp_path).iterdir()) == [Path(download_filename)]
+    # each attempt resumes from the bytes already written to the part file
+    assert server.range_headers[0] is None
+    resumed_from = [int(header[6:-1]) for header in server.range_headers[1:]]
+    assert len(resumed_from) == 2
+    assert 0 < resumed_from[0] <= 30000 < resumed_from[1] <= 60000
+
+
+def test_download_from_url_keeps_part_file(tmp_path):
+    """Without Range support an interrupted download fails and is restarted later"""
+    content = os.urandom(100000)
+    with MockDownloadServer(
+        files={"study.zip": content}, interruptions=1, interrupt_after=30000
+    ) as server:
+        api_url = f"{server.url}/files/study.zip"
+        part_file = Path(get_part_filename(f"{tmp_path}/study.zip", api_url))
+        assert (
+            download_from_url(api_url, download_path=tmp_path, chunk_size=8192) is None
+        )
+        assert 0 < part_file.stat().st_size <= 30000
+        assert not (Path(tmp_path) / "study.zip").exists()
+
+        download_filename = download_from_url(api_url, download_path=tmp_path)
+    assert Path(download_filename).read_bytes() == content
+    assert not part_file.exists()
+    assert server.range_headers == [None, None]
+
+
+def test_download_from_url_resumes_part_file(tmp_path):
+    """A part file from an earlier call is resumed with an If-Range request"""
+    content = os.urandom(100000)
+    with MockDownloadServer(
+        files={"study.zip": content},
+        accept_ranges=True,
+        validators=True,
+        interruptions=1,
+        interrupt_after=30000,
+    ) as server:
+        api_url = f"{server.url}/files/study.zip"
+        assert (
+            download_from_url(
+                api_url, download_path=tmp_path, chunk_size=8192, max_resume_attempts=0
+            )
+            is None
+        )
+        part_size = Path(get_part_filename(f"{tmp_path}/study.zip", api_url)).stat()
+        download_filename = download_from_url(api_url, download_path=tmp_path)
+    assert Path(download_filename).read_bytes() == content
+    assert list(Path(tmp_path).iterdir()) == [Path(download_filename)]
+    assert server.range_headers == [None, None, f"bytes={part_size.st_size}-"]
+    assert server.if_range_headers[2] == f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def test_download_from_url_discards_stale_part_file(tmp_path):
+    """Part files of another url or of a file that changed are not resumed"""
+    content = os.urandom(100000)
+    with MockDownloadServer(
+        files={"README.txt": content},
+        accept_ranges=True,
+        validators=True,
+        interruptions=1,
+        interrupt_after=30000,
+    ) as server:
+        api_url = f"{server.url}/files/README.txt"
+        assert (
+            download_from_url(
+                api_url, download_path=tmp_path, chunk_size=8192, max_resume_attempts=0
+            )
+            is None
+        )
+        # another url with the same filename
+        download_filename = download_from_url(
+            f"{server.url}/files/README.txt?study=2", download_path=tmp_path
+        )
+        assert Path(download_filename).read_bytes() == content
+        assert Path(get_part_filename(download_filename, api_url)).exists()
+
+        # the file changed since the part file was saved
+        server.files["README.txt"] = new_content = os.urandom(100000)
+        download_filename = download_from_url(api_url, download_path=tmp_path)
+    assert Path(download_filename).read_bytes() == new_content
+    assert list(Path(tmp_path).iterdir()) == [Path(download_filename)]
+    assert server.range_headers == [None, None, None]
+
+
+def write_part_file(tmp_path, api_url: str, content: bytes, etag: str, total: int):
+    """Write the part file of study.zip as left by an earlier call"""
+    part_filename = get_part_filename(f"{tmp_path}/study.zip", api_url)
+    Path(part_filename).write_bytes(content)
+    save_part_info(part_filename, {"etag": etag}, total)
+
+
+def test_download_from_url_range_ignored(tmp_path):
+    """If the server ignores the Range request then the whole file is downloaded"""
+    content = b"0123456789"
+    api_url = "https://data.qdr.test.edu/api/access/datafile/1"
+    write_part_file(tmp_path, api_url, b"01234", '"v1"', len(content))
+    response_headers = {
+        "Content-Type": "application/zip",
+        "Content-Disposition": "application; filename=study.zip",
+        "Accept-Ranges": "bytes",
+        "ETag": '"v1"',
+        "Content-Length": "10",
+    }
+    with requests_mock.Mocker() as m:
+        m.get(api_url, headers=response_headers, content=content)
+        download_filename = download_from_url(api_url, download_path=tmp_path)
+        assert m.request_history[1].headers["Range"] == "bytes=5-"
+        assert m.request_history[1].headers["If-Range"] == '"v1"'
+    assert Path(download_filename).read_bytes() == content
+
+
+def test_download_from_url_content_range_mismatch(tmp_path):
+    """A partial response that does not continue the part file is not used"""
+    content = b"0123456789"
+    api_url = "https://data.qdr.test.edu/api/access/datafile/1"
+    write_part_file(tmp_path, api_url, b"01234", '"v1"', len(content))
+    response_headers = {
+        "Content-Type": "application/zip",
+        "Content-Disposition": "application; filename=study.zip",
+        "Accept-Ranges": "bytes",
+        "ETag": '"v1"',
+        "Content-Length": "10",
+    }
+    with requests_mock.Mocker() as m:
+        m.get(
+            api_url,
+            [
+                {"headers": response_headers, "content": content},
+                {
+                    "status_code": 206,
+                    "headers": {
+                        **response_headers,
+                        "Content-Length": "8",
+                        "Content-Range": "bytes 2-9/10",
+                    },
+                    "content": content[2:],
+                },
+                {"headers": response_headers, "content": content},
+            ],
+        )
+        download_filename = download_from_url(api_url, download_path=tmp_path)
+        assert len(m.request_history) == 3
+        assert "Range" not in m.request_history[2].headers
+    assert Path(download_filename).read_bytes() == content
+
+
+def test_download_from_url_sink(tmp_path):
+    """Downloads are passed to file-like, generator and callable sinks"""
+    content = os.urandom(100000)
+    received = []
+
+    def consumer():
+        try:
+            while True:
+                chunk = yield
+                received.append(bytes(chunk))
+        finally:
+            received.append(b"closed")
+
+    chunks = []
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        api_url = f"{server.url}/files/data.bin"
+        file = io.BytesIO()
+        result = download_from_url(api_url, download_path=tmp_path, sink=file)
+        assert result == "data.bin"
+        assert file.getvalue() == content
+
+        result = download_from_url(api_url, chunk_size=8192, sink=consumer())
+        assert result == "data.bin"
+        assert received.pop() == b"closed"
+        assert b"".join(received) == content
+
+        result = download_from_url(api_url, chunk_size=8192, sink=chunks.append)
+        assert result == "data.bin"
+        assert all(isinstance(chunk, memoryview) for chunk in chunks)
+        assert b"".join(chunks) == content
+    # nothing is written to disk
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_from_url_sink_resumed():
+    """Interrupted downloads to a sink resume from the bytes already passed on"""
+    content = os.urandom(100000)
+    file = io.BytesIO()
+    with MockDownloadServer(
+        files={"data.bin": content},
+        accept_ranges=True,
+        interruptions=1,
+        interrupt_after=30000,
+    ) as server:
+        result = fetch_from_url(
+            f"{server.url}/files/data.bin", chunk_size=8192, sink=file
+        )
+    assert result == DownloadResult(path="data.bin", status="downloaded")
+    assert file.getvalue() == content
+    assert server.range_headers[0] is None
+    assert len(server.range_headers) == 2
+    assert 0 < int(server.range_headers[1][6:-1]) <= 30000
+
+
+def test_download_from_url_sink_errors():
+    """Sink errors and unresumable interruptions fail the download"""
+    content = os.urandom(100000)
+
+    def consumer():
+        yield
+        yield
+
+    with MockDownloadServer(
+        files={"data.bin": content}, interruptions=1, interrupt_after=30000
+    ) as server:
+        api_url = f"{server.url}/files/data.bin"
+        assert download_from_url(api_url, chunk_size=8192, sink=io.BytesIO()) is None
+        assert download_from_url(api_url, chunk_size=8192, sink=consumer()) is None
+    with pytest.raises(TypeError):
+        DownloadSink("not a sink")
+
+
+@pytest.mark.parametrize("failure", ["status", "interrupted"])
+def test_download_from_url_sink_closed(failure):
+    """Generator sinks are closed when the download fails"""
+    closed = []
+
+    def consumer():
+        try:
+            while True:
+                yield
+        finally:
+            closed.append(True)
+
+    with MockDownloadServer(
+        files={"data.bin": os.urandom(100000)}, interruptions=1, interrupt_after=30000
+    ) as server:
+        path = "missing.bin" if failure == "status" else "data.bin"
+        # keep a reference, so the generator is not closed by garbage collection
+        sink = consumer()
+        result = fetch_from_url(
+            f"{server.url}/files/{path}", chunk_size=8192, sink=sink
+        )
+    assert result.status == "failed"
+    assert closed == [True]
+
+
+def test_chunk_reader():
+    """Chunks are read as a buffered file"""
+    chunks = [b"a,b\n1,", b"", b"2\n3", b",4\n"]
+    reader = ChunkReader(chunks)
+    stream = io.BufferedReader(reader, buffer_size=4)
+    assert stream.readline() == b"a,b\n"
+    assert stream.read() == b"1,2\n3,4\n"
+    assert stream.read() == b""
+    assert reader.bytes_read == 12
+
+
+def test_download_hasher():
+    """Hashes are computed incrementally and compared case-insensitively"""
+    content = os.urandom(10000)
+    hasher = DownloadHasher(["MD5", "sha-256"])
+    assert hasher.algorithms == ["md5", "sha256"]
+    for chunk in hasher.iter_chunks([content[:3000], content[3000:]]):
+        pass
+    assert hasher.hexdigests() == {
+        "md5": hashlib.md5(content).hexdigest(),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    assert (
+        hasher.get_mismatches({"MD5": hashlib.md5(content).hexdigest().upper()}) == []
+    )
+    assert hasher.get_mismatches({"sha256": "0" * 64}) == ["sha256"]
+    hasher.reset()
+    assert hasher.hexdigests()["md5"] == hashlib.md5().hexdigest()
+
+
+@pytest.mark.parametrize(
+    "file_metadata, expected",
+    [
+        ({"file_id": "1"}, {}),
+        ({"file_id": "1", "md5sum": "ABC"}, {"md5": "abc"}),
+        (
+            {"file_id": "1", "checksums": {"SHA-256": "def", "md5": "abc"}},
+            {"sha256": "def", "md5": "abc"},
+        ),
+        ({"file_id": "1", "checksums": {"UNF": "UNF:6:abc"}}, {}),
+    ],
+)
+def test_get_checksums(file_metadata, expected):
+    """Checksums are read from file metadata"""
+    assert get_checksums(file_metadata) == expected
+
+
+def test_get_dataverse_checksums():
+    """Checksums are read from the Dataverse file metadata"""
+    base_url = "https://dataverse.test.edu/api"
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"{base_url}/files/101",
+            json={"data": {"dataFile": {"checksum": {"type": "MD5", "value": "AB"}}}},
+        )
+        m.get(
+            f"{base_url}/files/:persistentId/?persistentId=doi:10.70122/FK2/1",
+            json={"data": {"dataFile": {"checksum": {"type": "SHA-1", "value": "cd"}}}},
+        )
+        m.get(f"{base_url}/files/102", status_code=404)
+        # ingested tabular files are served as '.tab' files unless the
+        # original format is requested
+        m.get(
+            f"{base_url}/files/103",
+            json={
+                "data": {
+                    "dataFile": {
+                        "checksum": {"type": "MD5", "value": "ef"},
+                        "tabularData": True,
+                        "originalFileFormat": "text/csv",
+                    }
+                }
+            },
+        )
+        assert get_dataverse_checksums(f"{base_url}/access/datafile/103") == {}
+        assert get_dataverse_checksums(
+            f"{base_url}/access/datafile/103?format=original"
+        ) == {"md5": "ef"}
+        assert get_dataverse_checksums(f"{base_url}/access/datafile/101") == {
+            "md5": "ab"
+        }
+        assert get_dataverse_checksums(
+            f"{base_url}/access/datafile/doi:10.70122/FK2/1"
+        ) == {"sha1": "cd"}
+        assert get_dataverse_checksums(f"{base_url}/access/datafile/102") == {}
+        assert (
+            get_dataverse_checksums(
+                f"{base_url}/access/dataset/:persistentId/?persistentId=doi:1"
+            )
+            == {}
+        )
+        assert m.call_count == 5
+
+
+def test_download_from_url_checksums(tmp_path):
+    """Downloads are verified while they are written"""
+    content = os.urandom(100000)
+    md5 = hashlib.md5(content).hexdigest()
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        api_url = f"{server.url}/files/data.bin"
+        result = fetch_from_url(
+            api_url,
+            download_path=tmp_path,
+            checksums={"md5": md5},
+            hash_algorithms=["sha256"],
+        )
+        assert result == DownloadResult(
+            path=f"{tmp_path}/data.bin",
+            status="downloaded",
+            hashes={"md5": md5, "sha256": hashlib.sha256(content).hexdigest()},
+        )
+
+        result = fetch_from_url(
+            api_url, download_path=tmp_path, filename="bad.bin", checksums={"md5": "0"}
+        )
+        assert result.status == "checksum mismatch"
+        assert result.path is None
+        assert result.hashes == {"md5": md5}
+        assert (
+            download_from_url(
+                api_url,
+                download_path=tmp_path,
+                filename="bad.bin",
+                checksums={"md5": "0"},
+            )
+            is None
+        )
+    # the mismatched file is removed
+    assert [path.name for path in tmp_path.iterdir()] == ["data.bin"]
+
+
+def test_download_from_url_checksums_resumed(tmp_path):
+    """Hashes cover resumed downloads and part files from earlier calls"""
+    content = os.urandom(100000)
+    checksums = {"sha256": hashlib.sha256(content).hexdigest()}
+    with MockDownloadServer(
+        files={"study.zip": content},
+        accept_ranges=True,
+        validators=True,
+        interruptions=2,
+        interrupt_after=30000,
+    ) as server:
+        api_url = f"{server.url}/files/study.zip"
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        write_part_file(tmp_path, api_url, content[:1000], etag, len(content))
+        result = fetch_from_url(
+            api_url,
+            download_path=tmp_path,
+            chunk_size=8192,
+            checksums=checksums,
+        )
+    assert result.status == "downloaded"
+    # the first response is replaced by a Range request for the part file,
+    # which is interrupted and resumed
+    assert server.range_headers[:2] == [None, "bytes=1000-"]
+    assert len(server.range_headers) == 3
+
+
+def test_fetch_from_url_cache_uses_stream_hash(tmp_path):
+    """The cache uses the sha256 computed while downloading"""
+    cache = DownloadCache(tmp_path / "cache")
+    download_dir = tmp_path / "downloads"
+    download_dir.mkdir()
+    with MockDownloadServer(
+        files={"data.bin": b"content"}, validators=True
+    ) as server, mock.patch("heal.utils.get_file_hash") as get_file_hash:
+        result = fetch_from_url(
+            f"{server.url}/files/data.bin", download_path=download_dir, cache=cache
+        )
+    assert result.status == "downloaded"
+    get_file_hash.assert_not_called()
+    assert (
+        tmp_path / "cache" / "blobs" / hashlib.sha256(b"content").hexdigest()
+    ).is_file()
+
+
+@pytest.mark.parametrize("adaptive_chunk_size", [False, True])
+def test_download_from_url_chunk_size(tmp_path, adaptive_chunk_size):
+    """Content is unchanged for any chunk size"""
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    with MockDownloadServer(files={"data.bin": content}) as server:
+        download_filename = download_from_url(
+            f"{server.url}/files/data.bin",
+            download_path=tmp_path,
+            chunk_size=1000,
+            adaptive_chunk_size=adaptive_chunk_size,
+        )
+    assert Path(download_filename).read_bytes() == content
+
+
+def test_iter_response_chunks_adaptive():
+    """Adaptive chunks grow when the stream is fast"""
+    content = os.urandom(8 * 1024 * 1024)
+    api_url = "https://data.qdr.test.edu/api/access/datafile/1"
+    with requests_mock.Mocker() as m:
+        m.get(api_url, content=content)
+        response = requests.get(api_url, stream=True)
+        chunk_sizes = [
+            len(data)
+            for data in iter_response_chunks(response, MIN_CHUNK_SIZE, adaptive=True)
+        ]
+    assert sum(chunk_sizes) == len(content)
+    assert chunk_sizes[0] == MIN_CHUNK_SIZE
+    assert max(chunk_sizes) == MAX_CHUNK_SIZE
+
+
+class UnseekableStream:
+    """Write-only stream, so that ZipFile writes members with data descriptors"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+def make_zip(members: dict, seekable: bool = True, compression=zipfile.ZIP_DEFLATED):
+    """Make zip file content from a dict of member name to content"""
+    stream = io.BytesIO() if seekable else UnseekableStream()
+    with zipfile.ZipFile(stream, "w", compression=compression) as package:
+        for name, content in members.items():
+            package.writestr(name, content)
+    return stream.getvalue() if seekable else stream.buffer.getvalue()
+
+
+def read_tree(directory) -> dict:
+    """Get a dict of relative path to content for every file and dir in a directory"""
+    tree = {}
+    for path in sorted(Path(directory).rglob("*")):
+        relative_path = str(path.relative_to(directory))
+        tree[relative_path] = None if path.is_dir() else path.read_bytes()
+    return tree
+
+
+ZIP_MEMBERS = {
+    "MANIFEST.TXT": b"manifest",
+    "data/": b"",
+    "data/measures.csv": b"id,value\n" + b"1,2\n" * 50000,
+    "data/random.bin": os.urandom(200000),
+    "data/empty.txt": b"",
+    "/absolute/path.txt": b"absolute",
+    "../outside.txt": b"outside",
+    "data/./nested/../file.txt": b"dots",
+}
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+@pytest.mark.parametrize("chunk_size", [7, 65536])
+def test_streaming_zip_extractor(tmp_path, seekable, chunk_size):
+    """Streaming extraction matches ZipFile.extractall"""
+    content = make_zip(ZIP_MEMBERS, seekable=seekable)
+    zip_path = tmp_path / "expected" / "package.zip"
+    zip_path.parent.mkdir()
+    zip_path.write_bytes(content)
+    with zipfile.ZipFile(zip_path) as package:
+        package.extractall(zip_path.parent)
+    zip_path.unlink()
+
+    extractor = StreamingZipExtractor(tmp_path / "streamed")
+    for i in range(0, len(content), chunk_size):
+        extractor.write(content[i : i + chunk_size])
+    extractor.close()
+
+    assert read_tree(tmp_path / "streamed") == read_tree(tmp_path / "expected")
+    assert not (tmp_path / "outside.txt").exists()
+    assert extractor.bytes_received == len(content)
+    assert extractor.bytes_written == sum(len(data) for data in ZIP_MEMBERS.values())
+
+
+def test_streaming_zip_extractor_errors(tmp_path):
+    """Incomplete, corrupt and unsupported zip streams raise errors"""
+    content = make_zip(ZIP_MEMBERS)
+
+    extractor = StreamingZipExtractor(tmp_path)
+    extractor.write(content[:1000])
+    with pytest.raises(zipfile.BadZipFile):
+        extractor.close()
+
+    corrupt_content = bytearray(content)
+    corrupt_content[200] ^= 0xFF
+    extractor = StreamingZipExtractor(tmp_path)
+    with pytest.raises(zipfile.BadZipFile):
+        extractor.write(bytes(corrupt_content))
+        extractor.close()
+
+    # stored members with a data descriptor have no size in the local header
+    content = make_zip(ZIP_MEMBERS, seekable=False, compression=zipfile.ZIP_STORED)
+    extractor = StreamingZipExtractor(tmp_path)
+    with pytest.raises(StreamingZipError):
+        extractor.write(content)
+
+
+def test_download_from_url_extract_zip(tmp_path):
+    """A zip file is extracted while downloading without saving the zip"""
+    content = make_zip(ZIP_MEMBERS, seekable=False)
+    with MockDownloadServer(files={"study.zip": content}) as server:
+        result = download_from_url(
+            f"{server.url}/files/study.zip", download_path=tmp_path, extract_zip=True
+        )
+    assert result == str(tmp_path)
+    assert not (tmp_path / "study.zip").exists()
+    assert not list(tmp_path.glob("*.part"))
+    assert (tmp_path / "data" / "measures.csv").read_bytes() == ZIP_MEMBERS[
+        "data/measures.csv"
+    ]
+
+
+def test_download_from_url_extract_zip_resumed(tmp_path):
+    """Streaming extraction continues after an interrupted download is resumed"""
+    content = make_zip(ZIP_MEMBERS, seekable=False)
+    with MockDownloadServer(
+        files={"study.zip": content},
+        accept_ranges=True,
+        interruptions=1,
+        interrupt_after=100000,
+    ) as server:
+        result = download_from_url(
+            f"{server.url}/files/study.zip",
+            download_path=tmp_path,
+            extract_zip=True,
+            chunk_size=8192,
+        )
+    assert result == str(tmp_path)
+    assert server.range_headers[1].startswith("bytes=")
+    assert (tmp_path / "data" / "random.bin").read_bytes() == ZIP_MEMBERS[
+        "data/random.bin"
+    ]
+
+
+def test_download_from_url_extract_zip_fallback(tmp_path):
+    """Zip files that cannot be extracted while streaming are saved to disk"""
+    content = make_zip(ZIP_MEMBERS, seekable=False, compression=zipfile.ZIP_STORED)
+    with MockDownloadServer(files={"study.zip": content}) as server:
+        result = download_from_url(
+            f"{server.url}/files/study.zip", download_path=tmp_path, extract_zip=True
+        )
+    assert result == f"{tmp_path}/study.zip"
+    assert Path(result).read_bytes() == content
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_unpackage_object(tmp_path, max_workers):
+    """Parallel extraction gives the same files as ZipFile.extractall"""
+    members = {
+        **ZIP_MEMBERS,
+        **{f"many/file_{i}.txt": bytes(f"file {i}", "utf-8") * i for i in range(300)},
+        "large.bin": os.urandom(5 * 1024 * 1024),
+    }
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as package:
+        for name, data in members.items():
+            package.writestr(name, data)
+        # a duplicate member name, the later member wins
+        with pytest.warns(UserWarning, match="Duplicate name"):
+            package.writestr("MANIFEST.TXT", b"updated manifest")
+    content = stream.getvalue()
+
+    for directory in ["expected", "parallel"]:
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "package.zip").write_bytes(content)
+    with zipfile.ZipFile(tmp_path / "expected" / "package.zip") as package:
+        package.extractall(tmp_path / "expected")
+
+    unpackage_object(tmp_path / "parallel" / "package.zip", max_workers=max_workers)
+
+    assert read_tree(tmp_path / "parallel") == read_tree(tmp_path / "expected")
+    assert (tmp_path / "parallel" / "MANIFEST.TXT").read_bytes() == b"updated manifest"
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_unpackage_object_exclude(tmp_path, max_workers):
+    """Excluded members are not extracted"""
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, "w") as package:
+        for name, data in ZIP_MEMBERS.items():
+            package.writestr(name, data)
+    for directory in ["expected", "excluded"]:
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "package.zip").write_bytes(stream.getvalue())
+    with zipfile.ZipFile(tmp_path / "expected" / "package.zip") as package:
+        package.extractall(tmp_path / "expected")
+    (tmp_path / "expected" / "MANIFEST.TXT").unlink()
+
+    unpackage_object(
+        tmp_path / "excluded" / "package.zip",
+        max_workers=max_workers,
+        exclude={"MANIFEST.TXT"},
+    )
+    assert read_tree(tmp_path / "excluded") == read_tree(tmp_path / "expected")
+
+
+def test_unpack_download(tmp_path):
+    """Downloaded zip files are unpacked and removed, other files are kept"""
+    zip_path = tmp_path / "study.zip"
+    with zipfile.ZipFile(zip_path, "w") as package:
+        package.writestr("data.csv", b"a,b\n1,2\n")
+    result = DownloadResult(path=str(zip_path), status="downloaded")
+    assert unpack_download("study", result, 1, PhaseTimer()) == "downloaded"
+    assert [path.name for path in tmp_path.iterdir()] == ["data.csv"]
+
+    zip_path.write_bytes(b"not a zip file")
+    result = DownloadResult(path=str(zip_path), status="downloaded")
+    assert unpack_download("study", result, 1, PhaseTimer()) == "failed"
+    assert not zip_path.exists()
+
+    result = DownloadResult(path=str(tmp_path / "data.csv"), status="cached")
+    assert unpack_download("file", result, 1, PhaseTimer()) == "cached"
+    assert unpack_download("file", DownloadResult(), 1, PhaseTimer()) == "failed"
+
+
+def test_get_extraction_batches():
+    """Members are batched largest first, small members are grouped"""
+    sizes = [10, 500, 20, 1000, 30, 40]
+    members = []
+    for i, size in enumerate(sizes):
+        member = zipfile.ZipInfo(f"file_{i}")
+        member.file_size = size
+        members.append(member)
+    batches = get_extraction_batches(members, batch_size=100)
+    assert [[member.file_size for member in batch] for batch in batches] == [
+        [1000],
+        [500],
+        [40, 30, 20, 10],
+    ]
+
+
+def test_fetch_from_url_cache(tmp_path):
+    """Unmodified files are revalidated and served from the cache"""
+    cache = DownloadCache(tmp_path / "cache")
+    download_dir = tmp_path / "download"
+    download_dir.mkdir()
+    content = os.urandom(10000)
+    with MockDownloadServer(files={"data.bin": content}, validators=True) as server:
+        api_url = f"{server.url}/files/data.bin"
+        result = fetch_from_url(
+            api_url, download_path=download_dir, cache=cache, file_id="file_01"
+        )
+        assert result == DownloadResult(
+            path=f"{download_dir}/data.bin", status="downloaded"
+        )
+
+        result = fetch_from_url(
+            api_url, download_path=download_dir, cache=cache, file_id="file_01"
+        )
+        assert result == DownloadResult(
+            path=f"{download_dir}/data.bin", status="cached"
+        )
+        assert Path(result.path).read_bytes() == content
+
+        # the cache restores files to a new download path
+        other_dir = tmp_path / "other"
+        other_dir.mkdir()
+        result = fetch_from_url(
+            api_url, download_path=other_dir, cache=cache, file_id="file_01"
+        )
+        assert result.status == "cached"
+        assert Path(result.path).read_bytes() == content
+
+        # modified file is downloaded again
+        server.files["data.bin"] = b"new content"
+        result = fetch_from_url(
+            api_url, download_path=download_dir, cache=cache, file_id="file_01"
+        )
+        assert result.status == "downloaded"
+        assert Path(result.path).read_bytes() == b"new content"
+
+    assert server.status_codes == [200, 304, 304, 200]
+    # the index is saved with the cache
+    entry = DownloadCache(tmp_path / "cache").get_entry(
+        DownloadCache.get_key(api_url, "file_01")
+    )
+    assert entry["size"] == len(b"new content")
+    assert entry["filename"] == "data.bin"
+
+
+def test_fetch_from_url_without_validators(tmp_path):
+    """Responses without ETag or Last-Modified are not cached"""
+    cache = DownloadCache(tmp_path / "cache")
+    with MockDownloadServer(files={"data.bin": b"content"}) as server:
+        api_url = f"{server.url}/files/data.bin"
+        for _ in range(2):
+            result = fetch_from_url(api_url, download_path=tmp_path, cache=cache)
+            assert result.status == "downloaded"
+    assert cache.get_entry(DownloadCache.get_key(api_url)) is None
+
+
+def test_download_cache_eviction(tmp_path):
+    """Least recently used entries are evicted beyond max_size"""
+    cache = DownloadCache(tmp_path / "cache", max_size=250)
+    for name in ["a", "b", "c"]:
+        path = tmp_path / name
+        path.write_bytes(os.urandom(100))
+        assert cache.store(name, path, etag=f'"{name}"')
+        # use "a" so that "b" is least recently used
+        if name == "b":
+            assert cache.restore("a", tmp_path / "a_copy")
+    assert cache.get_entry("a") is not None
+    assert cache.get_entry("b") is None
+    assert cache.get_entry("c") is not None
+    assert len(list(cache.blob_dir.iterdir())) == 2
+
+    # identical content is stored once
+    (tmp_path / "d").write_bytes((tmp_path / "c").read_bytes())
+    assert cache.store("d", tmp_path / "d", last_modified="yesterday")
+    assert cache.get_entry("c")["sha256"] == cache.get_entry("d")["sha256"]
+    assert len(list(cache.blob_dir.iterdir())) == 2
+
+
+def test_download_cache_restored_file_is_a_copy(tmp_path):
+    """Editing a downloaded or restored file does not change the cache"""
+    cache = DownloadCache(tmp_path / "cache")
+    path = tmp_path / "data.csv"
+    path.write_bytes(b"a,b\n1,2\n")
+    assert cache.store("data", path, etag='"v1"')
+    with open(path, "ab") as file:
+        file.write(b"3,4\n")
+
+    restored_path = tmp_path / "restored.csv"
+    assert cache.restore("data", restored_path)
+    assert restored_path.read_bytes() == b"a,b\n1,2\n"
+    with open(restored_path, "r+b") as file:
+        file.write(b"x")
+    assert cache.restore("data", tmp_path / "restored_again.csv")
+    assert (tmp_path / "restored_again.csv").read_bytes() == b"a,b\n1,2\n"
+
+
+def make_jwt(exp: float) -> str:
+    """Make an unsigned JWT with an expiry"""
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).rstrip(b"=")
+    return f"header.{payload.decode()}.signature"
+
+
+def test_get_token_expiry():
+    """Test the expiry of JWT and opaque tokens"""
+    assert get_token_expiry(make_jwt(1700000000)) == 1700000000
+    assert get_token_expiry("some-idp-token") is None
+    assert get_token_expiry(None) is None
+
+
+@pytest.mark.parametrize(
+    "lifetime, expected_calls",
+    [
+        # tokens are reused until they are close to expiry
+        (3600, 1),
+        (30, 3),
+        # opaque tokens are kept for DEFAULT_TOKEN_TTL
+        (None, 1),
+    ],
+)
+def test_get_idp_access_token_cache(lifetime, expected_calls):
+    """Test that idp tokens are cached until they need to be refreshed"""
+    token = make_jwt(time.time() + lifetime) if lifetime else "some-idp-token"
+    mock_auth = MagicMock()
+    file_metadata = {"external_oidc_idp": "test-idp"}
+    with mock.patch("heal.utils.wts_get_token", return_value=token) as wts_get_token:
+        for _ in range(3):
+            assert get_idp_access_token("wts.org", mock_auth, file_metadata) == token
+    assert wts_get_token.call_count == expected_calls
+    assert mock_auth.get_access_token.call_count == expected_calls
+
+
+def test_get_idp_access_token_cache_keys():
+    """Test that tokens are cached per wts_hostname and idp"""
+    mock_auth = MagicMock()
+    with mock.patch(
+        "heal.utils.wts_get_token",
+        side_effect=lambda hostname, idp, access_token: f"{hostname}-{idp}",
+    ) as wts_get_token:
+        for _ in range(2):
+            for hostname in ["wts.org", "other-wts.org"]:
+                for idp in ["idp_a", "idp_b"]:
+                    token = get_idp_access_token(
+                        hostname, mock_auth, {"external_oidc_idp": idp}
+                    )
+                    assert token == f"{hostname}-{idp}"
+    assert wts_get_token.call_count == 4
+
+
+def make_auth(api_key: str, endpoint: str = "https://commons.org") -> MagicMock:
+    """Make a Gen3Auth with an api key, returning the api key as its access token"""
+    auth = MagicMock(spec=Gen3Auth)
+    auth.endpoint = endpoint
+    auth._refresh_token = {"api_key": api_key}
+    auth._client_credentials = None
+    auth.get_access_token.return_value = api_key
+    return auth
+
+
+def test_get_idp_access_token_cache_auth():
+    """Test that tokens are cached per auth identity for the same wts_hostname"""
+    file_metadata = {"external_oidc_idp": "test-idp"}
+    with mock.patch(
+        "heal.utils.wts_get_token",
+        side_effect=lambda hostname, idp, access_token: f"{access_token}-idp-token",
+    ) as wts_get_token:
+        for _ in range(2):
+            for api_key in ["user_a", "user_b"]:
+                token = get_idp_access_token(
+                    "wts.org", make_auth(api_key), file_metadata
+                )
+                assert token == f"{api_key}-idp-token"
+        # auth objects with the same api key share their tokens
+        assert wts_get_token.call_count == 2
+
+        # auth objects without an api key are cached per object
+        auth_a, auth_b = MagicMock(), MagicMock()
+        auth_a.get_access_token.return_value = "wts_user_a"
+        auth_b.get_access_token.return_value = "wts_user_b"
+        for auth, user in [(auth_a, "wts_user_a"), (auth_b, "wts_user_b")] * 2:
+            token = get_idp_access_token("wts.org", auth, file_metadata)
+            assert token == f"{user}-idp-token"
+    assert wts_get_token.call_count == 4
+
+
+def test_get_idp_access_token_refresh_failure():
+    """Test that an unexpired token is used when a refresh fails"""
+    token = make_jwt(time.time() + 30)
+    mock_auth = MagicMock()
+    file_metadata = {"external_oidc_idp": "test-idp"}
+    with mock.patch("heal.utils.wts_get_token", return_value=token):
+        assert get_idp_access_token("wts.org", mock_auth, file_metadata) == token
+    with mock.patch("heal.utils.wts_get_token", side_effect=Exception("wts is down")):
+        assert get_idp_access_token("wts.org", mock_auth, file_metadata) == token
+
+    # expired tokens are not used
+    clear_token_cache()
+    with mock.patch("heal.utils.wts_get_token", return_value=make_jwt(time.time() - 1)):
+        get_idp_access_token("wts.org", mock_auth, file_metadata)
+    with mock.patch("heal.utils.wts_get_token", side_effect=Exception("wts is down")):
+        assert get_idp_access_token("wts.org", mock_auth, file_metadata) is None
+
+
+def test_get_idp_access_token_concurrent():
+    """Test that concurrent callers share a single token request"""
+
+    def slow_wts_get_token(hostname, idp, access_token):
+        time.sleep(0.1)
+        return "some-idp-token"
+
+    mock_auth = MagicMock()
+    with mock.patch(
+        "heal.utils.wts_get_token", side_effect=slow_wts_get_token
+    ) as wts_get_token:
+        results = download_concurrently(
+            lambda api_url: get_idp_access_token(
+                "wts.org", mock_auth, {"external_oidc_idp": "test-idp"}
+            ),
+            {i: {"api_url": f"https://host{i}.org"} for i in range(8)},
+            max_workers=8,
+        )
+    assert set(results.values()) == {"some-idp-token"}
+    assert wts_get_token.call_count == 1
+
+
+FAST_RETRY_POLICY = RetryPolicy(backoff_factor=0.01, max_backoff=0.5)
+
+
+@pytest.mark.parametrize("status_code", [429, 500, 502, 503, 504])
+def test_download_from_url_retry(tmp_path, status_code):
+    """Throttled and failed requests are retried"""
+    with MockDownloadServer(
+        files={"data.bin": b"content"}, failures=[status_code, status_code]
+    ) as server:
+        api_url = f"{server.url}/files/data.bin"
+        result = download_from_url(
+            api_url, download_path=tmp_path, retry_policy=FAST_RETRY_POLICY
+        )
+    assert result == f"{tmp_path}/data.bin"
+    assert server.status_codes == [status_code, status_code, 200]
+
+
+def test_download_from_url_no_retry(tmp_path):
+    """Requests are not retried without a policy, or for other status codes"""
+    with MockDownloadServer(files={"data.bin": b"content"}, failures=[503]) as server:
+        api_url = f"{server.url}/files/data.bin"
+        assert download_from_url(api_url, download_path=tmp_path) is None
+        assert server.status_codes == [503]
+
+    with MockDownloadServer(files={"data.bin": b"content"}, failures=[403]) as server:
+        api_url = f"{server.url}/files/data.bin"
+        assert (
+            download_from_url(
+                api_url, download_path=tmp_path, retry_policy=FAST_RETRY_POLICY
+            )
+            is None
+        )
+        assert server.status_codes == [403]
+
+
+def test_download_from_url_retries_exhausted(tmp_path):
+    """Download fails after max_retries"""
+    retry_policy = RetryPolicy(max_retries=2, backoff_factor=0.01)
+    with MockDownloadServer(
+        files={"data.bin": b"content"}, failures=[503] * 5
+    ) as server:
+        api_url = f"{server.url}/files/data.bin"
+        assert (
+            download_from_url(
+                api_url, download_path=tmp_path, retry_policy=retry_policy
+            )
+            is None
+        )
+    assert server.status_codes == [503] * 3
+
+
+def test_download_from_url_retry_after(tmp_path):
+    """The Retry-After header is used as the backoff"""
+    retry_policy = RetryPolicy(backoff_factor=0.0)
+    with MockDownloadServer(
+        files={"data.bin": b"content"}, failures=[429], retry_after="0.3"
+    ) as server:
+        api_url = f"{server.url}/files/data.bin"
+        assert download_from_url(
+            api_url, download_path=tmp_path, retry_policy=retry_policy
+        )
+    assert server.request_times[1] - server.request_times[0] >= 0.3
+
+
+def test_download_from_url_retry_connection_error(tmp_path):
+    """Connection errors are retried"""
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://test.org/files/data.bin",
+            [
+                {"exc": requests.exceptions.ConnectTimeout},
+                {"exc": requests.exceptions.ConnectionError},
+                {"content": b"content"},
+            ],
+        )
+        result = download_from_url(
+            "https://test.org/files/data.bin",
+            download_path=tmp_path,
+            retry_policy=FAST_RETRY_POLICY,
+        )
+    assert result == f"{tmp_path}/data.bin"
+    assert m.call_count == 3
+
+
+def test_get_response_timeout():
+    """A server that does not answer in time is retried and then given up on"""
+    retry_policy = RetryPolicy(max_retries=1, backoff_factor=0.01)
+    with MockDownloadServer(files={"data.bin": b"content"}, latency=1.0) as server:
+        start_time = time.monotonic()
+        response = get_response(
+            f"{server.url}/files/data.bin",
+            retry_policy=retry_policy,
+            timeout=(1.0, 0.1),
+        )
+        assert response is None
+        assert time.monotonic() - start_time < 1.0
+        assert server.request_count == 2
+
+
+def test_retry_policy_backoff():
+    """Backoff grows exponentially with full jitter, up to max_backoff"""
+    retry_policy = RetryPolicy(backoff_factor=1.0, max_backoff=5.0, jitter=False)
+    assert [retry_policy.get_backoff(attempt) for attempt in range(5)] == [
+        1.0,
+        2.0,
+        4.0,
+        5.0,
+        5.0,
+    ]
+    assert retry_policy.get_backoff(0, retry_after=3.0) == 3.0
+    assert retry_policy.get_backoff(0, retry_after=100.0) == 5.0
+    assert retry_policy.get_backoff(0, retry_after=-1.0) == 0.0
+
+    retry_policy = RetryPolicy(backoff_factor=1.0, max_backoff=5.0)
+    backoffs = [retry_policy.get_backoff(2) for _ in range(100)]
+    assert all(0 <= backoff <= 4.0 for backoff in backoffs)
+    assert len(set(backoffs)) > 1
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected",
+    [
+        ("120", 120.0),
+        (None, None),
+        ("soon", None),
+    ],
+)
+def test_get_retry_after(retry_after, expected):
+    """Test parsing the Retry-After header"""
+    response = requests.Response()
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    assert get_retry_after(response) == expected
+
+
+def test_get_retry_after_date():
+    """Test a Retry-After header with an http date"""
+    response = requests.Response()
+    response.headers["Retry-After"] = email.utils.formatdate(
+        time.time() + 60, usegmt=True
+    )
+    assert 55 < get_retry_after(response) <= 60
+
+
+def test_get_datafile_batches():
+    """Dataverse file jobs are grouped by base url and idp"""
+    qdr = "https://data.qdr.syr.edu/api/access"
+    harvard = "https://dataverse.harvard.edu/api/access"
+
+    def job(api_url, **file_metadata):
+        return {"api_url": api_url, "file_metadata": file_metadata}
+
+    jobs = {
+        "1": job(f"{harvard}/datafile/1"),
+        "2": job(f"{harvard}/datafile/2"),
+        "3": job(f"{harvard}/datafile/3"),
+        "4": job(f"{qdr}/datafile/4", external_oidc_idp="idp"),
+        "5": job(f"{qdr}/datafile/5", external_oidc_idp="idp"),
+        "6": job(f"{qdr}/datafile/6", external_oidc_idp="other-idp"),
+        "7": job(f"{harvard}/datafile/7", filename="custom.csv"),
+        "doi:study": job(f"{harvard}/dataset/:persistentId/?persistentId=doi:study"),
+        "file_id": job(f"{harvard}/datafile/file_id"),
+    }
+    batches, single_jobs = get_datafile_batches(jobs, batch_size=2)
+    assert {url: list(batch) for url, batch in batches.items()} == {
+        f"{harvard}/datafiles/1,2": ["1", "2"],
+        f"{qdr}/datafiles/4,5": ["4", "5"],
+    }
+    assert batches[f"{harvard}/datafiles/1,2"]["1"] is jobs["1"]
+    assert sorted(single_jobs) == ["3", "6", "7", "doi:study", "file_id"]
+
+    batches, single_jobs = get_datafile_batches(jobs, batch_size=10)
+    assert list(batches) == [
+        f"{harvard}/datafiles/1,2,3",
+        f"{qdr}/datafiles/4,5",
+    ]
+
+
+def test_token_bucket():
+    """Consumers wait once the burst capacity is used"""
+    bucket = TokenBucket(rate=1000, capacity=100)
+    start_time = time.perf_counter()
+    bucket.consume(100)
+    assert time.perf_counter() - start_time < 0.05
+    for _ in range(3):
+        bucket.consume(100)
+    assert time.perf_counter() - start_time >= 0.25
+
+
+def test_download_scheduler_shortest_first(tmp_path):
+    """Jobs with the smallest Content-Length run first"""
+    files = {
+        "large.bin": b"x" * 30000,
+        "small.bin": b"x" * 10,
+        "medium.bin": b"x" * 2000,
+    }
+    with MockDownloadServer(files=files) as server, DownloadScheduler(
+        max_workers=1
+    ) as scheduler:
+        jobs = {
+            name: {"api_url": f"{server.url}/files/{name}", "download_path": tmp_path}
+            for name in [*files, "missing.bin"]
+        }
+        results = scheduler.run(download_from_url, jobs)
+    assert list(results) == list(jobs)
+    assert results["missing.bin"] is None
+    assert [path for method, path in server.requests if method == "GET"] == [
+        "/files/small.bin",
+        "/files/medium.bin",
+        "/files/large.bin",
+        "/files/missing.bin",
+    ]
+
+
+def test_download_scheduler_head_headers():
+    """HEAD requests have the job headers, and jobs with an auth are not sized"""
+    api_url = "https://dataverse.test.edu/api/access/datafile/1"
+    with requests_mock.Mocker() as m:
+        m.head(api_url, headers={"Content-Length": "10"})
+        scheduler = DownloadScheduler()
+        sizes = scheduler.get_expected_sizes(
+            {
+                "file": {"api_url": api_url, "headers": {"Authorization": "Bearer t"}},
+                "qdr_file": {"api_url": api_url, "auth": MagicMock()},
+            }
+        )
+        scheduler.shutdown()
+        assert sizes == {"file": 10, "qdr_file": None}
+        assert m.call_count == 1
+        assert m.request_history[0].headers["Authorization"] == "Bearer t"
+
+
+def test_download_scheduler_base_exception():
+    """A job interrupted by a BaseException does not leave run() waiting"""
+
+    class Interrupt(BaseException):
+        pass
+
+    def download_function(api_url):
+        raise Interrupt()
+
+    with DownloadScheduler(shortest_first=False) as scheduler:
+        with pytest.raises(Interrupt):
+            scheduler.run(download_function, {"a": {"api_url": "https://a.org/1"}})
+        # the scheduler can still run jobs
+        assert scheduler.run(
+            lambda api_url: "downloaded", {"b": {"api_url": "https://a.org/2"}}
+        ) == {"b": "downloaded"}
+
+
+def test_download_scheduler_bandwidth(tmp_path):
+    """The total bandwidth of concurrent downloads is limited"""
+    files = {f"file_{i}.bin": os.urandom(100000) for i in range(3)}
+    with MockDownloadServer(files=files) as server, DownloadScheduler(
+        max_workers=3, bandwidth=200000, shortest_first=False
+    ) as scheduler:
+        jobs = {
+            name: {
+                "api_url": f"{server.url}/files/{name}",
+                "download_path": tmp_path,
+                "chunk_size": 8192,
+            }
+            for name in files
+        }
+        start_time = time.perf_counter()
+        scheduler.run(download_from_url, jobs)
+        elapsed = time.perf_counter() - start_time
+    # 200000 bytes of burst, then 100000 bytes at 200000 bytes/second
+    assert elapsed >= 0.45
+    for name, content in files.items():
+        assert (tmp_path / name).read_bytes() == content
+
+    # downloads outside the scheduler are not limited
+    with MockDownloadServer(files=files) as server:
+        start_time = time.perf_counter()
+        for name in files:
+            download_from_url(f"{server.url}/files/{name}", download_path=tmp_path)
+        assert time.perf_counter() - start_time < 0.45
+
+
+def test_download_scheduler_request_rate(tmp_path):
+    """Requests to each host are limited to requests_per_second"""
+    files = {f"file_{i}.bin": b"content" for i in range(4)}
+    with MockDownloadServer(files=files) as server, DownloadScheduler(
+        max_workers=4, requests_per_second=10
+    ) as scheduler:
+        jobs = {
+            name: {"api_url": f"{server.url}/files/{name}", "download_path": tmp_path}
+            for name in files
+        }
+        scheduler.run(download_from_url, jobs)
+    # HEAD and GET requests are both limited
+    assert len(server.requests) == 8
+    assert server.request_times[-1] - server.request_times[0] >= 0.25
+
+
+def test_download_scheduler_shared_limits(tmp_path):
+    """Jobs submitted from several threads share max_workers and max_per_host"""
+    files = {f"file_{i}.bin": b"content" for i in range(8)}
+    with MockDownloadServer(files=files, latency=0.05) as server, DownloadScheduler(
+        max_workers=4, max_per_host=2, shortest_first=False
+    ) as scheduler:
+        results = {}
+
+        def submit(names):
+            jobs = {
+                name: {
+                    "api_url": f"{server.url}/files/{name}",
+                    "download_path": tmp_path,
+                }
+                for name in names
+            }
+            results.update(scheduler.run(download_from_url, jobs))
+
+        threads = [
+            threading.Thread(target=submit, args=(list(files)[i::2],)) for i in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert len(results) == 8
+    assert all(results.values())
+    assert server.max_concurrent_requests == 2
@@ -0,0 +1,68 @@
+"""
+Benchmarks for the per-call cost of VLMD validation, with the validators built
+for every call and with the cached validators.
+
+The benchmarks need pytest-benchmark and are skipped without it:
+    pip install pytest-benchmark
+    pytest tests/test_vlmd_benchmarks.py --benchmark-columns=mean,rounds
+"""
+
+import importlib.util
+import json
+
+import pytest
+
+from heal.vlmd import vlmd_validate
+from heal.vlmd.validate.json_validator import vlmd_validate_json
+from heal.vlmd.validate.utils import clear_validator_cache
+
+requires_benchmark = pytest.mark.skipif(
+    importlib.util.find_spec("pytest_benchmark") is None,
+    reason="pytest-benchmark is not installed",
+)
+
+ROUNDS = 50
+JSON_FILE = "tests/test_data/vlmd/valid/vlmd_valid.json"
+CSV_FILE = "tests/test_data/vlmd/valid/vlmd_valid.csv"
+
+
+def run_benchmark(benchmark, validate, cached: bool):
+    """
+    Benchmark a validation call, clearing the validator cache before each
+    round unless cached.
+    """
+
+    def setup():
+        if not cached:
+            clear_validator_cache()
+
+    clear_validator_cache()
+    validate()
+    return benchmark.pedantic(validate, setup=setup, rounds=ROUNDS, iterations=1)
+
+
+@requires_benchmark
+@pytest.mark.parametrize("cached", [False, True])
+def test_benchmark_vlmd_validate_json(benchmark, cached):
+    """vlmd_validate_json with a json dictionary"""
+    with open(JSON_FILE) as f:
+        data = json.load(f)
+    assert run_benchmark(
+        benchmark, lambda: vlmd_validate_json(data, schema_type="json"), cached
+    )
+
+
+@requires_benchmark
+@pytest.mark.parametrize("cached", [False, True])
+def test_benchmark_vlmd_validate_json_input(benchmark, cached):
+    """vlmd_validate with a json dictionary"""
+    with open(JSON_FILE) as f:
+        data = json.load(f)
+    assert run_benchmark(benchmark, lambda: vlmd_validate(data), cached)
+
+
+@requires_benchmark
+@pytest.mark.parametrize("cached", [False, True])
+def test_benchmark_vlmd_validate_csv(benchmark, cached):
+    """vlmd_validate with a csv dictionary file, converted to json"""
+    assert run_benchmark(benchmark, lambda: vlmd_validate(CSV_FILE), cached)
@@ -0,0 +1,127 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+
+from heal.vlmd.extract.conversion import convert_to_vlmd
+from heal.vlmd.validate.column_validator import (
+    MIN_COLUMN_VALIDATION_ROWS,
+    find_flagged_rows,
+    is_column_data,
+    is_records_schema,
+)
+from heal.vlmd.validate.utils import (
+    CSV_ARRAY_SCHEMA,
+    build_validator,
+    validate_instance,
+)
+
+ROWS = MIN_COLUMN_VALIDATION_ROWS + 10
+
+
+@pytest.fixture(scope="module")
+def csv_records():
+    """Records of a converted csv dictionary, repeated to ROWS records"""
+    fields = convert_to_vlmd(
+        "tests/test_data/vlmd/valid/vlmd_valid.csv", input_type="csv-data-dict"
+    )["template_csv"]["fields"]
+    return [dict(fields[index % len(fields)]) for index in range(ROWS)]
+
+
+def get_error(validate):
+    try:
+        validate()
+    except ValidationError as err:
+        return (err.message, list(err.absolute_path), list(err.absolute_schema_path))
+    return None
+
+
+def test_column_validation_differential(csv_records):
+    """Column validation raises the same errors as validating every record"""
+    validator = build_validator(CSV_ARRAY_SCHEMA, True, backend="fast")
+    values = [None, True, 1, 1.0, 1.5, "", "a|b", "x=1", [], {"a": 1}]
+    checked = 0
+    for key in csv_records[0]:
+        for value in values:
+            for row in [3, ROWS - 1]:
+                records = copy.copy(csv_records)
+                records[row] = {**records[row], key: value}
+                expected = best_match(validator.iter_errors(records))
+                error = get_error(lambda: validate_instance(validator, records))
+                assert error == (
+                    expected
+                    and (
+                        expected.message,
+                        list(expected.absolute_path),
+                        list(expected.absolute_schema_path),
+                    )
+                )
+                checked += 1
+    assert checked > 300
+
+
+def test_column_validation_errors(csv_records):
+    """The best error of all the flagged records is raised, with its row index"""
+    validator = build_validator(CSV_ARRAY_SCHEMA, True, backend="jsonschema")
+    records = copy.copy(csv_records)
+    records[10] = {**records[10], "constraints.maxLength": "x"}
+    records[50] = {**records[50], "constraints.maxLength": "y", "custom": "z"}
+
+    expected = best_match(validator.iter_errors(records))
+    with pytest.raises(ValidationError) as err:
+        validate_instance(validator, records)
+    assert (
+        err.value.message
+        == expected.message
+        == "'z' does not match "
+        + repr(validator.schema["items"]["properties"]["custom"]["anyOf"][0]["pattern"])
+    )
+    assert list(err.value.absolute_path) == [50, "custom"]
+
+    # without the types for csv data every record has extra properties
+    validator = build_validator(CSV_ARRAY_SCHEMA)
+    expected = best_match(validator.iter_errors(csv_records))
+    with pytest.raises(ValidationError) as err:
+        validate_instance(validator, csv_records)
+    assert err.value.message == expected.message
+    assert list(err.value.absolute_path) == list(expected.absolute_path)
+
+
+def test_find_flagged_rows(csv_records):
+    """Only rows with values that may be invalid are flagged"""
+    item_schema = build_validator(CSV_ARRAY_SCHEMA, True).schema["items"]
+    records = copy.copy(csv_records)
+    records[5] = {**records[5], "constraints.maximum": "a"}
+    records[7] = {**records[7], "missingValues": None}
+    records[9] = {**records[9], "constraints.maxLength": 2.0}
+    frame = pd.DataFrame(records, dtype=object)
+    flagged = find_flagged_rows(frame, item_schema)
+    # None is valid for the typed schema, 2.0 is an integer
+    assert list(np.flatnonzero(flagged)) == [5]
+
+    # a required column is missing
+    assert find_flagged_rows(
+        frame.drop(columns="name"), CSV_ARRAY_SCHEMA["items"]
+    ).all()
+    # keywords without a column check flag every row
+    assert find_flagged_rows(frame, {"minProperties": 1}).all()
+    assert find_flagged_rows(
+        frame, {"properties": {"name": {"type": "string", "maxLength": 2}}}
+    ).all()
+
+
+def test_is_column_data(csv_records):
+    assert is_column_data(csv_records)
+    assert not is_column_data(csv_records[: MIN_COLUMN_VALIDATION_ROWS - 1])
+    assert not is_column_data(csv_records + [{"name": "other"}])
+    assert not is_column_data(csv_records + ["not a record"])
+    assert not is_column_data({"fields": csv_records})
+
+
+def test_is_records_schema():
+    assert is_records_schema(CSV_ARRAY_SCHEMA)
+    assert not is_records_schema({"type": "array", "items": {}, "minItems": 1})
+    assert not is_records_schema({"type": "object"})
@@ -0,0 +1,263 @@
+"""
+Differential tests of the compiled validators against the jsonschema validators,
+with the test dictionaries and mutations of them.
+"""
+
+import copy
+import json
+from pathlib import Path
+
+import jsonschema
+import pytest
+from jsonschema import ValidationError
+
+from heal.vlmd.utils import add_types_to_props
+from heal.vlmd.validate.fast_validator import (
+    FastValidator,
+    SchemaCompiler,
+    UnsupportedSchemaError,
+    get_schema_key,
+)
+from heal.vlmd.validate.utils import (
+    CSV_ARRAY_SCHEMA,
+    JSON_SCHEMA,
+    build_validator,
+    clear_validator_cache,
+    get_validator,
+    read_delim,
+    set_validator_backend,
+    validate_instance,
+)
+
+VALID_DIR = Path("tests/test_data/vlmd/valid")
+MUTATED_VALUES = [None, True, 0, 1, 1.0, 1.5, -3, "", "1.2.3", "a|b", "x=1", [], {}]
+
+
+def get_instances(schema_type: str) -> list:
+    """Get the test dictionaries for a schema type, as read from the files"""
+    if schema_type == "csv":
+        return [
+            read_delim(path).to_dict(orient="records")
+            for path in sorted(VALID_DIR.glob("vlmd_valid*.[ct]sv"))
+        ]
+    return [
+        json.loads(path.read_text())
+        for path in sorted(VALID_DIR.glob("vlmd_*.json"))
+        if "fields" in path.read_text()
+    ]
+
+
+def iter_mutations(instance):
+    """Yield copies of an instance with one value replaced, removed or added"""
+    yield instance
+    yield MUTATED_VALUES
+    for value in MUTATED_VALUES:
+        yield value
+
+    def paths(node, path=()):
+        yield path
+        if isinstance(node, dict):
+            for key, value in node.items():
+                yield from paths(value, path + (key,))
+        elif isinstance(node, list):
+            for index, value in enumerate(node[:2]):
+                yield from paths(value, path + (index,))
+
+    for path in paths(instance):
+        if not path:
+            continue
+        for value in MUTATED_VALUES:
+            mutated = copy.deepcopy(instance)
+            parent = mutated
+            for key in path[:-1]:
+                parent = parent[key]
+            parent[path[-1]] = value
+            yield mutated
+        mutated = copy.deepcopy(instance)
+        parent = mutated
+        for key in path[:-1]:
+            parent = parent[key]
+        if isinstance(parent, dict):
+            del parent[path[-1]]
+            yield mutated
+            parent["extraProperty"] = "extra"
+            yield mutated
+
+
+def get_error(validator, instance):
+    try:
+        validate_instance(validator, instance)
+    except ValidationError as err:
+        return (err.message, list(err.absolute_path), list(err.absolute_schema_path))
+    return None
+
+
+@pytest.mark.parametrize("schema_type", ["csv", "json"])
+@pytest.mark.parametrize("add_missing_types", [False, True])
+def test_fast_validator_differential(schema_type, add_missing_types, tmp_path):
+    """The fast validator passes and fails the same data with the same errors"""
+    schema = {"csv": CSV_ARRAY_SCHEMA, "json": JSON_SCHEMA}[schema_type]
+    reference = build_validator(schema, add_missing_types, backend="jsonschema")
+    fast = build_validator(schema, add_missing_types, backend="fast")
+    assert isinstance(fast, FastValidator)
+
+    checked = invalid = 0
+    for instance in get_instances(schema_type):
+        for mutated in iter_mutations(instance):
+            expected = reference.is_valid(mutated)
+            assert fast.is_valid(mutated) == expected, mutated
+            if not expected:
+                assert get_error(fast, mutated) == get_error(reference, mutated)
+                invalid += 1
+            checked += 1
+    assert checked > 500
+    assert invalid > 50
+
+
+@pytest.mark.parametrize(
+    "schema,valid,invalid",
+    [
+        ({"type": "integer"}, [1, 1.0, -2], [1.5, True, "1", None]),
+        ({"type": "number"}, [1, 1.5], [True, "1"]),
+        ({"type": ["string", "null"]}, ["", None], [0, False]),
+        ({"enum": [1, "a", None]}, [1, 1.0, "a", None], [True, 0, "b", [1]]),
+        ({"enum": ["a", "b"]}, ["a"], ["c", ["a"], {"a": 1}]),
+        ({"pattern": "^a"}, ["ab", 1], ["ba"]),
+        (
+            {"patternProperties": {"^x": {"type": "string"}}},
+            [{"xa": "1", "y": 1}, []],
+            [{"xa": 1}],
+        ),
+        (
+            {
+                "properties": {"a": {}},
+                "patternProperties": {"^x": {}, "^y": {}},
+                "additionalProperties": False,
+            },
+            [{"a": 1, "x1": 2, "y1": 3}],
+            [{"b": 1}],
+        ),
+        (
+            {"additionalProperties": {"type": "integer"}},
+            [{"a": 1}],
+            [{"a": "1"}],
+        ),
+        ({"items": False}, [[], 1], [[1]]),
+        ({"propertyNames": {"pattern": "^[a-z]+$"}}, [{"ab": 1}], [{"A": 1}]),
+        (
+            {"anyOf": [{"type": "string"}, {"type": "integer"}]},
+            ["a", 1],
+            [1.5, None],
+        ),
+        ({"required": ["a"]}, [{"a": None}, "a"], [{}]),
+        (False, [], [1, None]),
+    ],
+)
+def test_fast_validator_keywords(schema, valid, invalid, tmp_path):
+    """Compiled keywords have the jsonschema semantics"""
+    validator = FastValidator(schema, cache_dir=tmp_path)
+    reference = jsonschema.validators.validator_for(schema)(schema)
+    for instance in valid:
+        assert validator.is_valid(instance) and reference.is_valid(instance)
+    for instance in invalid:
+        assert not validator.is_valid(instance) and not reference.is_valid(instance)
+        assert list(validator.iter_errors(instance))
+
+
+def test_fast_validator_disk_cache(tmp_path):
+    """Sources are saved in the cache directory, and only rewritten if they differ"""
+    schema = add_types_to_props(CSV_ARRAY_SCHEMA)
+    validator_class = jsonschema.validators.validator_for(schema)
+    source_path = tmp_path / f"{get_schema_key(schema, validator_class)}.py"
+
+    FastValidator(schema, cache_dir=tmp_path)
+    source = SchemaCompiler(schema, validator_class).source
+    assert source_path.read_text() == source
+    modified_time = source_path.stat().st_mtime_ns
+    FastValidator(schema, cache_dir=tmp_path)
+    assert source_path.stat().st_mtime_ns == modified_time
+
+    # the key changes with the schema
+    assert get_schema_key(CSV_ARRAY_SCHEMA, validator_class) != source_path.stem
+
+
+@pytest.mark.parametrize(
+    "cached_source",
+    [
+        lambda source: source[: len(source) // 2],
+        lambda source: source.replace("return False", "return True", 1),
+        lambda source: "validate = lambda x: 'cached'\n",
+        lambda source: "",
+    ],
+    ids=["truncated", "edited", "replaced", "empty"],
+)
+def test_fast_validator_cached_source_not_run(cached_source, tmp_path):
+    """Cached sources are never run, and are saved again if they differ"""
+    schema = add_types_to_props(CSV_ARRAY_SCHEMA)
+    validator_class = jsonschema.validators.validator_for(schema)
+    source_path = tmp_path / f"{get_schema_key(schema, validator_class)}.py"
+    FastValidator(schema, cache_dir=tmp_path)
+    source = source_path.read_text()
+
+    source_path.write_text(cached_source(source))
+    validator = FastValidator(schema, cache_dir=tmp_path)
+    assert validator.is_valid([{"name": "a"}]) is True
+    assert not validator.is_valid([{"name": 1}])
+    assert source_path.read_text() == source
+
+
+def test_fast_validator_unloadable_source(monkeypatch, tmp_path):
+    """A generated source that cannot be loaded is unsupported, to fall back to jsonschema"""
+    monkeypatch.setattr(
+        SchemaCompiler,
+        "__init__",
+        lambda self, schema, validator_class: setattr(self, "source", "validate =\n"),
+    )
+    with pytest.raises(UnsupportedSchemaError):
+        FastValidator({"type": "string"}, cache_dir=tmp_path)
+
+
+def test_fast_validator_unwritable_cache_dir(tmp_path):
+    """Validators are compiled in memory if the cache directory cannot be written"""
+    cache_dir = tmp_path / "file"
+    cache_dir.write_text("not a directory")
+    validator = FastValidator({"type": "string"}, cache_dir=cache_dir)
+    assert validator.is_valid("a")
+    assert not validator.is_valid(1)
+
+
+@pytest.mark.parametrize(
+    "schema",
+    [
+        {"type": "string", "maxLength": 2},
+        {"properties": {"a": {"$ref": "#/definitions/a"}}, "definitions": {"a": {}}},
+        {
+            "$schema": "http://json-schema.org/draft-07/schema#",
+            "items": [{"type": "string"}],
+        },
+        {"$schema": "http://json-schema.org/draft-04/schema#", "type": "string"},
+    ],
+)
+def test_fast_validator_unsupported(schema, tmp_path):
+    """Schemas with keywords that are not compiled fall back to jsonschema"""
+    with pytest.raises(UnsupportedSchemaError):
+        FastValidator(schema, cache_dir=tmp_path)
+    validator = build_validator(schema, backend="fast")
+    assert not isinstance(validator, FastValidator)
+
+
+def test_set_validator_backend(validator_cache_dir):
+    """The default backend is used by get_validator, and cached separately"""
+    assert not isinstance(get_validator(JSON_SCHEMA), FastValidator)
+    try:
+        set_validator_backend("fast", cache_dir=validator_cache_dir)
+        assert isinstance(get_validator(JSON_SCHEMA), FastValidator)
+        assert not isinstance(
+            get_validator(JSON_SCHEMA, backend="jsonschema"), FastValidator
+        )
+        with pytest.raises(ValueError):
+            set_validator_backend("unknown")
+    finally:
+        set_validator_backend("jsonschema", cache_dir=validator_cache_dir)
+    assert not isinstance(get_validator(JSON_SCHEMA), FastValidator)
+    clear_validator_cache()
@@ -4,7 +4,11 @@ import os
 import pandas as pd
 
 from heal.vlmd.config import OUTPUT_FILE_PREFIX
-from heal.vlmd.file_utils import get_output_filepath, write_vlmd_dict
+from heal.vlmd.file_utils import (
+    get_input_files,
+    get_output_filepath,
+    write_vlmd_dict,
+)
 
 
 def test_write_json(tmp_path, valid_json_data):
@@ -64,3 +68,21 @@ def test_write_vlmd_unallowed():
         dictionary, output_filepath=output_filepath, file_type="auto"
     )
     assert result is None
+
+
+def test_get_input_files(tmp_path):
+    """Input files are the dictionary files matching the pattern"""
+    for name in ["b.csv", "a.json", "c.tsv", "notes.txt", "sub/d.csv"]:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text("")
+    (tmp_path / "dir.csv").mkdir()
+
+    assert get_input_files(tmp_path) == [
+        tmp_path / "a.json",
+        tmp_path / "b.csv",
+        tmp_path / "c.tsv",
+    ]
+    assert get_input_files(tmp_path, "**/*.csv") == [
+        tmp_path / "b.csv",
+        tmp_path / "sub/d.csv",
+    ]
@@ -3,9 +3,10 @@ from unittest.mock import patch
 import pytest
 from jsonschema import SchemaError, ValidationError
 
-from heal.vlmd import ExtractionError, vlmd_validate
+from heal.vlmd import ExtractionError, vlmd_validate, vlmd_validate_many
 from heal.vlmd.config import ALLOWED_OUTPUT_TYPES
 from heal.vlmd.extract.csv_dict_conversion import RedcapExtractionError
+from heal.vlmd.validate.report import ValidationReport
 
 
 @pytest.mark.parametrize(
@@ -158,6 +159,31 @@ def test_validate_dataset_as_dictionary_csv_output(suffix):
     assert str(e.value) == expected_message
 
 
+@pytest.mark.parametrize("suffix", ["csv", "tsv"])
+def test_validate_dataset_as_dictionary_csv_output_collect_errors(suffix):
+    """The required csv properties are reported up to max_errors when collecting errors"""
+    test_file = f"tests/test_data/vlmd/valid/vlmd_valid_data.{suffix}"
+    report = vlmd_validate(
+        test_file, file_type=suffix, output_type="csv", collect_errors=True
+    )
+    assert not report.valid
+    assert not report.truncated
+    assert [error["message"] for error in report.errors] == [
+        "'description' is a required property in csv dictionaries"
+    ]
+
+    report = vlmd_validate(
+        test_file,
+        file_type=suffix,
+        output_type="csv",
+        collect_errors=True,
+        max_errors=0,
+    )
+    assert report.error_count == 0
+    assert report.truncated
+    assert not report.valid
+
+
 @pytest.mark.parametrize("test_schema_type", ["auto", "csv"])
 def test_read_non_delim_data_in_csv(test_schema_type):
     test_file = "tests/test_data/vlmd/invalid/vlmd_text_data.csv"
@@ -181,7 +207,7 @@ def test_invalid_converted_data():
     input_file = "tests/test_data/vlmd/valid/vlmd_valid.csv"
     fail_message = "Failed validation"
 
-    with patch("jsonschema.validate") as mock_validate:
+    with patch("heal.vlmd.validate.validate.validate_instance") as mock_validate:
         mock_validate.side_effect = ValidationError(fail_message)
         with pytest.raises(ValidationError) as e:
             vlmd_validate(input_file, output_type="json")
@@ -234,3 +260,82 @@ def test_could_not_get_schema():
             vlmd_validate(input_file=test_file, schema_type=schema_type)
         expected_message = f"Could not get schema for type = {schema_type}"
         assert expected_message in str(e.value)
+
+
+@pytest.mark.parametrize("file_type", ["csv", "json", "tsv"])
+def test_validate_collect_errors_valid(file_type, valid_json_data):
+    """vlmd_validate returns a valid report with the output when collecting errors"""
+    input_file = f"tests/test_data/vlmd/valid/vlmd_valid.{file_type}"
+    report = vlmd_validate(
+        input_file, collect_errors=True, return_converted_output=True
+    )
+    assert isinstance(report, ValidationReport)
+    assert report.valid
+    assert report.error_count == 0
+    assert isinstance(report.converted_output, dict)
+    if file_type == "json":
+        assert report.converted_output == valid_json_data
+
+
+@pytest.mark.parametrize("file_type", ["csv", "json", "tsv"])
+def test_validate_collect_errors(file_type):
+    """vlmd_validate reports the errors of all the fields when collecting errors"""
+    test_file = f"tests/test_data/vlmd/invalid/vlmd_missing_description.{file_type}"
+    with pytest.raises(ValidationError) as e:
+        vlmd_validate(test_file)
+
+    report = vlmd_validate(test_file, collect_errors=True, return_converted_output=True)
+    assert not report.valid
+    assert report.converted_output is None
+    assert report.errors[0]["message"] == e.value.message
+    assert all(
+        list(properties) == ["description"] for properties in report.fields.values()
+    )
+    assert report.error_count == len(report.fields)
+
+    report = vlmd_validate(test_file, collect_errors=True, max_errors=0)
+    assert report.error_count == 0
+    assert report.truncated
+    assert not report.valid
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_validate_many(workers):
+    """vlmd_validate_many returns a result for each file, in order"""
+    input_files = [
+        "tests/test_data/vlmd/valid/vlmd_valid.csv",
+        "tests/test_data/vlmd/invalid/vlmd_missing_name.json",
+        "tests/test_data/vlmd/valid/vlmd_valid.json",
+        "tests/test_data/vlmd/invalid/vlmd_string_in_maxLength.csv",
+        "tests/test_data/vlmd/invalid/vlmd_invalid.txt",
+    ]
+    results = list(vlmd_validate_many(input_files, workers=workers, chunksize=2))
+    assert [result["input_file"] for result in results] == input_files
+    assert [result["valid"] for result in results] == [True, False, True, False, False]
+    assert [result.get("error_type") for result in results] == [
+        None,
+        "ValidationError",
+        None,
+        "ExtractionError",
+        "ValueError",
+    ]
+    assert results[1]["message"] == "'name' is a required property"
+
+
+def test_validate_many_collect_errors():
+    """vlmd_validate_many adds the report of each file when collecting errors"""
+    input_files = [
+        "tests/test_data/vlmd/invalid/vlmd_missing_description.tsv",
+        "tests/test_data/vlmd/valid/vlmd_valid.tsv",
+    ]
+    invalid, valid = vlmd_validate_many(input_files, workers=1, collect_errors=True)
+    assert not invalid["valid"]
+    assert invalid["error_count"] == len(invalid["errors"]) > 0
+    assert valid == {
+        "input_file": input_files[1],
+        "valid": True,
+        "error_count": 0,
+        "truncated": False,
+        "errors": [],
+        "fields": {},
+    }
@@ -0,0 +1,86 @@
+import copy
+import json
+
+from jsonschema.exceptions import best_match
+
+from heal.vlmd.validate.report import (
+    ROOT_FIELD,
+    ValidationReport,
+    collect_validation_errors,
+)
+from heal.vlmd.validate.utils import (
+    CSV_ARRAY_SCHEMA,
+    JSON_SCHEMA,
+    get_validator,
+)
+
+
+def test_collect_validation_errors_json(valid_json_data):
+    """Errors of json dictionaries are grouped by field name and property"""
+    data = copy.deepcopy(valid_json_data)
+    del data["title"]
+    data["fields"][0]["constraints"]["maxLength"] = "foo"
+    data["fields"][0]["type"] = "text"
+    del data["fields"][1]["name"]
+    validator = get_validator(JSON_SCHEMA)
+
+    report = collect_validation_errors(validator, data)
+    assert not report.valid
+    assert not report.truncated
+    assert report.error_count == 4
+    assert report.fields == {
+        ROOT_FIELD: {"title": ["'title' is a required property"]},
+        "participant_id": {
+            "constraints.maxLength": ["'foo' is not of type 'integer'"],
+            "type": [report.fields["participant_id"]["type"][0]],
+        },
+        "fields[1]": {"name": ["'name' is a required property"]},
+    }
+    assert "'text' is not one of" in report.fields["participant_id"]["type"][0]
+    assert {
+        "field": "participant_id",
+        "property": "constraints.maxLength",
+        "path": ["fields", 0, "constraints", "maxLength"],
+        "validator": "type",
+        "message": "'foo' is not of type 'integer'",
+    } in report.errors
+    # the report can be written as json
+    assert json.loads(json.dumps(report.to_dict()))["error_count"] == 4
+
+
+def test_collect_validation_errors_csv(valid_array_data):
+    """Errors of csv dictionaries use the most relevant error of each violation"""
+    data = [dict(record) for record in valid_array_data * 20]
+    data[30]["constraints.maxLength"] = "x"
+    data[40]["custom"] = "no key value pairs"
+    validator = get_validator(CSV_ARRAY_SCHEMA, add_missing_types=True)
+
+    report = collect_validation_errors(validator, data)
+    assert [(error["field"], error["property"]) for error in report.errors] == [
+        (data[30]["name"], "constraints.maxLength"),
+        (data[40]["name"], "custom"),
+    ]
+    assert report.errors[0]["message"] == (
+        "'x' is not valid under any of the given schemas"
+    )
+    assert report.errors[0]["path"] == [30, "constraints.maxLength"]
+    assert (
+        report.errors[1]["message"] == best_match(validator.iter_errors(data)).message
+    )
+
+
+def test_collect_validation_errors_max_errors(valid_array_data):
+    """Collection stops at max_errors"""
+    data = [{**record, "constraints.maxLength": "x"} for record in valid_array_data]
+    validator = get_validator(CSV_ARRAY_SCHEMA, add_missing_types=True)
+
+    report = collect_validation_errors(validator, data, max_errors=2)
+    assert report.error_count == 2
+    assert report.truncated
+
+    report = collect_validation_errors(validator, data, max_errors=None)
+    assert report.error_count == len(data)
+    assert not report.truncated
+
+    report = collect_validation_errors(validator, valid_array_data)
+    assert report == ValidationReport()
@@ -1,14 +1,22 @@
 import json
 from pathlib import Path
+from unittest.mock import patch
 
+import jsonschema
 import pandas as pd
 import pytest
+from jsonschema import SchemaError, ValidationError
 
+from heal.vlmd import vlmd_validate
+from heal.vlmd.utils import add_types_to_props
 from heal.vlmd.validate.utils import (
+    clear_validator_cache,
     detect_file_encoding,
     get_schema,
+    get_validator,
     read_data_from_json_file,
     read_delim,
+    validate_instance,
 )
 
 
@@ -150,3 +158,54 @@ def test_get_schema_unknown_type(allowed_schema_types):
     assert unallowed_schema_type not in allowed_schema_types
     result = get_schema(test_file, unallowed_schema_type)
     assert result is None
+
+
+def test_get_validator_cached(valid_array_data):
+    """Validators are cached by schema type and add_missing_types"""
+    clear_validator_cache()
+    csv_validator = get_validator(get_schema("vlmd.csv", "auto"))
+    assert get_validator(get_schema("vlmd.tsv", "auto")) is csv_validator
+    typed_validator = get_validator(get_schema("vlmd.csv", "auto"), True)
+    assert typed_validator is not csv_validator
+    assert typed_validator.schema == add_types_to_props(get_schema("vlmd.csv", "csv"))
+    assert get_validator(get_schema("vlmd.json", "auto")) is get_validator(
+        get_schema({}, "json")
+    )
+    validate_instance(typed_validator, valid_array_data)
+
+    # other schemas are not cached
+    schema = {"type": "array"}
+    assert get_validator(schema) is not get_validator(schema)
+
+
+def test_get_validator_invalid_schema(invalid_csv_schema):
+    """Invalid schemas raise SchemaError"""
+    with pytest.raises(SchemaError):
+        get_validator(invalid_csv_schema)
+
+
+def test_validate_instance_error(valid_json_data):
+    """validate_instance raises the same error as jsonschema.validate"""
+    schema = get_schema(valid_json_data, "json")
+    invalid_data = {**valid_json_data, "fields": "not a list"}
+    with pytest.raises(ValidationError) as expected:
+        jsonschema.validate(instance=invalid_data, schema=schema)
+    with pytest.raises(ValidationError) as e:
+        validate_instance(get_validator(schema), invalid_data)
+    assert e.value.message == expected.value.message
+    assert list(e.value.path) == list(expected.value.path)
+
+
+def test_vlmd_validate_checks_schema_once():
+    """Repeated validations do not check the schema again"""
+    clear_validator_cache()
+    with patch(
+        "jsonschema.validators.Draft7Validator.check_schema",
+        wraps=jsonschema.validators.Draft7Validator.check_schema,
+    ) as check_schema:
+        for _ in range(3):
+            assert vlmd_validate("tests/test_data/vlmd/valid/vlmd_valid.json")
+            assert vlmd_validate("tests/test_data/vlmd/valid/vlmd_valid.csv")
+    # the json schema and the csv schema with missing types, the json output
+    # of the csv input uses the cached json validator
+    assert check_schema.call_count == 2